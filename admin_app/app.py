@@ -1,6 +1,13 @@
 import streamlit as st
 import os
-from chatpdf import process_and_save_pdfs
+import time
+import shutil
+from chatpdf import (
+    remove_pdf, rollback_index, current_generation, list_generations, index_version,
+    list_collections, collection_data_dir, COLLECTION_NAME_PATTERN,
+)
+from ingest_queue import submit_job, list_jobs, ensure_worker, ACTIVE_STATES
+import metrics
 import hashlib
 
 # Set page config
@@ -79,6 +86,43 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# Stages shown in the performance panel, in pipeline order
+METRIC_STAGES = {
+    "Ingestion": ["extract", "split", "embed", "index_add", "save", "ingest"],
+    "Chat": ["load", "rerun", "condense", "query_embed", "retrieve", "pack", "generate", "first_token", "answer"],
+    "Query API": ["api_wait", "api_request", "query_embed_batch"],
+}
+METRIC_WINDOWS = {"Last 15 minutes": 900, "Last hour": 3600, "Last 24 hours": 86400, "Last 7 days": 7 * 86400}
+# Uploads are copied to disk in blocks of this many bytes
+UPLOAD_BLOCK_SIZE = 1024 * 1024
+
+def save_upload(uploaded_file, path):
+    """Stream an uploaded file to path block by block, replacing any earlier version in one step"""
+    # The partial file does not end in .pdf, so ingestion never picks it up
+    tmp_path = f"{path}.part"
+    uploaded_file.seek(0)
+    with open(tmp_path, "wb") as f:
+        shutil.copyfileobj(uploaded_file, f, UPLOAD_BLOCK_SIZE)
+    os.replace(tmp_path, path)
+
+def metric_rows(summary, stages):
+    """Table rows of the recorded stages: latency percentiles, throughput and totals"""
+    rows = []
+    for stage in stages:
+        stats = summary.get(stage)
+        if stats is None:
+            continue
+        rows.append({
+            "Stage": stage,
+            "Samples": stats["count"],
+            "p50 ms": round(stats.get("p50_ms", 0), 1),
+            "p95 ms": round(stats.get("p95_ms", 0), 1),
+            "p99 ms": round(stats.get("p99_ms", 0), 1),
+            "Throughput": ", ".join(f"{rate:,.0f} {name}/s" for name, rate in stats.get("per_s", {}).items()),
+            "Totals": ", ".join(f"{total:,} {name}" for name, total in stats["totals"].items()),
+        })
+    return rows
+
 # Password protection
 def check_password():
     """Returns True if the user has entered the correct password."""
@@ -139,9 +183,6 @@ def check_password():
         return True
 
 if check_password():
-    # Create data directory if it doesn't exist
-    os.makedirs("data", exist_ok=True)
-    
     # Header
     st.markdown('<h1 class="header-text">🛡️ Admin Panel – Document Management System</h1>', unsafe_allow_html=True)
     
@@ -155,16 +196,60 @@ if check_password():
         </div>
         """, unsafe_allow_html=True)
         
+        # Each collection has its own folder and index, rebuilt independently of the others
+        st.markdown("### 🗂️ Collection")
+        collections = list_collections()
+        new_collection = st.text_input(
+            "New collection",
+            placeholder="e.g. hr",
+            help="Letters, digits, '-' and '_'. Uploads to it create its folder and index."
+        ).strip()
+        if new_collection and not COLLECTION_NAME_PATTERN.match(new_collection):
+            st.error("❌ Invalid collection name")
+            new_collection = ""
+        if new_collection and new_collection not in collections:
+            collections.append(new_collection)
+        collection = st.selectbox(
+            "Manage collection",
+            collections,
+            index=collections.index(new_collection) if new_collection else 0,
+        )
+        data_dir = collection_data_dir(collection)
+        
         st.markdown("### 📊 System Status")
         
         # Count existing files
-        data_files = [f for f in os.listdir("data") if f.endswith('.pdf')]
+        data_files = [f for f in (os.listdir(data_dir) if os.path.isdir(data_dir) else []) if f.endswith('.pdf')]
         st.metric("📄 Total Documents", len(data_files))
         
         # Check if embeddings exist
-        embeddings_exist = os.path.exists("embeddings/docs_index.faiss")
+        embeddings_exist = index_version(collection) is not None
         st.metric("🧠 Embeddings Status", "✅ Ready" if embeddings_exist else "❌ Not Ready")
         
+        if data_files and st.button("🔁 Rebuild Collection", use_container_width=True):
+            # Files keep their access roles from the saved manifest, see process_and_save_pdfs
+            submit_job([], index_name=collection, rebuild=True)
+            ensure_worker()
+            st.success(f"✅ Rebuild of {collection} queued")
+        
+        # Earlier index generations kept for rollback
+        current = current_generation(collection)
+        generations = [generation for generation in list_generations(collection) if generation != current]
+        if current is not None and generations:
+            st.caption(f"Serving index generation {int(current)}")
+            target = st.selectbox(
+                "Roll back to generation",
+                generations[::-1],
+                format_func=lambda generation: str(int(generation)),
+            )
+            if st.button("⏪ Roll Back Index", use_container_width=True):
+                try:
+                    rollback_index(collection, generation=target, lock_timeout=5)
+                    st.success(f"✅ Now serving generation {int(target)}")
+                    st.rerun()
+                except Exception as e:
+                    st.error(f"❌ Error rolling back: {str(e)}")
+        
         if st.button("🔄 Refresh Status", use_container_width=True):
             st.rerun()
     
@@ -176,6 +261,7 @@ if check_password():
         st.markdown("""
         <div class="upload-section">
             <h3 style="color: white; text-align: center; margin-bottom: 20px;">📤 Upload New Documents</h3>
+            <p style="color: white; text-align: center;">Uploads go to the collection selected in the sidebar</p>
         </div>
         """, unsafe_allow_html=True)
         
@@ -185,6 +271,11 @@ if check_password():
             accept_multiple_files=True,
             help="Select one or more PDF files to upload"
         )
+        access_roles = st.text_input(
+            "Restrict to roles",
+            placeholder="e.g. hr, finance",
+            help="Comma-separated roles allowed to retrieve these documents. Leave empty to share them with everyone."
+        )
         
         if st.button("🚀 Process Documents", use_container_width=True, type="primary") and uploaded_pdfs:
             pdf_paths = []
@@ -192,33 +283,51 @@ if check_password():
             status_text = st.empty()
             
             # Save uploaded files
+            os.makedirs(data_dir, exist_ok=True)
             for i, pdf in enumerate(uploaded_pdfs):
                 status_text.text(f"Saving {pdf.name}...")
                 progress_bar.progress((i + 1) / (len(uploaded_pdfs) + 1))
                 
-                path = os.path.join("data", pdf.name)
-                with open(path, "wb") as f:
-                    f.write(pdf.read())
+                path = os.path.join(data_dir, pdf.name)
+                save_upload(pdf, path)
                 pdf_paths.append(path)
             
-            # Process documents
-            status_text.text("Processing and creating embeddings...")
-            progress_bar.progress(1.0)
-            
-            try:
-                process_and_save_pdfs(pdf_paths)
-                st.markdown("""
-                <div class="success-box">
-                    <h4>✅ Success!</h4>
-                    <p>PDFs processed and embeddings saved successfully!</p>
-                </div>
-                """, unsafe_allow_html=True)
-                st.balloons()
-            except Exception as e:
-                st.error(f"❌ Error processing documents: {str(e)}")
+            # Hand the documents to the background ingestion worker
+            roles = [role.strip() for role in access_roles.split(",") if role.strip()]
+            submit_job(pdf_paths, index_name=collection, roles=roles)
+            ensure_worker()
             
             progress_bar.empty()
             status_text.empty()
+            st.success(f"✅ {len(pdf_paths)} document(s) queued for processing in {collection}")
+        
+        # Ingestion jobs, most recent first
+        jobs = list_jobs(index_name=collection, limit=5)
+        jobs_active = any(job["state"] in ACTIVE_STATES for job in jobs)
+        if jobs:
+            st.markdown("### ⚙️ Processing Jobs")
+            for job in jobs:
+                names = ", ".join(os.path.basename(path) for path in job["pdf_paths"]) or f"Rebuild of {collection}"
+                if job["state"] == "queued":
+                    st.info(f"🕒 {names}: waiting for the worker")
+                elif job["state"] == "running":
+                    extract = job["stages"].get("extract", {})
+                    embed = job["stages"].get("embed", {})
+                    st.progress(
+                        min(extract.get("files_done", 0) / max(extract.get("files_total", 1), 1), 1.0),
+                        text=(
+                            f"⏳ {names}: {job['stage']} – {extract.get('pages', 0)} pages, "
+                            f"{embed.get('vectors', 0)} vectors, {embed.get('cached', 0)} from cache, "
+                            f"{embed.get('restored', 0)} resumed "
+                            f"({embed.get('vectors_per_s', 0):.0f} vectors/s)"
+                        )
+                    )
+                elif job["state"] == "done":
+                    st.success(f"✅ {names}: processed ({job['report']['total_chunks']} chunks in index)")
+                    for path, error in job["report"]["failed"].items():
+                        st.warning(f"⚠️ Could not process {os.path.basename(path)}: {error}")
+                else:
+                    st.error(f"❌ {names}: {job['error']}")
     
     with col2:
         # Existing files section
@@ -228,11 +337,11 @@ if check_password():
         </div>
         """, unsafe_allow_html=True)
         
-        data_files = [f for f in os.listdir("data") if f.endswith('.pdf')]
+        data_files = [f for f in (os.listdir(data_dir) if os.path.isdir(data_dir) else []) if f.endswith('.pdf')]
         
         if data_files:
             for file in data_files:
-                file_path = os.path.join("data", file)
+                file_path = os.path.join(data_dir, file)
                 file_size = os.path.getsize(file_path) / 1024  # Size in KB
                 
                 col_file, col_size, col_delete = st.columns([3, 1, 1])
@@ -246,7 +355,7 @@ if check_password():
                 with col_delete:
                     if st.button("🗑️", key=f"delete_{file}", help=f"Delete {file}"):
                         try:
-                            os.remove(file_path)
+                            remove_pdf(file_path, index_name=collection, lock_timeout=5)
                             st.success(f"✅ {file} deleted successfully!")
                             st.rerun()
                         except Exception as e:
@@ -256,6 +365,27 @@ if check_password():
         else:
             st.info("📁 No documents uploaded yet. Upload some PDFs to get started!")
     
+    # Stage timings recorded by the user app, the ingestion worker and this panel
+    store = metrics.get_store()
+    if store is not None:
+        st.markdown("### 📈 Performance")
+        window = METRIC_WINDOWS[st.selectbox("Window", list(METRIC_WINDOWS), index=1)]
+        summary = store.summary(window)
+        if summary:
+            for title, stages in METRIC_STAGES.items():
+                rows = metric_rows(summary, stages)
+                if rows:
+                    st.markdown(f"**{title}**")
+                    st.dataframe(rows, use_container_width=True, hide_index=True)
+            st.download_button(
+                "⬇️ Prometheus metrics",
+                store.prometheus_text(window),
+                file_name="intellidoc_metrics.prom",
+                mime="text/plain",
+            )
+        else:
+            st.info("No metrics recorded in this window yet.")
+
     # Footer
     st.markdown("---")
     st.markdown("""
@@ -263,4 +393,10 @@ if check_password():
         <p>🛡️ Admin Panel - IntelliDocAI System</p>
         <p>Manage your document library with ease</p>
     </div>
-    """, unsafe_allow_html=True)
\ No newline at end of file
+    """, unsafe_allow_html=True)
+    
+    # Poll job status while the worker is busy, restarting it if it died
+    if jobs_active:
+        ensure_worker()
+        time.sleep(2)
+        st.rerun()
\ No newline at end of file
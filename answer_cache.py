@@ -0,0 +1,276 @@
+import os
+import json
+import base64
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+from langchain_core.documents import Document
+
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", 1000))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", 24 * 3600))
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95))
+# The log is rewritten with only the live entries once it holds this many times max_entries records
+LOG_COMPACT_FACTOR = 2
+
+def normalize_question(question):
+    """Key for exact-duplicate questions, ignoring case and spacing"""
+    return " ".join(question.lower().split())
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+class AnswerCache:
+    """Answers to previous questions, looked up by cosine similarity of the question embeddings
+
+    Entries belong to one index version and are dropped as soon as another version is seen.
+    Least recently used entries are evicted beyond max_entries, and entries expire after ttl seconds.
+
+    On disk the cache is an append-only log of JSON lines, one per stored answer, so storing
+    an answer writes only that answer. Replaying the log on load keeps the newest max_entries
+    entries of the latest version; the log is compacted once it holds LOG_COMPACT_FACTOR times
+    max_entries records.
+    """
+
+    def __init__(self, path=None, max_entries=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL, threshold=ANSWER_CACHE_THRESHOLD):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.version = None
+        self.counters = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0, "expired": 0, "invalidations": 0}
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._inflight = {}
+        self._log_records = 0
+        self._clear()
+        if path is not None:
+            self._load()
+
+    def _clear(self):
+        # Rows of one preallocated matrix hold the vectors, the OrderedDict keeps them in LRU order
+        self._entries = OrderedDict()
+        self._vectors = None
+        self._created = np.zeros(self.max_entries, dtype=np.float64)
+        self._used = np.zeros(self.max_entries, dtype=bool)
+
+    def _check_version(self, version):
+        if version != self.version:
+            if self._entries:
+                self.counters["invalidations"] += 1
+            self._clear()
+            self.version = version
+
+    def _drop(self, row):
+        self._entries.pop(row, None)
+        self._used[row] = False
+
+    def lookup(self, vector, version, count=True):
+        """Cached entry for the most similar question above the threshold, or None
+
+        Pass count=False for a repeated lookup that should not change the hit/miss counters.
+        """
+        if self.max_entries <= 0:
+            return None
+        query = _unit(vector)
+        with self._lock:
+            self._check_version(version)
+            if not self._entries:
+                self.counters["misses"] += count
+                return None
+
+            expired = self._used & (self._created < time.time() - self.ttl)
+            for row in np.flatnonzero(expired):
+                self._drop(int(row))
+                self.counters["expired"] += 1
+
+            scores = self._vectors @ query
+            scores[~self._used] = -np.inf
+            row = int(np.argmax(scores))
+            if scores[row] < self.threshold:
+                self.counters["misses"] += count
+                return None
+            self._entries.move_to_end(row)
+            self.counters["hits"] += count
+            entry = self._entries[row]
+            return dict(entry, similarity=float(scores[row]), source_documents=list(entry["source_documents"]))
+
+    def store(self, question, vector, answer, source_documents, version):
+        """Remember the answer to a question of the given index version"""
+        if self.max_entries <= 0:
+            return
+        vector = _unit(vector)
+        with self._lock:
+            self._check_version(version)
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+            if len(self._entries) >= self.max_entries:
+                row, _ = self._entries.popitem(last=False)
+                self._used[row] = False
+                self.counters["evictions"] += 1
+            row = int(np.flatnonzero(~self._used)[0])
+            self._vectors[row] = vector
+            self._created[row] = time.time()
+            self._used[row] = True
+            entry = self._entries[row] = {
+                "question": question,
+                "answer": answer,
+                "source_documents": list(source_documents),
+                "created_at": float(self._created[row]),
+            }
+        self._append([_record(entry, vector, version)])
+
+    def join(self, key):
+        """Register interest in the answer for key
+
+        Returns the in-flight call and whether this caller owns it. The owner computes the answer
+        and passes it to finish; everyone else waits for it.
+        """
+        with self._lock:
+            call = self._inflight.get(key)
+            if call is not None:
+                self.counters["coalesced"] += 1
+                return call, False
+            call = {"done": threading.Event()}
+            self._inflight[key] = call
+            return call, True
+
+    def wait(self, call):
+        """Result of a call owned by another caller, or its error"""
+        call["done"].wait()
+        if "error" in call:
+            raise call["error"]
+        return call["result"]
+
+    def finish(self, key, call, result=None, error=None):
+        """Hand the owner's result, or error, to every waiting caller"""
+        if error is not None:
+            call["error"] = error
+        else:
+            call["result"] = result
+        with self._lock:
+            self._inflight.pop(key, None)
+        call["done"].set()
+
+    def get_or_compute(self, key, compute):
+        """Run compute once for concurrent callers with the same key, all of them get its result
+
+        Returns the result and whether it was produced by another caller.
+        """
+        call, owner = self.join(key)
+        if not owner:
+            return self.wait(call), True
+        try:
+            result = compute()
+        except Exception as e:
+            self.finish(key, call, error=e)
+            raise
+        self.finish(key, call, result)
+        return result, False
+
+    def stats(self):
+        """Counters, current size and hit rate"""
+        with self._lock:
+            stats = dict(self.counters, entries=len(self._entries), max_entries=self.max_entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def clear(self):
+        """Drop every entry"""
+        with self._lock:
+            self._clear()
+        self.save()
+
+    def _append(self, records):
+        """Append records to the log, compacting it when it has grown too long"""
+        if self.path is None:
+            return
+        lines = "".join(json.dumps(record) + "\n" for record in records)
+        with self._save_lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(lines)
+            self._log_records += len(records)
+            compact = self._log_records >= LOG_COMPACT_FACTOR * max(self.max_entries, 1)
+        if compact:
+            self.save()
+
+    def save(self):
+        """Rewrite the log with only the live entries, oldest first"""
+        if self.path is None:
+            return
+        # Entries are never changed once stored, so they are serialized outside the lock
+        with self._lock:
+            version = self.version
+            entries = [(entry, self._vectors[row].copy()) for row, entry in self._entries.items()]
+        records = [{"version": version, "clear": True}] + [_record(entry, vector, version) for entry, vector in entries]
+        with self._save_lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.writelines(json.dumps(record) + "\n" for record in records)
+            os.replace(tmp_path, self.path)
+            self._log_records = len(records)
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+        except OSError:
+            return
+        entries = OrderedDict()
+        version = None
+        # Appending to a file written before the log format, or cut off mid-line, would garble the next record
+        rewrite = bool(lines) and not lines[-1].endswith("\n")
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line cut short by a crash
+                continue
+            if "entries" in record:
+                # A whole cache written before the log format
+                records = [dict(entry, version=record.get("version")) for entry in record["entries"]]
+                rewrite = True
+            else:
+                records = [record]
+            for record in records:
+                if record.get("version") != version or record.get("clear"):
+                    entries.clear()
+                    version = record.get("version")
+                if "question" in record:
+                    entries[self._log_records] = record
+                self._log_records += 1
+
+        self.version = version
+        cutoff = time.time() - self.ttl
+        for entry in list(entries.values())[-self.max_entries:]:
+            if entry["created_at"] < cutoff:
+                continue
+            vector = entry.pop("vector")
+            if isinstance(vector, str):
+                vector = np.frombuffer(base64.b64decode(vector), dtype=np.float32)
+            vector = np.asarray(vector, dtype=np.float32)
+            entry.pop("version", None)
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+            row = len(self._entries)
+            self._vectors[row] = vector
+            self._created[row] = entry["created_at"]
+            self._used[row] = True
+            entry["source_documents"] = [Document(**doc) for doc in entry["source_documents"]]
+            self._entries[row] = entry
+        if rewrite:
+            self.save()
+
+def _record(entry, vector, version):
+    """Log record of an entry, with its vector as base64 float32"""
+    return dict(
+        entry,
+        version=version,
+        vector=base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode("ascii"),
+        source_documents=[{"page_content": doc.page_content, "metadata": doc.metadata} for doc in entry["source_documents"]],
+    )
@@ -0,0 +1,134 @@
+"""Recall@k vs latency of the ANN index types against the exact flat baseline
+
+Run from the project root:
+    python -m benchmarks.ann_report --synthetic 100000
+    python -m benchmarks.ann_report --index docs_index
+"""
+import os
+import json
+import time
+import argparse
+import numpy as np
+import faiss
+import chatpdf
+
+def synthetic_vectors(count, dimension=384, clusters=200, seed=0):
+    """Clustered random vectors, closer to real embeddings than uniform noise"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dimension)).astype(np.float32)
+    assignment = rng.integers(0, clusters, size=count)
+    vectors = centers[assignment] + 0.35 * rng.normal(size=(count, dimension)).astype(np.float32)
+    return vectors.astype(np.float32)
+
+def index_vectors(index_name):
+    """All vectors stored in a saved index"""
+    vectordb = chatpdf.load_vectordb(index_name, mode="memory")
+    labels = np.array(sorted(vectordb.index_to_docstore_id), dtype=np.int64)
+    return vectordb.index.reconstruct_batch(labels)
+
+def make_queries(vectors, count, seed=1):
+    """Perturbed copies of corpus vectors, so every query has true near neighbours"""
+    rng = np.random.default_rng(seed)
+    picks = vectors[rng.choice(len(vectors), size=min(count, len(vectors)), replace=False)]
+    noise = rng.normal(scale=picks.std() * 0.2, size=picks.shape).astype(np.float32)
+    return (picks + noise).astype(np.float32)
+
+def measure(index, queries, truth, k):
+    """Recall@k against the exact neighbours and per-query latency percentiles in ms"""
+    latencies = []
+    found = 0
+    for i in range(len(queries)):
+        started = time.perf_counter()
+        _, labels = index.search(queries[i:i + 1], k)
+        latencies.append((time.perf_counter() - started) * 1000)
+        found += len(set(labels[0].tolist()) & set(truth[i].tolist()))
+    latencies = np.array(latencies)
+    return {
+        "recall_at_k": found / (len(queries) * k),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+    }
+
+def index_bytes(index):
+    """Serialized size of an index, a proxy for its memory footprint"""
+    return int(faiss.serialize_index(index).size)
+
+def build(index_type, vectors):
+    """Build an index exactly as ingestion would, returning it with its parameters and build time"""
+    started = time.perf_counter()
+    index, params = chatpdf._new_ann_index(index_type, vectors.shape[1], len(vectors))
+    if not index.is_trained:
+        rng = np.random.default_rng(0)
+        sample = vectors[rng.choice(len(vectors), size=min(len(vectors), params["nlist"] * 256), replace=False)]
+        index.train(sample)
+    if index_type in ("ivf_flat", "ivf_pq"):
+        index.add_with_ids(vectors, np.arange(len(vectors), dtype=np.int64))
+    else:
+        index.add(vectors)
+    return index, params, time.perf_counter() - started
+
+def run(vectors, queries, k, index_types):
+    """Measure every index type over a sweep of its query-time knob"""
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    _, truth = exact.search(queries, k)
+
+    rows = []
+    for index_type in index_types:
+        if len(vectors) < chatpdf.MIN_TRAINING_VECTORS.get(index_type, 0):
+            print(f"Skipping {index_type}: needs at least {chatpdf.MIN_TRAINING_VECTORS[index_type]} vectors")
+            continue
+        index, params, build_s = build(index_type, vectors)
+        if index_type in ("ivf_flat", "ivf_pq"):
+            sweep = [("nprobe", n) for n in (1, 4, 8, 16, 32, 64) if n <= params["nlist"]]
+        elif index_type == "hnsw":
+            sweep = [("ef_search", ef) for ef in (16, 32, 64, 128, 256)]
+        else:
+            sweep = [(None, None)]
+
+        for knob, value in sweep:
+            if knob is not None:
+                chatpdf._configure_search(index, **{knob: value})
+            row = {"type": index_type, "params": dict(params), "build_s": build_s, "bytes": index_bytes(index)}
+            if knob is not None:
+                row["params"][knob] = value
+            row.update(measure(index, queries, truth, k))
+            rows.append(row)
+    return rows
+
+def format_table(rows, k):
+    """Markdown table of the results"""
+    lines = [
+        f"| index | settings | recall@{k} | p50 ms | p95 ms | p99 ms | size MB | build s |",
+        "|---|---|---|---|---|---|---|---|",
+    ]
+    for row in rows:
+        settings = ", ".join(f"{key}={value}" for key, value in row["params"].items() if key != "type")
+        lines.append(
+            f"| {row['type']} | {settings or '-'} | {row['recall_at_k']:.3f} | {row['p50_ms']:.3f} | "
+            f"{row['p95_ms']:.3f} | {row['p99_ms']:.3f} | {row['bytes'] / 1e6:.1f} | {row['build_s']:.1f} |"
+        )
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--index", help="measure the vectors of a saved index")
+    source.add_argument("--synthetic", type=int, default=50000, help="number of synthetic vectors")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument("--types", default="flat,ivf_flat,ivf_pq,hnsw")
+    parser.add_argument("--output", default="benchmarks/results/ann_report.json")
+    args = parser.parse_args()
+
+    vectors = index_vectors(args.index) if args.index else synthetic_vectors(args.synthetic)
+    queries = make_queries(vectors, args.queries)
+    rows = run(vectors, queries, args.k, args.types.split(","))
+
+    print(f"{len(vectors)} vectors, {len(queries)} queries\n")
+    print(format_table(rows, args.k))
+
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"vectors": len(vectors), "queries": len(queries), "k": args.k, "results": rows}, f, indent=2)
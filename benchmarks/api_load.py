@@ -0,0 +1,170 @@
+"""Load test of the query API: answer throughput and latency as concurrent clients are added
+
+Runs offline against a synthetic corpus (benchmarks/corpus.py). The LLM is FakeChatModel and the
+embedding model is HashEmbeddings with a cost per model call, so that unbatched queries queue for
+the model as they would for sentence-transformers (benchmarks/fake_llm.py). Every concurrency
+level runs with query embedding batching on and off. Each client opens a session and asks --turns
+questions one after the other.
+
+Run from the project root:
+    python -m benchmarks.api_load
+    python -m benchmarks.api_load --concurrency 1,8,32,128 --output benchmarks/results/api_load.json
+"""
+import os
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import datetime
+import aiohttp
+from aiohttp import web
+import chatpdf
+import query_api
+from benchmarks.corpus import generate
+from benchmarks.fake_llm import FakeChatModel, HashEmbeddings
+from benchmarks.pipeline import git_commit, make_queries, percentiles, use_workdir
+
+# Key of the load test clients, known only to the service under test
+API_KEY = "load-test"
+
+async def client(http, base, questions, results):
+    """One session asking its questions in turn, recording status, latency and time to first token"""
+    async with http.post(f"{base}/sessions") as response:
+        session_id = (await response.json())["session_id"]
+    for question in questions:
+        started = time.perf_counter()
+        first_token, last = None, {}
+        async with http.post(f"{base}/sessions/{session_id}/ask", json={"question": question}) as response:
+            if response.status != 200:
+                await response.read()
+                results.append({"status": response.status})
+                continue
+            async for line in response.content:
+                if first_token is None:
+                    first_token = time.perf_counter()
+                last = json.loads(line)
+        results.append({
+            "status": 200,
+            "error": "error" in last,
+            "latency": time.perf_counter() - started,
+            "ttft": first_token - started,
+        })
+
+async def run_level(concurrency, queries, args, batched):
+    """Throughput and latency of one service with concurrency clients"""
+    service = query_api.QueryService(
+        llm=FakeChatModel(latency=args.llm_latency, tokens_per_s=args.llm_tokens_per_s, answer_tokens=args.answer_tokens),
+        use_cache=False,
+        max_concurrent=args.max_concurrent,
+        max_queued=args.max_queued,
+        timeout=args.timeout,
+        batch_window=args.batch_window_ms / 1000 if batched else 0.0,
+        max_batch=args.max_batch if batched else 1,
+        api_keys={API_KEY: query_api.API_DEFAULT_ROLES},
+    )
+    runner = web.AppRunner(query_api.create_app(service))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    base = f"http://127.0.0.1:{runner.addresses[0][1]}"
+    results = []
+    try:
+        async with aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0), headers={"Authorization": f"Bearer {API_KEY}"}
+        ) as http:
+            started = time.perf_counter()
+            await asyncio.gather(*(
+                client(http, base, [queries[(i * args.turns + turn) % len(queries)] for turn in range(args.turns)], results)
+                for i in range(concurrency)
+            ))
+            wall = time.perf_counter() - started
+        embedding = service.batcher.stats()
+    finally:
+        await runner.cleanup()
+
+    answered = [r for r in results if r["status"] == 200 and not r["error"]]
+    return {
+        "batched": batched,
+        "clients": concurrency,
+        "requests": len(results),
+        "answered": len(answered),
+        "rejected": sum(r["status"] == 503 for r in results),
+        "timeouts": sum(r["status"] == 504 or r.get("error", False) for r in results),
+        "wall_s": wall,
+        "answers_per_s": len(answered) / wall,
+        "latency": percentiles([r["latency"] for r in answered]) if answered else {},
+        "time_to_first_token": percentiles([r["ttft"] for r in answered]) if answered else {},
+        "embedding_batches": embedding["batches"],
+        "mean_batch": embedding["mean_batch"],
+    }
+
+def format_table(results):
+    """Markdown summary of the results"""
+    lines = [
+        "| batching | clients | answers/s | p50 s | p95 s | ttft p50 s | ttft p95 s | rejected | timeouts | mean batch |",
+        "|---|---|---|---|---|---|---|---|---|---|",
+    ]
+    for r in results:
+        latency, ttft = r["latency"], r["time_to_first_token"]
+        lines.append(
+            f"| {'on' if r['batched'] else 'off'} | {r['clients']} | {r['answers_per_s']:.2f} | "
+            f"{latency.get('p50_ms', 0) / 1000:.2f} | {latency.get('p95_ms', 0) / 1000:.2f} | "
+            f"{ttft.get('p50_ms', 0) / 1000:.2f} | {ttft.get('p95_ms', 0) / 1000:.2f} | "
+            f"{r['rejected']} | {r['timeouts']} | {r['mean_batch']:.1f} |"
+        )
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", default="1,4,16,64", help="comma separated numbers of concurrent clients")
+    parser.add_argument("--turns", type=int, default=3, help="questions per client")
+    parser.add_argument("--documents", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="seconds before the first token")
+    parser.add_argument("--llm-tokens-per-s", type=float, default=50.0)
+    parser.add_argument("--answer-tokens", type=int, default=40)
+    parser.add_argument("--embed-call-ms", type=float, default=10.0, help="cost of one embedding model call")
+    parser.add_argument("--embed-text-ms", type=float, default=0.5, help="additional cost per embedded text")
+    parser.add_argument("--batch-window-ms", type=float, default=query_api.EMBED_BATCH_WINDOW_MS)
+    parser.add_argument("--max-batch", type=int, default=query_api.EMBED_BATCH_MAX)
+    parser.add_argument("--max-concurrent", type=int, default=32)
+    parser.add_argument("--max-queued", type=int, default=64)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--output", default="benchmarks/results/api_load.json")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="api_load_bench_")
+    results = []
+    try:
+        use_workdir(workdir, real_embeddings=False)
+        corpus = generate(chatpdf.DATA_DIR, args.documents, args.pages)
+        chatpdf.process_and_save_pdfs()
+        # Questions pay the model cost, ingestion does not
+        key = (chatpdf.EMBEDDING_MODEL, chatpdf.EMBEDDING_NORMALIZE, chatpdf.EMBEDDING_BACKEND)
+        chatpdf._embedding_models[key] = HashEmbeddings(call_latency=args.embed_call_ms / 1000, text_latency=args.embed_text_ms / 1000)
+        levels = [int(n) for n in args.concurrency.split(",")]
+        queries = [f"What is the policy on {query}?" for query in make_queries(corpus, max(levels) * args.turns)]
+        for concurrency in levels:
+            for batched in (False, True):
+                result = asyncio.run(run_level(concurrency, queries, args, batched))
+                print(f"{concurrency} clients, batching {'on' if batched else 'off'}: {result['answers_per_s']:.2f} answers/s")
+                results.append(result)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print()
+    print(format_table(results))
+
+    commit, dirty = git_commit()
+    settings = {key: value for key, value in vars(args).items() if key != "output"}
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({
+            "commit": commit,
+            "dirty": dirty,
+            "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "settings": settings,
+            "results": results,
+        }, f, indent=2)
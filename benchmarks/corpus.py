@@ -0,0 +1,75 @@
+"""Synthetic PDF corpus for benchmarks: policy-style pages with headings, paragraphs and form codes
+
+Run from the project root:
+    python -m benchmarks.corpus --documents 50 --pages 20 --output benchmarks/corpus
+"""
+import os
+import argparse
+import numpy as np
+import fitz
+
+TOPICS = [
+    "leave", "travel", "expense", "payroll", "benefit", "security", "laptop", "training",
+    "overtime", "relocation", "insurance", "pension", "onboarding", "procurement", "privacy",
+]
+WORDS = """
+employee manager approval request policy form deadline days month year amount limit receipt claim
+submit review department office team contract salary allowance reimbursement portal record system
+access account password device report incident holiday schedule payment invoice vendor budget
+quarter annual eligible required standard exception escalation director finance human resources
+""".split()
+PAGE_RECT = fitz.Rect(40, 40, 555, 800)
+FONT_SIZE = 8
+
+def page_text(rng, document, page):
+    """Text of one page: a heading and a few paragraphs mentioning form codes and amounts"""
+    topic = TOPICS[(document + page) % len(TOPICS)]
+    paragraphs = [f"Section {page + 1}: {topic.title()} policy (document {document})"]
+    for paragraph in range(int(rng.integers(3, 6))):
+        sentences = []
+        for _ in range(int(rng.integers(3, 6))):
+            words = list(rng.choice(WORDS, size=int(rng.integers(8, 16))))
+            words.insert(int(rng.integers(0, len(words))), topic)
+            if rng.random() < 0.3:
+                words.append(f"form {topic[:2].upper()}-{document % 100:02d}{page % 100:02d}{paragraph}")
+            if rng.random() < 0.3:
+                words.append(f"within {int(rng.integers(2, 60))} days")
+            sentences.append(" ".join(words).capitalize() + ".")
+        paragraphs.append(" ".join(sentences))
+    return "\n\n".join(paragraphs)
+
+def write_pdf(path, document, pages, seed=0):
+    """Write one synthetic PDF, returning the text of its pages"""
+    rng = np.random.default_rng([seed, document])
+    texts = []
+    pdf = fitz.open()
+    for page in range(pages):
+        text = page_text(rng, document, page)
+        # insert_textbox writes nothing when the text overflows, so overflowing pages are cut down
+        while pdf.new_page().insert_textbox(PAGE_RECT, text, fontsize=FONT_SIZE) < 0:
+            pdf.delete_page(-1)
+            text = text[:int(len(text) * 0.8)]
+        texts.append(text)
+    pdf.save(path)
+    pdf.close()
+    return texts
+
+def generate(output_dir, documents, pages, seed=0):
+    """Write documents PDFs of pages pages each into output_dir, returning their paths and page texts"""
+    os.makedirs(output_dir, exist_ok=True)
+    corpus = {}
+    for document in range(documents):
+        path = os.path.join(output_dir, f"synthetic_{document:05d}.pdf")
+        corpus[path] = write_pdf(path, document, pages, seed)
+    return corpus
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--documents", type=int, default=50)
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmarks/corpus")
+    args = parser.parse_args()
+
+    corpus = generate(args.output, args.documents, args.pages, args.seed)
+    print(f"Wrote {len(corpus)} PDFs with {args.documents * args.pages} pages to {args.output}")
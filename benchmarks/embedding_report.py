@@ -0,0 +1,157 @@
+"""Accuracy and throughput of the embedding backends against the fp32 sentence-transformers model
+
+Accuracy is the cosine similarity between each backend's vector of a text and the torch model's,
+and recall@k of retrieval with the backend against retrieval with the torch model. Recall is
+reported for an index built with the backend and for queries embedded with the backend against
+an index built with the torch model. Throughput is texts per second when embedding chunks, for
+every combination of --threads and --batch-sizes, and the latency of single queries.
+
+Run from the project root:
+    python -m benchmarks.embedding_report
+    python -m benchmarks.embedding_report --index docs_index --threads 1,4 --batch-sizes 16,64
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import faiss
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+import chatpdf
+from embedding_backends import EMBEDDING_BACKENDS, load_embeddings
+from benchmarks.corpus import generate
+from benchmarks.pipeline import make_queries, percentiles
+
+def corpus_texts(documents, pages, queries):
+    """Chunks of a synthetic corpus, split as ingestion splits pages, and questions about it"""
+    folder = tempfile.mkdtemp(prefix="embedding_report_")
+    try:
+        corpus = generate(folder, documents, pages)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chatpdf.CHUNK_SIZE, chunk_overlap=chatpdf.CHUNK_OVERLAP)
+    chunks = [chunk for texts in corpus.values() for text in texts for chunk in splitter.split_text(text)]
+    return chunks, [f"What is the policy on {query}?" for query in make_queries(corpus, queries)]
+
+def index_texts(index_name, queries, seed=1):
+    """Chunks of a saved index, and questions made of a few words of random chunks"""
+    vectordb = chatpdf.load_vectordb(index_name, mode="memory")
+    chunks = [vectordb.docstore.search(doc_id).page_content for doc_id in vectordb.index_to_docstore_id.values()]
+    rng = np.random.default_rng(seed)
+    questions = []
+    for i in rng.integers(len(chunks), size=queries):
+        words = chunks[int(i)].split()
+        start = int(rng.integers(0, max(len(words) - 6, 1)))
+        questions.append(" ".join(words[start:start + 6]))
+    return chunks, questions
+
+def embed(embeddings, texts):
+    return np.array(embeddings.embed_documents(texts), dtype=np.float32)
+
+def search(docs, queries, k):
+    """Exact top-k rows of docs for each query, with the L2 metric the index uses"""
+    index = faiss.IndexFlatL2(docs.shape[1])
+    index.add(docs)
+    return index.search(queries, k)[1]
+
+def recall(found, truth):
+    return float(np.mean([len(set(a) & set(b)) / len(b) for a, b in zip(found, truth)]))
+
+def cosines(vectors, reference):
+    """Cosine similarity of each vector with its reference vector"""
+    norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(reference, axis=1)
+    return (vectors * reference).sum(axis=1) / np.maximum(norms, 1e-12)
+
+def accuracy(docs, queries, reference_docs, reference_queries, k):
+    """Cosine agreement with the reference vectors and recall@k against reference retrieval"""
+    truth = search(reference_docs, reference_queries, k)
+    agreement = cosines(np.vstack([docs, queries]), np.vstack([reference_docs, reference_queries]))
+    return {
+        "cosine_mean": float(agreement.mean()),
+        "cosine_p1": float(np.percentile(agreement, 1)),
+        "cosine_min": float(agreement.min()),
+        "recall_at_k": recall(search(docs, queries, k), truth),
+        "recall_at_k_reference_index": recall(search(reference_docs, queries, k), truth),
+    }
+
+def throughput(backend, args, chunks, queries):
+    """Texts per second embedding chunks and single-query latency, per thread count and batch size"""
+    rows = []
+    for threads in (int(n) for n in args.threads.split(",")):
+        for batch_size in (int(n) for n in args.batch_sizes.split(",")):
+            embeddings = load_embeddings(backend, args.model, chatpdf.EMBEDDING_NORMALIZE, args.cache_folder, threads, batch_size)
+            embeddings.embed_documents(chunks[:batch_size])
+            started = time.perf_counter()
+            embeddings.embed_documents(chunks)
+            elapsed = time.perf_counter() - started
+            latencies = []
+            for query in queries:
+                started = time.perf_counter()
+                embeddings.embed_query(query)
+                latencies.append(time.perf_counter() - started)
+            rows.append({"threads": threads, "batch_size": batch_size, "texts_per_s": len(chunks) / elapsed, "query": percentiles(latencies)})
+    return rows
+
+def format_table(results, k):
+    """Markdown summaries of accuracy, with the best throughput, and of every throughput run"""
+    lines = [
+        f"| backend | cosine mean | cosine p1 | recall@{k} | recall@{k} fp32 index | best texts/s | threads | batch | query p50 ms |",
+        "|---|---|---|---|---|---|---|---|---|",
+    ]
+    for backend, result in results.items():
+        best = max(result["throughput"], key=lambda row: row["texts_per_s"])
+        accuracy = result["accuracy"]
+        lines.append(
+            f"| {backend} | {accuracy['cosine_mean']:.4f} | {accuracy['cosine_p1']:.4f} | {accuracy['recall_at_k']:.3f} | "
+            f"{accuracy['recall_at_k_reference_index']:.3f} | {best['texts_per_s']:.0f} | {best['threads']} | "
+            f"{best['batch_size']} | {best['query']['p50_ms']:.1f} |"
+        )
+    lines += ["", "| backend | threads | batch | texts/s | query p50 ms | query p95 ms |", "|---|---|---|---|---|---|"]
+    for backend, result in results.items():
+        for row in result["throughput"]:
+            lines.append(
+                f"| {backend} | {row['threads']} | {row['batch_size']} | {row['texts_per_s']:.0f} | "
+                f"{row['query']['p50_ms']:.1f} | {row['query']['p95_ms']:.1f} |"
+            )
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model", default=chatpdf.EMBEDDING_MODEL)
+    parser.add_argument("--cache-folder", default=chatpdf.MODEL_CACHE_DIR)
+    parser.add_argument("--index", help="use the chunks of a saved index instead of a synthetic corpus")
+    parser.add_argument("--documents", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument("--backends", default=",".join(EMBEDDING_BACKENDS))
+    parser.add_argument("--threads", default="1,2,4", help="comma separated intra-op thread counts, 0 for the default")
+    parser.add_argument("--batch-sizes", default="8,32,64")
+    parser.add_argument("--throughput-texts", type=int, default=1000, help="chunks embedded per throughput run")
+    parser.add_argument("--throughput-queries", type=int, default=50, help="single queries timed per throughput run")
+    parser.add_argument("--output", default="benchmarks/results/embedding_report.json")
+    args = parser.parse_args()
+
+    chunks, queries = corpus_texts(args.documents, args.pages, args.queries) if args.index is None else index_texts(args.index, args.queries)
+    print(f"{len(chunks)} chunks, {len(queries)} queries")
+    reference = load_embeddings("torch", args.model, chatpdf.EMBEDDING_NORMALIZE, args.cache_folder)
+    reference_docs, reference_queries = embed(reference, chunks), embed(reference, queries)
+
+    results = {}
+    for backend in args.backends.split(","):
+        embeddings = load_embeddings(backend, args.model, chatpdf.EMBEDDING_NORMALIZE, args.cache_folder)
+        results[backend] = {
+            "accuracy": accuracy(embed(embeddings, chunks), embed(embeddings, queries), reference_docs, reference_queries, args.k),
+            "throughput": throughput(backend, args, chunks[:args.throughput_texts], queries[:args.throughput_queries]),
+        }
+        print(f"{backend}: cosine {results[backend]['accuracy']['cosine_mean']:.4f}, recall@{args.k} {results[backend]['accuracy']['recall_at_k']:.3f}")
+
+    print()
+    print(format_table(results, args.k))
+
+    settings = {key: value for key, value in vars(args).items() if key != "output"}
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"settings": settings, "chunks": len(chunks), "queries": len(queries), "results": results}, f, indent=2)
@@ -0,0 +1,96 @@
+"""Offline stand-ins for the Groq chat model and the sentence-transformers embeddings
+
+Both are deterministic, so benchmark runs are comparable across commits.
+"""
+import re
+import time
+import threading
+import hashlib
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from chat_memory import count_tokens
+
+_WORD_PATTERN = re.compile(r"[A-Za-z][\w-]+")
+
+class FakeChatModel(BaseChatModel):
+    """Chat model that answers from its prompt after a fixed latency, at a fixed token rate
+
+    The answer is answer_tokens words picked from the prompt by a generator seeded with a hash
+    of the prompt, so the same prompt always gets the same answer. Condense prompts get the
+    follow-up question back.
+    """
+
+    latency: float = 0.3
+    tokens_per_s: float = 50.0
+    answer_tokens: int = 80
+
+    @property
+    def _llm_type(self):
+        return "benchmark-fake"
+
+    def _answer(self, messages):
+        prompt = "\n".join(message.content for message in messages)
+        if "Standalone question" in prompt:
+            follow_up = prompt.split("Follow Up Input:")[-1].split("Standalone question")[0]
+            return follow_up.strip()
+        words = _WORD_PATTERN.findall(prompt) or ["answer"]
+        rng = np.random.default_rng(int.from_bytes(hashlib.sha256(prompt.encode("utf-8")).digest()[:8], "little"))
+        return " ".join(rng.choice(words, size=self.answer_tokens)) + "."
+
+    def _usage(self, messages, answer):
+        prompt_tokens = sum(count_tokens(message.content) for message in messages)
+        answer_tokens = count_tokens(answer)
+        return {"input_tokens": prompt_tokens, "output_tokens": answer_tokens, "total_tokens": prompt_tokens + answer_tokens}
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        answer = "".join(chunk.message.content for chunk in self._stream(messages, stop, run_manager, **kwargs))
+        message = AIMessage(content=answer, usage_metadata=self._usage(messages, answer))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        answer = self._answer(messages)
+        time.sleep(self.latency)
+        tokens = re.findall(r"\S+\s*", answer)
+        for i, token in enumerate(tokens):
+            if i:
+                time.sleep(1 / self.tokens_per_s)
+            # The last chunk reports usage, as streaming providers do
+            usage = self._usage(messages, answer) if i == len(tokens) - 1 else None
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token, usage_metadata=usage))
+            if run_manager is not None:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+class HashEmbeddings(Embeddings):
+    """Hashed bag-of-words embeddings: texts sharing words get similar vectors, no model needed
+
+    call_latency and text_latency add the cost of a model in seconds per call and per text.
+    Calls then run one at a time, as they would on one model.
+    """
+
+    def __init__(self, dimension=384, call_latency=0.0, text_latency=0.0):
+        self.dimension = dimension
+        self.call_latency = call_latency
+        self.text_latency = text_latency
+        self._lock = threading.Lock()
+
+    def _embed(self, text):
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for word in _WORD_PATTERN.findall(text.lower()):
+            digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+            value = int.from_bytes(digest, "little")
+            vector[value % self.dimension] += 1.0 if value >> 63 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        if self.call_latency or self.text_latency:
+            with self._lock:
+                time.sleep(self.call_latency + self.text_latency * len(texts))
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
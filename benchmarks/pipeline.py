@@ -0,0 +1,231 @@
+"""End-to-end benchmarks of ingestion, index loading, retrieval and full chat turns
+
+Runs offline: the PDFs are synthetic (benchmarks/corpus.py), the LLM is FakeChatModel and the
+embeddings are HashEmbeddings unless --real-embeddings is given (benchmarks/fake_llm.py).
+Results are written as JSON together with the commit they were measured on, so runs can be
+compared across commits.
+
+Run from the project root:
+    python -m benchmarks.pipeline
+    python -m benchmarks.pipeline --sizes 10x10,100x20,400x25 --output benchmarks/results/pipeline.json
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import datetime
+import subprocess
+import numpy as np
+import faiss
+import chatpdf
+from embedding_cache import EmbeddingCache
+from benchmarks.corpus import generate
+from benchmarks.fake_llm import FakeChatModel, HashEmbeddings
+
+FOLLOW_UPS = ["What about the deadline?", "And who has to approve it?", "Is there a limit for that?"]
+
+def percentiles(values):
+    """p50, p95 and p99 of a list of seconds, in ms"""
+    values = np.array(values) * 1000
+    return {f"p{p}_ms": float(np.percentile(values, p)) for p in (50, 95, 99)}
+
+def git_commit():
+    """Commit the benchmark runs on, and whether the tree has uncommitted changes"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+def use_workdir(workdir, real_embeddings):
+    """Point chatpdf at a scratch data and index folder, with a fresh embedding cache"""
+    chatpdf.DATA_DIR = os.path.join(workdir, "data/")
+    chatpdf.EMBEDDINGS_DIR = os.path.join(workdir, "embeddings/")
+    key = (chatpdf.EMBEDDING_MODEL, chatpdf.EMBEDDING_NORMALIZE, chatpdf.EMBEDDING_BACKEND)
+    if not real_embeddings:
+        chatpdf._embedding_models[key] = HashEmbeddings()
+    chatpdf._embedding_caches[key] = EmbeddingCache(
+        chatpdf.EMBEDDING_MODEL, chatpdf.EMBEDDING_NORMALIZE, os.path.join(workdir, "embedding_cache"), backend=chatpdf.EMBEDDING_BACKEND
+    )
+    chatpdf._shared_vectordbs.clear()
+
+def ingest(rebuild=False):
+    """Ingestion throughput of one full build"""
+    started = time.perf_counter()
+    report = chatpdf.process_and_save_pdfs(rebuild=rebuild)
+    stats = report["stats"]
+    return {
+        "wall_s": time.perf_counter() - started,
+        "ingest_s": stats["elapsed"],
+        "pages": stats["pages"],
+        "chunks": stats["chunks"],
+        "cached_vectors": stats["cached_vectors"],
+        "pages_per_s": stats["pages_per_s"],
+        "chunks_per_s": stats["chunks_per_s"],
+        "embeddings_per_s": stats["vectors_per_s"],
+    }
+
+def load_times(repeat=3):
+    """Best of repeat load times of the index, into memory and memory-mapped"""
+    times = {}
+    for mode in chatpdf.INDEX_LOAD_MODES:
+        runs = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            chatpdf.load_vectordb(mode=mode)
+            runs.append(time.perf_counter() - started)
+        times[f"{mode}_s"] = min(runs)
+    return times
+
+def make_queries(corpus, count, seed=1):
+    """Questions made of a few consecutive words of random sentences of the corpus"""
+    rng = np.random.default_rng(seed)
+    pages = [text for texts in corpus.values() for text in texts]
+    queries = []
+    for _ in range(count):
+        sentences = [s for s in pages[int(rng.integers(len(pages)))].split(". ") if len(s.split()) > 8]
+        words = sentences[int(rng.integers(len(sentences)))].split()
+        start = int(rng.integers(0, len(words) - 6))
+        queries.append(" ".join(words[start:start + 6]))
+    return queries
+
+def retrieval(queries, k):
+    """Latency of vector and hybrid search on the served index, and recall@k against exact search"""
+    served = chatpdf.load_vectordb()
+    built = chatpdf.load_vectordb(mode="memory")
+    vectors = [served.embeddings.embed_query(query) for query in queries]
+
+    labels = np.array(sorted(built.index_to_docstore_id), dtype=np.int64)
+    exact = faiss.IndexFlat(built.index.d, built.index.metric_type)
+    exact.add(built.index.reconstruct_batch(labels))
+    _, truth = exact.search(np.array(vectors, dtype=np.float32), k)
+
+    vector_latencies, hybrid_latencies, found = [], [], 0
+    for query, vector, true_rows in zip(queries, vectors, truth):
+        started = time.perf_counter()
+        ids = served._search_labels(vector, k)
+        vector_latencies.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        served.hybrid_search_by_vector(query, vector, k=k)
+        hybrid_latencies.append(time.perf_counter() - started)
+        found += len(set(ids) & {built.index_to_docstore_id[int(labels[row])] for row in true_rows if row != -1})
+    return {
+        "index_type": chatpdf._index_kind(built.index),
+        "vectors": len(labels),
+        "recall_at_k": found / (len(queries) * k),
+        "vector": percentiles(vector_latencies),
+        "hybrid": percentiles(hybrid_latencies),
+    }
+
+def chat_turns(queries, turns, latency, tokens_per_s):
+    """Full-turn latency through get_qa_chain with the fake chat model, every other turn a follow-up"""
+    llm = FakeChatModel(latency=latency, tokens_per_s=tokens_per_s)
+    qa_chain = chatpdf.get_qa_chain(chatpdf.get_shared_vectordb(), use_cache=False, llm=llm)
+    timings = []
+    for turn in range(turns):
+        question = FOLLOW_UPS[turn // 2 % len(FOLLOW_UPS)] if turn % 2 else f"What is the policy on {queries[turn]}?"
+        timings.append(qa_chain.invoke({"question": question})["timings"])
+    stages = ("condense", "embed", "retrieve", "time_to_first_token", "total")
+    return {stage: percentiles([t.get(stage, 0.0) for t in timings]) for stage in stages}
+
+def context_packing(queries):
+    """Context tokens and evidence recall of each context mode on the same questions
+
+    A question's evidence is the corpus phrase it was made from; it counts as found when the
+    phrase appears in the context the LLM would see.
+    """
+    llm = FakeChatModel(latency=0.0, tokens_per_s=1e6, answer_tokens=1)
+    vectordb = chatpdf.get_shared_vectordb()
+    results = {}
+    for mode in chatpdf.CONTEXT_MODES:
+        tokens, pack_latencies, found = [], [], 0
+        for query in queries:
+            qa_chain = chatpdf.get_qa_chain(vectordb, use_cache=False, llm=llm, context_mode=mode)
+            result = qa_chain.invoke({"question": f"What is the policy on {query}?"})
+            tokens.append(result["usage"]["context_tokens"])
+            pack_latencies.append(result["timings"].get("pack", 0.0))
+            context = " ".join(" ".join(doc.page_content.split()) for doc in result["source_documents"])
+            found += query in context
+        results[mode] = {
+            "context_tokens_mean": float(np.mean(tokens)),
+            "context_tokens_p95": float(np.percentile(tokens, 95)),
+            "evidence_recall": found / len(queries),
+            "pack": percentiles(pack_latencies),
+        }
+    return results
+
+def run_size(workdir, documents, pages, args):
+    """Every scenario on one corpus size"""
+    use_workdir(workdir, args.real_embeddings)
+    corpus = generate(chatpdf.DATA_DIR, documents, pages)
+    queries = make_queries(corpus, max(args.queries, args.turns))
+    result = {"documents": documents, "pages": documents * pages}
+    result["ingest"] = ingest()
+    result["rebuild_cached"] = ingest(rebuild=True)
+    result["load"] = load_times()
+    result["retrieval"] = retrieval(queries[:args.queries], args.k)
+    result["turn"] = chat_turns(queries, args.turns, args.llm_latency, args.llm_tokens_per_s)
+    result["context"] = context_packing(queries[:args.queries])
+    return result
+
+def format_table(results):
+    """Markdown summary of the results"""
+    lines = [
+        "| pages | chunks | index | pages/s | emb/s | cached emb/s | load mmap ms | vector p95 ms | hybrid p95 ms | recall | turn p50 s | ttft p50 s | context tokens stuff/packed | evidence stuff/packed |",
+        "|---|---|---|---|---|---|---|---|---|---|---|---|---|---|",
+    ]
+    for r in results:
+        lines.append(
+            f"| {r['pages']} | {r['ingest']['chunks']} | {r['retrieval']['index_type']} | "
+            f"{r['ingest']['pages_per_s']:.0f} | {r['ingest']['embeddings_per_s']:.0f} | "
+            f"{r['rebuild_cached']['embeddings_per_s']:.0f} | {r['load']['mmap_s'] * 1000:.1f} | "
+            f"{r['retrieval']['vector']['p95_ms']:.2f} | {r['retrieval']['hybrid']['p95_ms']:.2f} | "
+            f"{r['retrieval']['recall_at_k']:.3f} | {r['turn']['total']['p50_ms'] / 1000:.2f} | "
+            f"{r['turn']['time_to_first_token']['p50_ms'] / 1000:.2f} | "
+            f"{r['context']['stuff']['context_tokens_mean']:.0f}/{r['context']['packed']['context_tokens_mean']:.0f} | "
+            f"{r['context']['stuff']['evidence_recall']:.2f}/{r['context']['packed']['evidence_recall']:.2f} |"
+        )
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10x10,50x20", help="comma separated corpus sizes, documents x pages")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="seconds before the first token")
+    parser.add_argument("--llm-tokens-per-s", type=float, default=50.0)
+    parser.add_argument("--real-embeddings", action="store_true", help="use the sentence-transformers model")
+    parser.add_argument("--embedding-backend", default=chatpdf.EMBEDDING_BACKEND, help="overrides EMBEDDING_BACKEND, with --real-embeddings")
+    parser.add_argument("--index-type", default=chatpdf.INDEX_TYPE, help="overrides INDEX_TYPE")
+    parser.add_argument("--output", default="benchmarks/results/pipeline.json")
+    args = parser.parse_args()
+    chatpdf.INDEX_TYPE = args.index_type
+    chatpdf.EMBEDDING_BACKEND = args.embedding_backend
+
+    results = []
+    for size in args.sizes.split(","):
+        documents, pages = (int(n) for n in size.lower().split("x"))
+        workdir = tempfile.mkdtemp(prefix="pipeline_bench_")
+        try:
+            results.append(run_size(workdir, documents, pages, args))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print()
+    print(format_table(results))
+
+    commit, dirty = git_commit()
+    settings = {key: value for key, value in vars(args).items() if key != "output"}
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({
+            "commit": commit,
+            "dirty": dirty,
+            "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "settings": settings,
+            "results": results,
+        }, f, indent=2)
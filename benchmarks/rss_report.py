@@ -0,0 +1,164 @@
+"""Per-process memory and load time of serving an index from memory vs memory-mapped
+
+Starts several processes that each load the same index and answer a few queries, the way
+user app workers do, and reports their private (RssAnon), page-cache (RssFile) and
+proportional (Pss) memory. Modes are "pickle", loading into memory from the pickled docstore
+written before the chunk store, "memory", loading the vectors and reading chunks from the
+chunk store, and "mmap". Linux only, the numbers come from /proc.
+
+Run from the project root:
+    python -m benchmarks.rss_report --synthetic 100000
+    python -m benchmarks.rss_report --index docs_index
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
+import chatpdf
+from lexical_index import BM25Index
+from benchmarks.ann_report import synthetic_vectors, make_queries
+
+WORDS = "policy plan form claim benefit employee leave salary deadline approval section code report".split()
+
+def memory_usage():
+    """RssAnon, RssFile and Pss of this process in MB"""
+    usage = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(("RssAnon:", "RssFile:")):
+                usage[line.split(":")[0]] = int(line.split()[1]) / 1024
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            if line.startswith("Pss:"):
+                usage["Pss"] = int(line.split()[1]) / 1024
+    return usage
+
+def synthetic_index(count, seed=0):
+    """Index of synthetic vectors with chunk-sized texts, typed for its size as ingestion would"""
+    rng = np.random.default_rng(seed)
+    vectors = synthetic_vectors(count, seed=seed)
+    texts = (" ".join(rng.choice(WORDS, size=chatpdf.CHUNK_SIZE // 7)) for _ in range(count))
+    metadatas = [{"source": f"data/doc{i // 50}.pdf", "page": i % 50} for i in range(count)]
+    vectordb = chatpdf.DocumentIndex.from_embeddings(zip(texts, vectors), chatpdf.get_embeddings(), metadatas=metadatas)
+    chatpdf._tune_index(vectordb, {})
+    return vectordb
+
+def serve(folder, mode, queries, barrier, results):
+    """Load the index in one worker, query it, then report once every worker has loaded"""
+    before = memory_usage()
+    started = time.perf_counter()
+    vectordb = chatpdf.DocumentIndex.load_local(
+        folder, chatpdf.get_embeddings(), mmap=mode == "mmap", allow_dangerous_deserialization=True
+    )
+    load_s = time.perf_counter() - started
+    started = time.perf_counter()
+    for query in queries:
+        vectordb.hybrid_search_by_vector("policy claim form", query, k=4)
+    query_ms = (time.perf_counter() - started) * 1000 / len(queries)
+    # Shared pages are only split between processes that are alive at the same time
+    barrier.wait()
+    results.put({"load_s": load_s, "query_ms": query_ms, "before": before, "after": memory_usage()})
+
+def measure(folder, mode, queries, processes):
+    """Run processes workers on one saved index, averaging their numbers"""
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(processes)
+    results = context.Queue()
+    workers = [context.Process(target=serve, args=(folder, mode, queries, barrier, results)) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    reports = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+
+    row = {
+        "load_s": float(np.mean([r["load_s"] for r in reports])),
+        "query_ms": float(np.mean([r["query_ms"] for r in reports])),
+    }
+    for key in ("RssAnon", "RssFile", "Pss"):
+        row[f"{key}_before_mb"] = float(np.mean([r["before"][key] for r in reports]))
+        row[f"{key}_after_mb"] = float(np.mean([r["after"][key] for r in reports]))
+    return row
+
+def save_pickled(vectordb, folder):
+    """Save the index with a pickled docstore, as FAISS.save_local did before the chunk store"""
+    ids = list(vectordb.index_to_docstore_id.values())
+    docstore = InMemoryDocstore(dict(zip(ids, vectordb._documents(ids))))
+    FAISS.save_local(FAISS(vectordb.embeddings, vectordb.index, docstore, dict(vectordb.index_to_docstore_id)), folder)
+    vectordb.lexical.save(os.path.join(folder, "index.bm25"))
+
+def loaded_bytes(folder, mode):
+    """Size of the files a load mode reads"""
+    names = {
+        "mmap": ("index.mapped.faiss", "index.chunks.bin"),
+        "memory": ("index.faiss", "index.labels.json", "index.chunks.sqlite"),
+        "pickle": ("index.faiss", "index.pkl"),
+    }[mode]
+    paths = [os.path.join(folder, name) for name in names] + BM25Index.files(os.path.join(folder, "index.bm25"))
+    return sum(os.path.getsize(path) for path in paths)
+
+def format_table(rows, processes):
+    """Markdown table of the results"""
+    lines = [
+        f"| mode | storage | load s | query ms | RssAnon MB | RssFile MB | Pss MB (of {processes}) | on disk MB |",
+        "|---|---|---|---|---|---|---|---|",
+    ]
+    for row in rows:
+        lines.append(
+            f"| {row['mode']} | {row['storage']} | {row['load_s']:.3f} | {row['query_ms']:.2f} | "
+            f"{row['RssAnon_before_mb']:.0f} -> {row['RssAnon_after_mb']:.0f} | "
+            f"{row['RssFile_before_mb']:.0f} -> {row['RssFile_after_mb']:.0f} | "
+            f"{row['Pss_after_mb']:.0f} | {row['bytes'] / 1e6:.0f} |"
+        )
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--index", help="measure a saved index")
+    source.add_argument("--synthetic", type=int, default=50000, help="number of synthetic chunks")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--storage", default=",".join(chatpdf.INDEX_STORAGE_TYPES))
+    parser.add_argument("--output", default="benchmarks/results/rss_report.json")
+    args = parser.parse_args()
+
+    if args.index:
+        vectordb = chatpdf.load_vectordb(args.index, mode="memory")
+    else:
+        vectordb = synthetic_index(args.synthetic)
+    labels = np.array(sorted(vectordb.index_to_docstore_id), dtype=np.int64)
+    queries = make_queries(vectordb.index.reconstruct_batch(labels[:10000]), args.queries)
+
+    workdir = tempfile.mkdtemp(prefix="rss_report_")
+    rows = []
+    try:
+        folder = os.path.join(workdir, "pickle")
+        save_pickled(vectordb, folder)
+        row = {"mode": "pickle", "storage": "float32", "bytes": loaded_bytes(folder, "pickle")}
+        row.update(measure(folder, "pickle", queries, args.processes))
+        rows.append(row)
+        for position, storage in enumerate(args.storage.split(",")):
+            folder = os.path.join(workdir, storage)
+            vectordb.save_local(folder, storage=storage)
+            # Loading into memory reads the same full-precision files whatever the storage
+            runs = [("memory", "float32"), ("mmap", storage)] if position == 0 else [("mmap", storage)]
+            for mode, stored_as in runs:
+                row = {"mode": mode, "storage": stored_as, "bytes": loaded_bytes(folder, mode)}
+                row.update(measure(folder, mode, queries, args.processes))
+                rows.append(row)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{len(labels)} chunks ({chatpdf._index_kind(vectordb.index)}), {args.processes} processes\n")
+    print(format_table(rows, args.processes))
+
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"chunks": len(labels), "processes": args.processes, "results": rows}, f, indent=2)
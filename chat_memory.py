@@ -0,0 +1,167 @@
+import os
+import re
+import threading
+from langchain.prompts import PromptTemplate
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET", 1500))
+MEMORY_RECENT_TURNS = int(os.getenv("MEMORY_RECENT_TURNS", 4))
+
+# Words split into pieces of up to four characters, close to what BPE tokenizers do for English
+_TOKEN_PATTERN = re.compile(r"\w{1,4}|[^\w\s]")
+
+SUMMARY_PROMPT = PromptTemplate(
+    template="""Progressively summarize the conversation below, adding onto the previous summary and returning a new summary.
+Keep names, numbers, dates, plan names, form numbers and codes exactly as written. Use at most {max_words} words.
+
+Previous summary:
+{summary}
+
+New lines of conversation:
+{new_lines}
+
+New summary:""",
+    input_variables=["summary", "new_lines", "max_words"]
+)
+
+def count_tokens(text):
+    """Approximate token count of a text, without loading a tokenizer"""
+    return len(_TOKEN_PATTERN.findall(text))
+
+def _truncate_tokens(text, max_tokens, keep_end=False):
+    """Cut text down to about max_tokens tokens"""
+    pieces = list(_TOKEN_PATTERN.finditer(text))
+    if len(pieces) <= max_tokens:
+        return text
+    # One token of the budget goes to the ellipsis marking the cut
+    if max_tokens <= 1:
+        return ""
+    if keep_end:
+        return "…" + text[pieces[1 - max_tokens].start():]
+    return text[:pieces[max_tokens - 2].end()] + "…"
+
+class TokenBudgetMemory:
+    """Conversation memory that never exceeds a token budget
+
+    The last recent_turns turns are kept verbatim; older turns are folded into a running summary
+    by the LLM, in a background thread so answering the next question is not delayed. While a
+    fold runs, the history is the previous summary and every turn verbatim, which may exceed
+    the budget for that one turn; it holds again once the fold is done. Used in place of
+    ConversationBufferMemory: chat_history is a list of messages, starting with a system
+    message holding the summary once there is one.
+    """
+
+    def __init__(self, llm, token_budget=MEMORY_TOKEN_BUDGET, recent_turns=MEMORY_RECENT_TURNS, memory_key="chat_history"):
+        self.llm = llm
+        self.token_budget = token_budget
+        self.recent_turns = max(recent_turns, 1)
+        self.memory_key = memory_key
+        self.summary = ""
+        self.turns = []
+        self.summarized_turns = 0
+        self._lock = threading.Lock()
+        self._folding = None
+        # Bumped by clear(), so a fold started before it drops its summary
+        self._epoch = 0
+
+    @property
+    def memory_variables(self):
+        return [self.memory_key]
+
+    def _history_tokens(self):
+        return count_tokens(self.summary) + sum(count_tokens(q) + count_tokens(a) for q, a in self.turns)
+
+    def load_memory_variables(self, inputs):
+        """Summary and recent turns as chat messages, without waiting for a running fold"""
+        with self._lock:
+            messages = [SystemMessage(content=f"Summary of the earlier conversation: {self.summary}")] if self.summary else []
+            for question, answer in self.turns:
+                messages.extend([HumanMessage(content=question), AIMessage(content=answer)])
+        return {self.memory_key: messages}
+
+    def save_context(self, inputs, outputs):
+        """Record a turn, folding older turns into the summary if the budget requires it"""
+        question = inputs.get("question") or next(iter(inputs.values()))
+        answer = outputs.get("answer") or next(iter(outputs.values()))
+        with self._lock:
+            self.turns.append((question, answer))
+            if len(self.turns) <= self.recent_turns and self._history_tokens() <= self.token_budget:
+                return
+            # A running fold checks the new turn once it is done
+            if self._folding is None:
+                self._folding = threading.Thread(target=self._fold, args=(self._epoch,), daemon=True)
+                self._folding.start()
+
+    def _fold(self, epoch):
+        """Fold the oldest turns into the summary until the history fits the budget
+
+        The LLM is called without holding the lock, so turns can be read and added meanwhile.
+        """
+        summary_floor = self.token_budget // 4
+        while True:
+            with self._lock:
+                if epoch != self._epoch:
+                    return
+                # Fold the oldest turns until the verbatim part fits next to a minimal summary
+                tokens = [count_tokens(q) + count_tokens(a) for q, a in self.turns]
+                count = 0
+                while len(tokens) - count > 1 and (
+                    len(tokens) - count > self.recent_turns or sum(tokens[count:]) > self.token_budget - summary_floor
+                ):
+                    count += 1
+                if not count:
+                    self._enforce_budget(summary_floor)
+                    self._folding = None
+                    return
+                folded, summary = self.turns[:count], self.summary
+                summary_budget = max(self.token_budget - sum(tokens[count:]), summary_floor)
+
+            new_lines = "\n".join(f"Human: {q}\nAI: {a}" for q, a in folded)
+            try:
+                prompt = SUMMARY_PROMPT.format(
+                    summary=summary or "(none)", new_lines=new_lines, max_words=int(summary_budget * 0.7)
+                )
+                summary = self.llm.invoke(prompt).content.strip()
+            except Exception as e:
+                print(f"Warning: Could not summarize conversation, keeping it truncated: {str(e)}")
+                summary = f"{summary}\n{new_lines}".strip()
+
+            with self._lock:
+                if epoch != self._epoch:
+                    return
+                # Turns added during the call follow the folded ones
+                del self.turns[:len(folded)]
+                self.summary = summary
+                self.summarized_turns += len(folded)
+
+    def _enforce_budget(self, summary_floor):
+        """Cut the summary, and a single turn too big on its own, down to the budget"""
+        verbatim_tokens = sum(count_tokens(q) + count_tokens(a) for q, a in self.turns)
+        # Enforce the budget even if the summary came back too long or one turn alone is too big
+        if verbatim_tokens > self.token_budget - summary_floor:
+            question, answer = self.turns[-1]
+            question = _truncate_tokens(question, (self.token_budget - summary_floor) // 4)
+            answer = _truncate_tokens(answer, self.token_budget - summary_floor - count_tokens(question))
+            self.turns[-1] = (question, answer)
+            verbatim_tokens = count_tokens(question) + count_tokens(answer)
+        self.summary = _truncate_tokens(self.summary, self.token_budget - verbatim_tokens, keep_end=True)
+
+    def clear(self):
+        with self._lock:
+            self.summary = ""
+            self.turns = []
+            self.summarized_turns = 0
+            self._epoch += 1
+            self._folding = None
+
+    def stats(self):
+        """Token usage of the history kept for the prompt, folding tells whether a fold is running"""
+        with self._lock:
+            return {
+                "verbatim_turns": len(self.turns),
+                "summarized_turns": self.summarized_turns,
+                "summary_tokens": count_tokens(self.summary),
+                "history_tokens": self._history_tokens(),
+                "token_budget": self.token_budget,
+                "folding": self._folding is not None,
+            }
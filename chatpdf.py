@@ -1,14 +1,41 @@
 import os
+import re
+import glob
 from dotenv import load_dotenv
 from langchain_groq import ChatGroq
 from langchain.chains import ConversationalRetrievalChain
+from langchain.chains.conversational_retrieval.base import _get_chat_history
 from langchain_community.vectorstores import FAISS
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import PyMuPDFLoader
-from langchain.memory import ConversationBufferMemory
 from langchain.prompts import PromptTemplate
-import pickle
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+from langchain_core.documents import Document
+from langchain_core.prompts import format_document
+import hashlib
+import json
+import uuid
+import shutil
+import threading
+import itertools
+import time
+from collections import deque
+from contextlib import contextmanager
+import multiprocessing
+import numpy as np
+import faiss
+import fitz
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from answer_cache import AnswerCache, normalize_question
+from chat_memory import TokenBudgetMemory, count_tokens
+from lexical_index import BM25Index
+import metrics
+from embedding_cache import EmbeddingCache, EMBEDDING_CACHE_MAX_MB, EMBEDDING_CACHE_FLUSH_ROWS
+from embedding_backends import load_embeddings, EMBEDDING_BACKEND
+from chunk_store import ChunkStore
+from mapped_store import MappedChunks, MappedDocstore, MappedLabels, write_chunk_file
+from ingest_checkpoint import PageCheckpoint, checkpoint_folder, prune_checkpoints
+from context_packing import ContextCache, pack_context, CONTEXT_FETCH_K, CONTEXT_TOKEN_BUDGET
 
 # Load env
 load_dotenv()
@@ -16,87 +43,2265 @@ groq_api_key = os.getenv("GROQ_API_KEY")
 
 EMBEDDINGS_DIR = "embeddings/"
 DATA_DIR = "data/"
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDING_NORMALIZE = False
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR", "models/")
+INDEX_FORMAT_VERSION = 2
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", os.cpu_count() or 1))
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 64))
+INDEX_TYPE = os.getenv("INDEX_TYPE", "auto")
+FLAT_MAX_VECTORS = 20000
+IVF_FLAT_MAX_VECTORS = 500000
+IVF_RETRAIN_GROWTH = 4
+ANN_BUILD_BATCH_SIZE = 65536
+MIN_TRAINING_VECTORS = {"ivf_flat": 1000, "ivf_pq": 10000}
+# Precision of the vectors in the memory-mapped serving copy, and how load_vectordb reads an index
+INDEX_STORAGE_TYPES = ("float32", "float16", "int8")
+INDEX_STORAGE = os.getenv("INDEX_STORAGE", "float32")
+INDEX_LOAD_MODES = ("memory", "mmap")
+INDEX_LOAD_MODE = os.getenv("INDEX_LOAD_MODE", "mmap")
+# Every save publishes a new generation; this many previous ones are kept for rollback
+INDEX_KEEP_GENERATIONS = int(os.getenv("INDEX_KEEP_GENERATIONS", 3))
+# Deleted vectors stay in the index, hidden from searches, until they are this fraction of it
+INDEX_COMPACT_FRACTION = float(os.getenv("INDEX_COMPACT_FRACTION", 0.1))
+# Large PDFs are extracted and checkpointed in ranges of this many pages
+PAGE_RANGE_SIZE = int(os.getenv("PAGE_RANGE_SIZE", 32))
+# Every collection is an index of its own with its PDFs in DATA_DIR/<name>; the default
+# collection keeps its PDFs directly in DATA_DIR
+DEFAULT_COLLECTION = "docs_index"
+COLLECTION_NAME_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_-]{0,63}$")
+# Threads that search the collections of a federated query in parallel
+FEDERATED_SEARCH_WORKERS = int(os.getenv("FEDERATED_SEARCH_WORKERS", os.cpu_count() or 1))
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 100
+# Retrieval: "hybrid" fuses BM25 and vector results with reciprocal rank fusion, "vector" is vector only
+RETRIEVAL_MODES = ("vector", "hybrid")
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+HYBRID_FETCH_K = 20
+# "stuff" puts the top k chunks in the prompt as they are, "packed" merges, diversifies and budgets them
+CONTEXT_MODES = ("stuff", "packed")
+CONTEXT_MODE = os.getenv("CONTEXT_MODE", "packed")
+RRF_K = 60
+# Query rewriting of follow-up questions, see CachedQAChain
+QUERY_REWRITE_MODES = ("llm", "never", "heuristic")
+QUERY_REWRITE_MODE = os.getenv("QUERY_REWRITE_MODE", "heuristic")
+REWRITE_CONTEXT_TURNS = 2
+REFERRING_WORDS = {
+    "it", "its", "it's", "they", "them", "their", "theirs", "this", "these", "those",
+    "he", "she", "him", "her", "his", "hers", "former", "latter", "same", "above", "previous",
+}
+THAT_REFERENCE_PRECEDERS = {"about", "of", "for", "in", "on", "with", "does", "is", "was", "do", "did", "mean", "like"}
+FOLLOW_UP_OPENERS = {"and", "or", "but", "also", "so", "what about", "how about", "then", "why not"}
+# Stock phrases stripped from answers before they are shown
+RESPONSE_FILLER_PHRASES = (
+    "According to the Clinic Policies Manual, ",
+    "The manual states that ",
+    "Based on the document, ",
+    "According to the document, ",
+)
 
-def process_and_save_pdfs(pdf_paths=None, index_name="docs_index"):
-    """Process all PDFs in data folder and save FAISS embeddings"""
-    docs = []
-    
-    # If no specific paths provided, process all PDFs in data folder
-    if pdf_paths is None:
-        if not os.path.exists(DATA_DIR):
-            raise ValueError("Data directory does not exist")
-        
-        pdf_paths = [os.path.join(DATA_DIR, f) for f in os.listdir(DATA_DIR) if f.endswith('.pdf')]
+# Process-wide state shared by every session of the apps
+_shared_vectordbs = {}
+_shared_lock = threading.Lock()
+_llm = None
+_answer_caches = {}
+_answer_timings = deque(maxlen=1000)
+_context_cache = ContextCache()
+_search_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="search")
+_federation_pool = ThreadPoolExecutor(max_workers=FEDERATED_SEARCH_WORKERS, thread_name_prefix="federated")
+_federated_vectordbs = {}
+_embedding_models = {}
+_embedding_caches = {}
+_model_lock = threading.Lock()
+_lock_state = threading.local()
+
+class LazyEmbeddings(Embeddings):
+    """Sentence-transformers embeddings loaded once per process, on first use, on one of EMBEDDING_BACKENDS"""
+
+    def __init__(self, model_name=EMBEDDING_MODEL, normalize=EMBEDDING_NORMALIZE, backend=EMBEDDING_BACKEND):
+        self.model_name = model_name
+        self.normalize = normalize
+        self.backend = backend
+
+    def _model(self):
+        key = (self.model_name, self.normalize, self.backend)
+        model = _embedding_models.get(key)
+        if model is None:
+            with _model_lock:
+                model = _embedding_models.get(key)
+                if model is None:
+                    model = load_embeddings(self.backend, self.model_name, self.normalize, MODEL_CACHE_DIR)
+                    _embedding_models[key] = model
+        return model
+
+    def embed_documents(self, texts):
+        return self._model().embed_documents(texts)
+
+    def embed_query(self, text):
+        return self._model().embed_query(text)
+
+def get_embeddings():
+    """Embeddings for the configured model, the model itself is loaded on first use"""
+    return LazyEmbeddings(EMBEDDING_MODEL, EMBEDDING_NORMALIZE, EMBEDDING_BACKEND)
+
+def get_embedding_cache():
+    """Process-wide cache of chunk embeddings for the configured model, None if disabled"""
+    if EMBEDDING_CACHE_MAX_MB <= 0:
+        return None
+    key = (EMBEDDING_MODEL, EMBEDDING_NORMALIZE, EMBEDDING_BACKEND)
+    with _model_lock:
+        cache = _embedding_caches.get(key)
+        if cache is None:
+            cache = _embedding_caches[key] = EmbeddingCache(EMBEDDING_MODEL, EMBEDDING_NORMALIZE, backend=EMBEDDING_BACKEND)
+        return cache
+
+def _index_paths(index_name, generation=None):
+    """Paths of the files that make up a saved index
+
+    The index and manifest live in a generation folder; generation defaults to the
+    current one. Without a published generation they are the unversioned files
+    written by older versions.
+    """
+    generations = os.path.join(EMBEDDINGS_DIR, f"{index_name}.generations")
+    if generation is None:
+        generation = current_generation(index_name)
+    folder = EMBEDDINGS_DIR if generation is None else os.path.join(generations, generation)
+    return {
+        "generation": generation,
+        "faiss": os.path.join(folder, f"{index_name}.faiss"),
+        "manifest": os.path.join(folder, f"{index_name}.manifest.json"),
+        "current": os.path.join(EMBEDDINGS_DIR, f"{index_name}.current"),
+        "generations": generations,
+        # Page ranges of unfinished ingests, see PageCheckpoint
+        "checkpoints": os.path.join(EMBEDDINGS_DIR, f"{index_name}.checkpoints"),
+        # Working copies of the chunk store, cleared by the next writer if one was interrupted
+        "work": os.path.join(EMBEDDINGS_DIR, f"{index_name}.work"),
+        # Unversioned index, removed once a generation is published
+        "legacy_faiss": os.path.join(EMBEDDINGS_DIR, f"{index_name}.faiss"),
+        "legacy_manifest": os.path.join(EMBEDDINGS_DIR, f"{index_name}.manifest.json"),
+        # Pickled embedding model written by older versions, removed on the next save
+        "legacy_pkl": os.path.join(EMBEDDINGS_DIR, f"{index_name}.pkl"),
+        "answer_cache": os.path.join(EMBEDDINGS_DIR, f"{index_name}.answers.json"),
+    }
+
+def current_generation(index_name="docs_index"):
+    """Name of the published generation of an index, or None if none was published"""
+    try:
+        with open(os.path.join(EMBEDDINGS_DIR, f"{index_name}.current"), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def list_generations(index_name="docs_index"):
+    """Generations of an index on disk, oldest first"""
+    folder = os.path.join(EMBEDDINGS_DIR, f"{index_name}.generations")
+    if not os.path.isdir(folder):
+        return []
+    return sorted(name for name in os.listdir(folder) if name.isdigit())
+
+def _publish_generation(paths):
+    """Point readers at a fully written generation in one atomic rename"""
+    tmp_path = f"{paths['current']}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(paths["generation"])
+        # The pointer must not reach the disk before the files it points at
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, paths["current"])
+
+def _collect_generations(index_name, keep=None):
+    """Delete all but the current generation and the keep most recent others
+
+    The newest generation is always kept, so generation numbers are never reused.
+    """
+    keep = INDEX_KEEP_GENERATIONS if keep is None else keep
+    paths = _index_paths(index_name)
+    others = [generation for generation in list_generations(index_name) if generation != paths["generation"]]
+    for generation in others[:max(len(others) - max(keep, 1), 0)]:
+        # Readers still serving a deleted generation keep their open and mapped files
+        shutil.rmtree(os.path.join(paths["generations"], generation), ignore_errors=True)
+    if os.path.isdir(paths["legacy_faiss"]):
+        shutil.rmtree(paths["legacy_faiss"], ignore_errors=True)
+    for key in ("legacy_manifest", "legacy_pkl"):
+        if os.path.exists(paths[key]):
+            os.remove(paths[key])
+
+def _manifest_key(pdf_path):
+    """Stable manifest key for a PDF path, independent of the OS separator"""
+    return os.path.normpath(pdf_path).replace("\\", "/")
+
+def _file_sha256(pdf_path, block_size=1024 * 1024):
+    """Content hash of a file, read in blocks"""
+    digest = hashlib.sha256()
+    with open(pdf_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _load_manifest(manifest_path):
+    """Load the ingestion manifest, or None if there is none"""
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def _save_manifest(manifest, manifest_path):
+    """Write the ingestion manifest atomically"""
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+def _load_deleted(folder_path, index_name="index"):
+    """Label to docstore id of the vectors deleted from a saved index but still in its files"""
+    path = os.path.join(folder_path, f"{index_name}.deleted.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        deleted = json.load(f)
+    return dict(zip(deleted["labels"], deleted["ids"]))
+
+def _save_deleted(deleted, folder_path, index_name="index"):
+    """Write the deleted vectors of an index, see _load_deleted"""
+    path = os.path.join(folder_path, f"{index_name}.deleted.json")
+    labels = sorted(deleted)
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump({"labels": labels, "ids": [deleted[label] for label in labels]}, f)
+    os.replace(f"{path}.tmp", path)
+
+def collection_data_dir(index_name=DEFAULT_COLLECTION):
+    """Folder of the PDFs of a collection"""
+    if index_name == DEFAULT_COLLECTION:
+        return DATA_DIR
+    if not COLLECTION_NAME_PATTERN.match(index_name):
+        raise ValueError(f"Invalid collection name {index_name!r}, use letters, digits, '-' and '_'")
+    return os.path.join(DATA_DIR, index_name)
+
+def list_collections():
+    """Names of the collections with PDFs or an index, the default collection first"""
+    names = set()
+    if os.path.isdir(DATA_DIR):
+        names.update(
+            name for name in os.listdir(DATA_DIR)
+            if os.path.isdir(os.path.join(DATA_DIR, name)) and COLLECTION_NAME_PATTERN.match(name)
+        )
+    if os.path.isdir(EMBEDDINGS_DIR):
+        for name in os.listdir(EMBEDDINGS_DIR):
+            # Versioned indexes have a current pointer, legacy ones a manifest
+            for suffix in (".current", ".manifest.json"):
+                if name.endswith(suffix) and COLLECTION_NAME_PATTERN.match(name[:-len(suffix)]):
+                    names.add(name[:-len(suffix)])
+    names.discard(DEFAULT_COLLECTION)
+    return [DEFAULT_COLLECTION] + sorted(names)
+
+def _list_data_pdfs(index_name=DEFAULT_COLLECTION):
+    """All PDFs currently in the data folder of a collection"""
+    data_dir = collection_data_dir(index_name)
+    if not os.path.isdir(data_dir):
+        return []
+    return [os.path.join(data_dir, f) for f in os.listdir(data_dir) if f.endswith('.pdf')]
+
+def _embedding_mismatch(manifest):
+    """Describe why an index cannot be used with the configured model, or None if it can"""
+    descriptor = manifest.get("embedding")
+    if descriptor is None:
+        return "it has no embedding model metadata"
+    if descriptor.get("format_version", 0) > INDEX_FORMAT_VERSION:
+        return f"it uses index format {descriptor['format_version']}, newer than {INDEX_FORMAT_VERSION}"
+    if descriptor["model_name"] != EMBEDDING_MODEL:
+        return f"it was built with {descriptor['model_name']}, not {EMBEDDING_MODEL}"
+    if descriptor["normalize_embeddings"] != EMBEDDING_NORMALIZE:
+        return "it was built with a different embedding normalization setting"
+    # Indexes from before the backend was recorded were all embedded by torch
+    backend = descriptor.get("backend", "torch")
+    if backend != EMBEDDING_BACKEND:
+        return f"it was embedded with the {backend} backend, not {EMBEDDING_BACKEND}"
+    return None
+
+def _previous_roles(paths):
+    """Access roles of every file of the saved index by manifest key, from its manifest
+
+    Read regardless of the embedding model, so rebuilds keep restrictions. Raises if a
+    published generation has no readable manifest rather than ingest its files as public.
+    """
+    try:
+        manifest = _load_manifest(paths["manifest"])
+    except ValueError as e:
+        raise ValueError(f"Could not read the access roles of {paths['manifest']}: {str(e)}")
+    if manifest is None:
+        if paths["generation"] is not None:
+            raise ValueError(f"Generation {paths['generation']} has no manifest, its access roles are unknown")
+        return {}
+    return {key: entry.get("roles") for key, entry in manifest.get("files", {}).items() if entry.get("roles")}
+
+def _open_index(paths, rebuild=False):
+    """Load the saved index and its manifest, or start a new manifest
+
+    Called by writers under the index lock, so working files left in paths["work"] by an
+    interrupted writer are no longer in use and are removed.
+    """
+    shutil.rmtree(paths["work"], ignore_errors=True)
+    # Reuse the saved index unless a rebuild is requested or it was built differently
+    manifest = None if rebuild else _load_manifest(paths["manifest"])
+    if manifest is not None and os.path.exists(paths["faiss"]) and _embedding_mismatch(manifest) is None:
+        vectordb = DocumentIndex.load_local(
+            paths["faiss"], get_embeddings(), work_dir=paths["work"], allow_dangerous_deserialization=True
+        )
+        # The next save writes every file anew, so chunks removed by remove_pdf go for good
+        vectordb._drop_deleted()
+        return vectordb, manifest
+    return None, {"files": {}}
+
+def _save_index(vectordb, manifest, index_name):
+    """Save FAISS index and its manifest as a new generation, then publish it
+
+    Readers keep loading the previous generation until the pointer is swapped.
+    Returns the paths of the new generation.
+    """
+    paths = _next_generation_paths(index_name)
+    os.makedirs(paths["faiss"], exist_ok=True)
+    try:
+        with metrics.timed("save", vectors=vectordb.index.ntotal):
+            _tune_index(vectordb, manifest)
+            vectordb.save_local(paths["faiss"])
+
+        # Record only a description of the embedding model, never the model itself
+        manifest["embedding"] = {
+            "model_name": EMBEDDING_MODEL,
+            "dimension": vectordb.index.d,
+            "normalize_embeddings": EMBEDDING_NORMALIZE,
+            "backend": EMBEDDING_BACKEND,
+            "format_version": INDEX_FORMAT_VERSION,
+        }
+        _save_manifest(manifest, paths["manifest"])
+    except BaseException:
+        shutil.rmtree(os.path.dirname(paths["faiss"]), ignore_errors=True)
+        raise
+    _publish_generation(paths)
+    _collect_generations(index_name)
+    return paths
+
+def _next_generation_paths(index_name):
+    """Paths of the generation after the newest one on disk"""
+    generations = list_generations(index_name)
+    return _index_paths(index_name, f"{int(generations[-1]) + 1 if generations else 1:06d}")
+
+def _save_deletion(index_name, paths, manifest, key):
+    """Publish the index without one file's chunks, by marking their vectors deleted
+
+    The new generation links the files of the current one and only lists the deleted
+    labels and ids next to them, so the cost depends on the chunks removed rather than on
+    the corpus. Returns None, leaving it to a full save, if the current generation has no
+    serving copy to look the labels up in or deleted vectors would pass INDEX_COMPACT_FRACTION.
+    """
+    folder = paths["faiss"]
+    try:
+        chunks = MappedChunks(os.path.join(folder, "index.chunks.bin"))
+        source = os.stat(os.path.join(folder, "index.faiss"))
+    except (OSError, ValueError):
+        return None
+    if paths["generation"] is None or chunks.source != f"{source.st_mtime_ns}-{source.st_size}":
+        return None
+    deleted = _load_deleted(folder)
+    for chunk_id in manifest["files"][key]["chunk_ids"]:
+        row = chunks.row_of_id(chunk_id)
+        if row is None:
+            return None
+        deleted[int(chunks.labels[row])] = chunk_id
+    if len(deleted) > INDEX_COMPACT_FRACTION * len(chunks):
+        return None
+
+    new_paths = _next_generation_paths(index_name)
+    os.makedirs(new_paths["faiss"])
+    try:
+        for name in os.listdir(folder):
+            if name != "index.deleted.json":
+                try:
+                    os.link(os.path.join(folder, name), os.path.join(new_paths["faiss"], name))
+                except OSError:
+                    # Keeps the mtime the serving copy was stamped with
+                    shutil.copy2(os.path.join(folder, name), os.path.join(new_paths["faiss"], name))
+        _save_deleted(deleted, new_paths["faiss"])
+        del manifest["files"][key]
+        _save_manifest(manifest, new_paths["manifest"])
+    except BaseException:
+        shutil.rmtree(os.path.dirname(new_paths["faiss"]), ignore_errors=True)
+        raise
+    _publish_generation(new_paths)
+    _collect_generations(index_name)
+    return new_paths
+
+def _delete_index(index_name):
+    """Remove every saved file of an index"""
+    paths = _index_paths(index_name)
+    # Unpublish first, so readers stop picking the index up before its files go
+    if os.path.exists(paths["current"]):
+        os.remove(paths["current"])
+    for key in ("generations", "checkpoints", "work", "legacy_faiss"):
+        if os.path.isdir(paths[key]):
+            shutil.rmtree(paths[key], ignore_errors=True)
+    for key in ("legacy_pkl", "legacy_manifest"):
+        if os.path.exists(paths[key]):
+            os.remove(paths[key])
+    # Answer caches of every role set
+    for cache_path in glob.glob(paths["answer_cache"].replace(".answers.json", ".answers*.json")):
+        os.remove(cache_path)
+
+def rollback_index(index_name="docs_index", generation=None, lock_timeout=None):
+    """Publish an earlier generation again, by default the one before the current one
+
+    Readers switch to it on their next query. Waits up to lock_timeout seconds (forever
+    if None) for a running update of the index. Returns the published generation.
+    """
+    with index_lock(index_name, timeout=lock_timeout):
+        current = current_generation(index_name)
+        generations = list_generations(index_name)
+        if generation is None:
+            older = [name for name in generations if current is None or int(name) < int(current)]
+            if not older:
+                raise ValueError(f"Index {index_name} has no earlier generation to roll back to")
+            generation = older[-1]
+        generation = f"{int(generation):06d}"
+        paths = _index_paths(index_name, generation)
+        if generation not in generations or not os.path.exists(paths["manifest"]):
+            raise ValueError(f"Index {index_name} has no generation {generation}")
+        _publish_generation(paths)
+        print(f"Rolled {index_name} back from generation {current} to {generation}")
+        return generation
+
+def _drop_files(vectordb, entries, keys):
+    """Delete the vectors of the given manifest entries in place"""
+    stale_ids = [chunk_id for key in keys if key in entries for chunk_id in entries[key]["chunk_ids"]]
+    if stale_ids:
+        vectordb.delete(stale_ids)
+    for key in keys:
+        entries.pop(key, None)
+    return stale_ids
+
+# Index types, from exact to most compressed; "auto" only ever moves up this list
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+
+class DocumentIndex(FAISS):
+    """FAISS vector store that keeps working when the index is IVF or HNSW instead of flat
+
+    Flat indexes renumber vectors on removal, which is what FAISS assumes. IVF indexes keep
+    their labels, so vectors are added with explicit labels and removed without renumbering.
+    HNSW cannot remove vectors, so they are marked deleted and searches skip them until they
+    are INDEX_COMPACT_FRACTION of the graph and it is rebuilt from its stored vectors.
+
+    A BM25 index over the same chunks is kept in step with every add and delete and saved
+    alongside, for hybrid retrieval.
+
+    Chunk texts and metadata live in a ChunkStore (index.chunks.sqlite) instead of the pickled
+    docstore of FAISS.save_local, so loading reads only the vectors and the label to id
+    mapping (index.labels.json) and searches fetch just their hits. Indexes saved in the
+    pickled format still load, and move to a chunk store on their next save.
+
+    Every save also writes a read-only serving copy (an IVF index in INDEX_STORAGE precision
+    and a chunk file) that load_local(mmap=True) maps instead of reading, so processes
+    serving the same index share its pages. Chunks and vectors unchanged since the serving
+    copy of the generation the index was loaded from are copied from it, not rebuilt.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lexical = None
+        self._access = None
+        self.read_only = False
+        # Saved generation the index matches apart from _added_ids, see _previous_chunks
+        self._base = None
+        self._added_ids = set()
+        # Label to id of vectors still in the index but deleted, see _mark_deleted
+        self._deleted = {}
+
+    @property
+    def lexical(self):
+        """BM25 index of the chunks, built from the docstore the first time it is needed"""
+        if self._lexical is None:
+            ids = list(self.index_to_docstore_id.values())
+            lexical = BM25Index()
+            lexical.add(ids, (doc.page_content for doc in self._documents(ids)))
+            self._lexical = lexical
+        return self._lexical
+
+    def _documents(self, ids):
+        """Documents of ids in order, read in batches from a chunk store"""
+        if isinstance(self.docstore, ChunkStore):
+            return self.docstore.iter_documents(ids)
+        return (self.docstore.search(id_) for id_ in ids)
+
+    def _rows(self, ids):
+        """UTF-8 text and metadata JSON of ids in order, as stored in a chunk file"""
+        if isinstance(self.docstore, ChunkStore):
+            rows = self.docstore.iter_rows(ids)
+        else:
+            rows = ((doc.page_content, json.dumps(doc.metadata)) for doc in self._documents(ids))
+        return ((text.encode("utf-8"), metadata.encode("utf-8")) for text, metadata in rows)
+
+    def _set_base(self, folder_path, index_name):
+        self._base = {"folder": folder_path, "index_name": index_name, "index": self.index, "chunks": None}
+        self._added_ids = set()
+
+    def _previous_chunks(self):
+        """Chunk file of the generation the index was loaded from or last saved to, or None if unusable"""
+        if self._base is None:
+            return None
+        if self._base["chunks"] is None:
+            folder_path, index_name = self._base["folder"], self._base["index_name"]
+            try:
+                chunks = MappedChunks(os.path.join(folder_path, f"{index_name}.chunks.bin"))
+                source = os.stat(os.path.join(folder_path, f"{index_name}.faiss"))
+            except (OSError, ValueError):
+                return None
+            if chunks.source != f"{source.st_mtime_ns}-{source.st_size}":
+                return None
+            self._base["chunks"] = chunks
+        return self._base["chunks"]
+
+    def _previous_rows(self, ids):
+        """Row of each id in the previous chunk file, -1 for ids added since"""
+        previous = self._previous_chunks()
+        if previous is None:
+            return None, np.full(len(ids), -1, dtype=np.int64)
+        rows_by_id = previous.rows_by_id()
+        return previous, np.array(
+            [-1 if id_ in self._added_ids else rows_by_id.get(id_, -1) for id_ in ids], dtype=np.int64
+        )
+
+    def _mark_deleted(self, deleted):
+        """Hide vectors that are deleted but still in the index from every search
+
+        deleted maps their labels to docstore ids. Their chunks may still be in the chunk and
+        BM25 stores as well; searches skip them through the same filters as access roles.
+        """
+        if not deleted:
+            return
+        self._deleted.update(deleted)
+        if isinstance(self.index_to_docstore_id, dict):
+            for label in deleted:
+                self.index_to_docstore_id.pop(label, None)
+        if self._access is not None:
+            labels = np.array(list(deleted), dtype=np.int64)
+            label_masks = np.zeros(max(len(self._access["label_masks"]), int(labels.max()) + 1), dtype=np.uint64)
+            label_masks[:len(self._access["label_masks"])] = self._access["label_masks"]
+            label_masks[labels] = 0
+            ids = set(deleted.values())
+            lexical_masks = np.array(self._access["lexical_masks"], dtype=np.uint64)
+            lexical_masks[[row for row, id_ in enumerate(self.lexical.row_ids()) if id_ in ids]] = 0
+            self._access = dict(self._access, label_masks=label_masks, lexical_masks=lexical_masks, filters={})
+
+    def _drop_deleted(self):
+        """Remove the vectors marked deleted from the index and their chunks from the stores
+
+        Flat and IVF indexes remove them at once. An HNSW graph keeps them until they are
+        INDEX_COMPACT_FRACTION of it.
+        """
+        if not self._deleted:
+            return
+        if self.read_only:
+            raise ValueError("A memory-mapped index is read-only, load it with mmap=False to change it")
+        ids = list(self._deleted.values())
+        try:
+            self.docstore.delete(ids)
+        except ValueError:
+            # Saved by an HNSW index, which keeps only the vectors of deleted chunks
+            pass
+        self.lexical.delete(ids)
+        kind = _index_kind(self.index)
+        if kind == "hnsw":
+            self._compact()
+        else:
+            self.index.remove_ids(np.array(list(self._deleted), dtype=np.int64))
+            if kind == "flat":
+                # Flat indexes renumber the remaining vectors in order
+                self.index_to_docstore_id = {
+                    position: id_ for position, (_, id_) in enumerate(sorted(self.index_to_docstore_id.items()))
+                }
+            self._deleted = {}
+        self._access = None
+
+    def _compact(self):
+        """Rebuild an HNSW graph once the vectors marked deleted are INDEX_COMPACT_FRACTION of it"""
+        if len(self._deleted) > INDEX_COMPACT_FRACTION * self.index.ntotal:
+            _rebuild_ann(self, "hnsw", _index_params(self.index))
+
+    @classmethod
+    def from_embeddings(cls, text_embeddings, embedding, metadatas=None, ids=None, **kwargs):
+        # New indexes keep their chunks on disk from the first batch on
+        if "docstore" not in kwargs:
+            kwargs["docstore"] = ChunkStore()
+        return super().from_embeddings(text_embeddings, embedding, metadatas=metadatas, ids=ids, **kwargs)
+
+    def save_local(self, folder_path, index_name="index", storage=None):
+        if self.read_only:
+            raise ValueError("A memory-mapped index is read-only, load it with mmap=False to save it")
+        os.makedirs(folder_path, exist_ok=True)
+        faiss.write_index(self.index, os.path.join(folder_path, f"{index_name}.faiss"))
+        labels = sorted(self.index_to_docstore_id)
+        if not isinstance(self.docstore, ChunkStore):
+            # Loaded from the pickled format, see migrate_chunk_store
+            self.docstore = ChunkStore.copy_of(self.docstore, [self.index_to_docstore_id[label] for label in labels])
+        access = self._access_masks()
+        with open(os.path.join(folder_path, f"{index_name}.labels.json"), "w", encoding="utf-8") as f:
+            json.dump({
+                "labels": labels,
+                "ids": [self.index_to_docstore_id[label] for label in labels],
+                # Role masks per label and per BM25 row, so loading does not read every chunk for them
+                "access": {
+                    "role_bits": access["role_bits"],
+                    "label_masks": access["label_masks"][labels].tolist(),
+                    "lexical_masks": access["lexical_masks"].tolist(),
+                },
+            }, f)
+        if self._deleted:
+            _save_deleted(self._deleted, folder_path, index_name)
+        self.docstore.save(os.path.join(folder_path, f"{index_name}.chunks.sqlite"))
+        self.lexical.save(os.path.join(folder_path, f"{index_name}.bm25"))
+        self._save_mapped(folder_path, index_name, storage or INDEX_STORAGE)
+        self._set_base(folder_path, index_name)
+
+    def _save_mapped(self, folder_path, index_name, storage):
+        """Write the serving copy read by load_local(mmap=True)
+
+        Chunks unchanged since the previous chunk file are copied from it as stored, the others
+        are streamed from the docstore in batches.
+        """
+        labels = np.array(sorted(self.index_to_docstore_id), dtype=np.int64)
+        ids = [self.index_to_docstore_id[int(label)] for label in labels]
+        access = self._access_masks()
+        previous, previous_rows = self._previous_rows(ids)
+        # Readers may still map the previous files, so new ones are moved into place, never rewritten
+        mapped_path = os.path.join(folder_path, f"{index_name}.mapped.faiss")
+        serving = self._updated_serving_index(previous, previous_rows, labels, storage)
+        if serving is None:
+            serving = _serving_index(self.index, labels, storage)
+        faiss.write_index(serving, f"{mapped_path}.tmp")
+        os.replace(f"{mapped_path}.tmp", mapped_path)
+
+        def rows():
+            added = self._rows([id_ for id_, row in zip(ids, previous_rows) if row < 0])
+            for row in previous_rows.tolist():
+                yield previous.raw(row) if row >= 0 else next(added)
+
+        source = os.stat(os.path.join(folder_path, f"{index_name}.faiss"))
+        write_chunk_file(
+            os.path.join(folder_path, f"{index_name}.chunks.bin"),
+            labels,
+            ids,
+            rows(),
+            label_masks=access["label_masks"][labels],
+            lexical_masks=access["lexical_masks"],
+            role_bits=access["role_bits"],
+            source=f"{source.st_mtime_ns}-{source.st_size}",
+            storage=storage,
+        )
+
+    def _updated_serving_index(self, previous, previous_rows, labels, storage):
+        """The previous serving index with only the changed vectors removed and added, or None to build it anew
+
+        Needs the same storage and, for IVF, the same lists. int8 ranges are fitted to the
+        vectors, so int8 copies are always rebuilt, and IVF-PQ and HNSW are written as they are. Vectors of a label are unchanged if it holds
+        the same chunk as in the previous chunk file.
+        """
+        kind = _index_kind(self.index)
+        if previous is None or previous.storage != storage or storage == "int8" or kind in ("ivf_pq", "hnsw"):
+            return None
+        if kind == "ivf_flat" and self.index is not self._base["index"]:
+            # Retrained or rebuilt since, so the vectors belong to other lists
+            return None
+        unchanged = previous_rows >= 0
+        unchanged[unchanged] = previous.labels[previous_rows[unchanged]] == labels[unchanged]
+        # Rebuilding is cheaper once most vectors changed, e.g. after a flat index renumbered its labels
+        if unchanged.sum() < len(labels) / 2:
+            return None
+        try:
+            serving = faiss.read_index(
+                os.path.join(self._base["folder"], f"{self._base['index_name']}.mapped.faiss")
+            )
+        except RuntimeError:
+            return None
+        if serving.ntotal != len(previous):
+            return None
+        stale = np.setdiff1d(previous.labels, labels[unchanged])
+        if len(stale):
+            serving.remove_ids(stale)
+        added = labels[~unchanged]
+        for start in range(0, len(added), ANN_BUILD_BATCH_SIZE):
+            batch = added[start:start + ANN_BUILD_BATCH_SIZE]
+            serving.add_with_ids(self.index.reconstruct_batch(batch), batch)
+        if kind == "ivf_flat":
+            serving.nprobe = faiss.extract_index_ivf(self.index).nprobe
+        return serving
+
+    @classmethod
+    def load_local(cls, folder_path, embeddings, index_name="index", mmap=False, work_dir=None, **kwargs):
+        """Load a saved index; changes to its chunk store are made in a working file in work_dir"""
+        lexical_path = os.path.join(folder_path, f"{index_name}.bm25")
+        if not all(os.path.exists(path) for path in BM25Index.files(lexical_path)):
+            # Written as one .npz file before the arrays were mapped
+            lexical_path += ".npz"
+            if not os.path.exists(lexical_path):
+                lexical_path = None
+        deleted = _load_deleted(folder_path, index_name)
+        vectordb = cls._load_mapped(folder_path, embeddings, index_name, deleted) if mmap else None
+        if vectordb is None and os.path.exists(os.path.join(folder_path, f"{index_name}.chunks.sqlite")):
+            vectordb = cls._load_chunk_store(folder_path, embeddings, index_name, work_dir, **kwargs)
+        if vectordb is None:
+            # Saved with the pickled docstore of FAISS.save_local
+            vectordb = super().load_local(folder_path, embeddings, index_name, **kwargs)
+        # Indexes saved before BM25 existed get theirs built from the docstore on first use
+        if lexical_path is not None:
+            lexical = BM25Index.load(lexical_path)
+            if len(lexical) == len(vectordb.index_to_docstore_id):
+                vectordb._lexical = lexical
+                chunks = getattr(vectordb.docstore, "chunks", None)
+                if chunks is not None and chunks.label_masks is not None and len(chunks.lexical_masks) == len(lexical):
+                    # Role masks were computed at save time, in the row order of this BM25 index
+                    label_masks = np.zeros(int(chunks.labels[-1]) + 1 if len(chunks) else 0, dtype=np.uint64)
+                    label_masks[chunks.labels] = chunks.label_masks
+                    vectordb._access = {
+                        "role_bits": chunks.role_bits, "label_masks": label_masks,
+                        "lexical_masks": chunks.lexical_masks, "filters": {},
+                    }
+        if vectordb._lexical is None:
+            # Saved role masks are in the row order of the saved BM25 index
+            vectordb._access = None
+        vectordb._mark_deleted(deleted)
+        return vectordb
+
+    @classmethod
+    def _load_chunk_store(cls, folder_path, embeddings, index_name, work_dir=None, **kwargs):
+        """Index over the saved vectors and chunk store, chunks are read on demand"""
+        # Nothing is unpickled, so there is nothing to allow
+        kwargs.pop("allow_dangerous_deserialization", None)
+        index = faiss.read_index(os.path.join(folder_path, f"{index_name}.faiss"))
+        with open(os.path.join(folder_path, f"{index_name}.labels.json"), "r", encoding="utf-8") as f:
+            mapping = json.load(f)
+        docstore = ChunkStore(os.path.join(folder_path, f"{index_name}.chunks.sqlite"), folder=work_dir)
+        vectordb = cls(embeddings, index, docstore, dict(zip(mapping["labels"], mapping["ids"])), **kwargs)
+        vectordb._set_base(folder_path, index_name)
+        access = mapping.get("access")
+        if access is not None:
+            labels = np.array(mapping["labels"], dtype=np.int64)
+            label_masks = np.zeros(int(labels[-1]) + 1 if len(labels) else 0, dtype=np.uint64)
+            label_masks[labels] = np.array(access["label_masks"], dtype=np.uint64)
+            vectordb._access = {
+                "role_bits": access["role_bits"], "label_masks": label_masks,
+                "lexical_masks": np.array(access["lexical_masks"], dtype=np.uint64), "filters": {},
+            }
+        return vectordb
+
+    @classmethod
+    def _load_mapped(cls, folder_path, embeddings, index_name, deleted=None):
+        """Read-only index over the mapped serving copy, or None if it is missing or stale"""
+        mapped_path = os.path.join(folder_path, f"{index_name}.mapped.faiss")
+        chunks_path = os.path.join(folder_path, f"{index_name}.chunks.bin")
+        if not (os.path.exists(mapped_path) and os.path.exists(chunks_path)):
+            print(f"Warning: {folder_path} has no memory-mapped copy yet, loading it into memory")
+            return None
+        chunks = MappedChunks(chunks_path)
+        source = os.stat(os.path.join(folder_path, f"{index_name}.faiss"))
+        index = faiss.read_index(mapped_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        labels = MappedLabels(chunks, deleted or ())
+        # Deleted vectors of an HNSW graph are in the index, but not always in the chunk file
+        if chunks.source != f"{source.st_mtime_ns}-{source.st_size}" or index.ntotal != len(labels) + len(deleted or ()):
+            # Saved by a writer that could not replace the mapped files, or caught mid-save
+            print(f"Warning: The memory-mapped copy of {folder_path} is out of date, loading it into memory")
+            return None
+        vectordb = cls(embeddings, index, MappedDocstore(chunks), labels)
+        vectordb.read_only = True
+        return vectordb
+
+    def _access_masks(self):
+        """Role bitmask of every vector label and the bit assigned to each role
+
+        Roles come from the "roles" metadata of the chunks. Bit 0 marks chunks open to
+        everyone, the other bits are assigned to roles in the order they are found. Chunks
+        unchanged since the previous chunk file keep the masks and bits saved there.
+        """
+        if self._access is None:
+            try:
+                self._access = self._compute_access(self._previous_chunks())
+            except ValueError:
+                # Roles no longer used still hold bits of the previous chunk file, assign them afresh
+                self._access = self._compute_access(None)
+        return self._access
+
+    def _compute_access(self, previous):
+        role_bits = {}
+        id_masks = {}
+        items = list(self.index_to_docstore_id.items())
+        ids = [id_ for _, id_ in items]
+        if previous is not None and previous.label_masks is not None:
+            role_bits = dict(previous.role_bits)
+            previous_masks = previous.label_masks.tolist()
+            _, previous_rows = self._previous_rows(ids)
+            id_masks = {id_: previous_masks[row] for id_, row in zip(ids, previous_rows.tolist()) if row >= 0}
+        missing = [id_ for id_ in ids if id_ not in id_masks]
+        for id_, doc in zip(missing, self._documents(missing)):
+            roles = doc.metadata.get("roles")
+            mask = 1
+            if roles:
+                mask = 0
+                for role in roles:
+                    if role not in role_bits:
+                        if len(role_bits) >= 63:
+                            raise ValueError("An index supports at most 63 distinct access roles")
+                        role_bits[role] = 1 << (len(role_bits) + 1)
+                    mask |= role_bits[role]
+            id_masks[id_] = mask
+        # Labels of deleted vectors are covered too, with no bits set
+        label_masks = np.zeros(max(max(self.index_to_docstore_id, default=-1), max(self._deleted, default=-1)) + 1, dtype=np.uint64)
+        for label, id_ in items:
+            label_masks[label] = id_masks[id_]
+        deleted_ids = set(self._deleted.values())
+        lexical_masks = np.array(
+            [id_masks.get(id_, 0 if id_ in deleted_ids else 1) for id_ in self.lexical.row_ids()], dtype=np.uint64
+        )
+        return {"role_bits": role_bits, "label_masks": label_masks, "lexical_masks": lexical_masks, "filters": {}}
+
+    def _access_filter(self, roles):
+        """FAISS selector and BM25 row mask of the chunks visible to any of roles, cached per role set
+
+        roles None selects every chunk that is not deleted.
+        """
+        access = self._access_masks()
+        query_mask = 1
+        for role in roles if roles is not None else ():
+            query_mask |= access["role_bits"].get(role, 0)
+        if roles is None:
+            # Every chunk that is not deleted has at least one bit set
+            query_mask = (1 << 64) - 1
+        cached = access["filters"].get(query_mask)
+        if cached is None:
+            allowed = (access["label_masks"] & np.uint64(query_mask)) != 0
+            # The selector reads the bitmap in place, so it is cached together with it
+            bitmap = np.packbits(allowed, bitorder="little")
+            selector = faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))
+            lexical_allowed = (access["lexical_masks"] & np.uint64(query_mask)) != 0
+            cached = access["filters"][query_mask] = (selector, bitmap, lexical_allowed)
+        return cached[0], cached[2]
+
+    def _search_filter(self, roles):
+        """_access_filter of roles, or (None, None) when every chunk may be returned"""
+        if roles is None and not self._deleted:
+            return None, None
+        return self._access_filter(roles)
+
+    def _search_labels(self, embedding, k, selector=None):
+        return [id_ for id_, _ in self._search_distances(embedding, k, selector)]
+
+    def _search_distances(self, embedding, k, selector=None):
+        """(docstore id, distance) pairs of the k nearest chunks"""
+        vector = np.array([embedding], dtype=np.float32)
+        if self._normalize_L2:
+            faiss.normalize_L2(vector)
+        if selector is None:
+            distances, labels = self.index.search(vector, k)
+        else:
+            # The selector filters inside the search, so k allowed results come back when they exist
+            kind = _index_kind(self.index)
+            if kind in ("ivf_flat", "ivf_pq"):
+                params = faiss.SearchParametersIVF(sel=selector, nprobe=faiss.extract_index_ivf(self.index).nprobe)
+            elif kind == "hnsw":
+                params = faiss.SearchParametersHNSW(sel=selector, efSearch=faiss.downcast_index(self.index).hnsw.efSearch)
+            else:
+                params = faiss.SearchParameters(sel=selector)
+            distances, labels = self.index.search(vector, k, params=params)
+        return [(self.index_to_docstore_id[label], float(distance)) for label, distance in zip(labels[0], distances[0]) if label != -1]
+
+    def vector_search(self, embedding, k=4, roles=None):
+        """Chunks nearest to an embedding, only among those visible to roles unless roles is None"""
+        selector = self._search_filter(roles)[0]
+        return [self.docstore.search(id_) for id_ in self._search_labels(embedding, k, selector)]
+
+    def vector_search_with_scores(self, embedding, k=4, roles=None):
+        """(chunk, relevance) pairs of vector_search
+
+        Relevance is the distance mapped by the index's relevance function, so it compares
+        across indexes built with the same embedding model.
+        """
+        selector = self._search_filter(roles)[0]
+        relevance = self._select_relevance_score_fn()
+        return [(self.docstore.search(id_), relevance(distance)) for id_, distance in self._search_distances(embedding, k, selector)]
+
+    def hybrid_search_by_vector(self, query, embedding, k=4, fetch_k=HYBRID_FETCH_K, rrf_k=RRF_K, roles=None):
+        """Chunks ranked by reciprocal rank fusion of the vector and BM25 results for a query
+
+        With roles, both searches only consider chunks visible to at least one of them.
+        """
+        return [doc for doc, _ in self.hybrid_search_with_scores(query, embedding, k, fetch_k, rrf_k, roles)]
+
+    def hybrid_search_with_scores(self, query, embedding, k=4, fetch_k=HYBRID_FETCH_K, rrf_k=RRF_K, roles=None):
+        """(chunk, score) pairs of hybrid_search_by_vector
+
+        The score is the fused score over its maximum, a chunk ranked first by both searches,
+        so it lies in [0, 1] whatever the size of the index.
+        """
+        selector, lexical_allowed = self._search_filter(roles)
+        # BM25 runs on the search pool while FAISS, which releases the GIL, searches here
+        lexical_hits = _search_pool.submit(self.lexical.search, query, fetch_k, lexical_allowed)
+        vector_ids = self._search_labels(embedding, fetch_k, selector)
+        lexical_ids = [id_ for id_, _ in lexical_hits.result()]
+
+        fused = {}
+        for ranking in (vector_ids, lexical_ids):
+            for rank, id_ in enumerate(ranking):
+                fused[id_] = fused.get(id_, 0.0) + 1.0 / (rrf_k + rank + 1)
+        best = sorted(fused, key=fused.get, reverse=True)[:k]
+        top = 2.0 / (rrf_k + 1)
+        return [(self.docstore.search(id_), fused[id_] / top) for id_ in best]
+
+    def hybrid_search(self, query, k=4, **kwargs):
+        """hybrid_search_by_vector for a query that is not embedded yet"""
+        return self.hybrid_search_by_vector(query, self._embed_query(query), k=k, **kwargs)
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None, fetch_k=20, **kwargs):
+        if not self._deleted:
+            return super().similarity_search_with_score_by_vector(embedding, k, filter=filter, fetch_k=fetch_k, **kwargs)
+        # Deleted vectors are still in the index, only the selector keeps them out
+        selector = self._search_filter(None)[0]
+        hits = self._search_distances(embedding, k if filter is None else fetch_k, selector)
+        docs = [(self.docstore.search(id_), distance) for id_, distance in hits]
+        if filter is not None:
+            docs = [(doc, distance) for doc, distance in docs if all(doc.metadata.get(key) == value for key, value in filter.items())][:k]
+        return docs
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        return self.add_embeddings(zip(texts, self._embed_documents(texts)), metadatas=metadatas, ids=ids)
+
+    def add_embeddings(self, text_embeddings, metadatas=None, ids=None, **kwargs):
+        if self.read_only:
+            raise ValueError("A memory-mapped index is read-only, load it with mmap=False to change it")
+        text_embeddings = list(text_embeddings)
+        kind = _index_kind(self.index)
+        if kind == "flat":
+            ids = super().add_embeddings(text_embeddings, metadatas=metadatas, ids=ids, **kwargs)
+            self._added_ids.update(ids)
+            if self._lexical is not None:
+                self._lexical.add(ids, [text for text, _ in text_embeddings])
+            self._access = None
+            return ids
+
+        texts, vectors = zip(*text_embeddings)
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        metadatas = metadatas or [{} for _ in texts]
+        vectors = np.array(vectors, dtype=np.float32)
+        start = max(max(self.index_to_docstore_id, default=-1), max(self._deleted, default=-1)) + 1
+        labels = np.arange(start, start + len(texts), dtype=np.int64)
+        if kind == "hnsw":
+            # HNSW labels are always positions, deleted vectors keep theirs until the graph is rebuilt
+            self.index.add(vectors)
+        else:
+            self.index.add_with_ids(vectors, labels)
+
+        self.docstore.add({id_: Document(page_content=text, metadata=metadata) for id_, text, metadata in zip(ids, texts, metadatas)})
+        self.index_to_docstore_id.update(zip(labels.tolist(), ids))
+        self._added_ids.update(ids)
+        if self._lexical is not None:
+            self._lexical.add(ids, texts)
+        self._access = None
+        return ids
+
+    def delete(self, ids=None, **kwargs):
+        if self.read_only:
+            raise ValueError("A memory-mapped index is read-only, load it with mmap=False to change it")
+        kind = _index_kind(self.index)
+        if kind == "flat":
+            super().delete(ids, **kwargs)
+            if self._lexical is not None:
+                self._lexical.delete(ids)
+            self._access = None
+            return True
+        if ids is None:
+            raise ValueError("No ids provided to delete.")
+
+        doomed = set(ids)
+        deleted = {label: id_ for label, id_ in self.index_to_docstore_id.items() if id_ in doomed}
+        if len(deleted) != len(doomed):
+            raise ValueError("Some specified ids do not exist in the current store.")
+        for label in deleted:
+            del self.index_to_docstore_id[label]
+        self.docstore.delete(ids)
+
+        if kind == "hnsw":
+            self._deleted.update(deleted)
+            self._compact()
+        else:
+            self.index.remove_ids(np.array(list(deleted), dtype=np.int64))
+        if self._lexical is not None:
+            self._lexical.delete(ids)
+        self._access = None
+        return True
+
+class FederatedIndex(VectorStore):
+    """Read-only view searching several collections at once
+
+    Each search runs on every collection in parallel on the federated pool, each returning its
+    own top k with normalized scores, and the best k of them all are kept. Chunks carry the
+    name of their collection in their "collection" metadata. The collections must be built
+    with the same embedding model, which load_vectordb already enforces.
+    """
+
+    def __init__(self, indexes):
+        self.indexes = dict(sorted(indexes.items()))
+        self.index_name = "+".join(self.indexes)
+        self.version = "+".join(f"{name}:{index.version}" for name, index in self.indexes.items())
+        self._embedding = next(iter(self.indexes.values())).embeddings
+
+    @property
+    def embeddings(self):
+        return self._embedding
+
+    def _merge(self, search, k):
+        futures = {name: _federation_pool.submit(search, index) for name, index in self.indexes.items()}
+        scored = []
+        for name, future in futures.items():
+            for doc, score in future.result():
+                scored.append((score, Document(page_content=doc.page_content, metadata=dict(doc.metadata, collection=name))))
+        # Stable, so ties keep the collection order
+        scored.sort(key=lambda item: item[0], reverse=True)
+        return scored[:k]
+
+    def vector_search(self, embedding, k=4, roles=None):
+        """DocumentIndex.vector_search over every collection, merged by relevance"""
+        return [doc for _, doc in self._merge(lambda index: index.vector_search_with_scores(embedding, k, roles), k)]
+
+    def hybrid_search_by_vector(self, query, embedding, k=4, fetch_k=HYBRID_FETCH_K, rrf_k=RRF_K, roles=None):
+        """DocumentIndex.hybrid_search_by_vector over every collection, merged by normalized fused score"""
+        search = lambda index: index.hybrid_search_with_scores(query, embedding, k, fetch_k, rrf_k, roles)
+        return [doc for _, doc in self._merge(search, k)]
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return self.vector_search(embedding, k)
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return self.vector_search(self._embedding.embed_query(query), k)
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        raise NotImplementedError("A federated index is read-only, add documents to one of its collections")
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        raise NotImplementedError("Build each collection with process_and_save_pdfs and federate them with get_federated_vectordb")
+
+def _index_kind(index):
+    """Which of INDEX_TYPES a FAISS index is"""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf_flat"
+    return "flat"
+
+def _index_params(index):
+    """Build and search parameters of a FAISS index, as recorded in the manifest"""
+    kind = _index_kind(index)
+    index = faiss.downcast_index(index)
+    params = {"type": kind}
+    if kind == "hnsw":
+        params.update(m=index.hnsw.nb_neighbors(1), ef_construction=index.hnsw.efConstruction, ef_search=index.hnsw.efSearch)
+    elif kind in ("ivf_flat", "ivf_pq"):
+        params.update(nlist=index.nlist, nprobe=index.nprobe)
+        if kind == "ivf_pq":
+            params.update(pq_m=index.pq.M, pq_bits=index.pq.nbits)
+    return params
+
+def _select_index_type(vector_count):
+    """Index type for a corpus of this size, unless INDEX_TYPE forces one"""
+    if INDEX_TYPE != "auto":
+        # IVF lists and PQ codebooks cannot be trained on a handful of vectors
+        if vector_count < MIN_TRAINING_VECTORS.get(INDEX_TYPE, 0):
+            return "flat"
+        return INDEX_TYPE
+    if vector_count < FLAT_MAX_VECTORS:
+        return "flat"
+    if vector_count < IVF_FLAT_MAX_VECTORS:
+        return "ivf_flat"
+    return "ivf_pq"
+
+def _new_ann_index(index_type, dimension, vector_count, params=None):
+    """Empty FAISS index of the given type with parameters sized for the corpus"""
+    params = dict(params or {}, type=index_type)
+    if index_type == "flat":
+        return faiss.IndexFlatL2(dimension), {"type": "flat"}
+
+    if index_type == "hnsw":
+        params.setdefault("m", 32)
+        params.setdefault("ef_construction", 80)
+        params.setdefault("ef_search", 64)
+        index = faiss.IndexHNSWFlat(dimension, params["m"])
+        index.hnsw.efConstruction = params["ef_construction"]
+        index.hnsw.efSearch = params["ef_search"]
+        return index, params
+
+    # Rule of thumb: about 4 * sqrt(n) lists, probing a few percent of them
+    nlist = params.get("nlist") or int(min(max(4 * np.sqrt(vector_count), 16), 65536, vector_count))
+    params["nlist"] = nlist
+    params.setdefault("nprobe", min(nlist, max(8, nlist // 32)))
+    quantizer = faiss.IndexFlatL2(dimension)
+    if index_type == "ivf_flat":
+        index = faiss.IndexIVFFlat(quantizer, dimension, nlist)
+    elif index_type == "ivf_pq":
+        # Sub-quantizers of 8 dimensions each, 8 bits per code
+        params.setdefault("pq_m", next(m for m in (dimension // 8, 48, 32, 16, 8, 4, 2, 1) if m and dimension % m == 0))
+        params.setdefault("pq_bits", 8)
+        index = faiss.IndexIVFPQ(quantizer, dimension, nlist, params["pq_m"], params["pq_bits"])
     else:
-        # Also include existing PDFs in data folder
-        existing_pdfs = [os.path.join(DATA_DIR, f) for f in os.listdir(DATA_DIR) if f.endswith('.pdf')]
-        # Combine new uploads with existing files, remove duplicates
-        all_pdfs = list(set(pdf_paths + existing_pdfs))
-        pdf_paths = all_pdfs
-    
-    if not pdf_paths:
-        raise ValueError("No PDF files found to process")
-    
-    # Load all PDFs
-    for pdf_path in pdf_paths:
-        if os.path.exists(pdf_path):
+        raise ValueError(f"Unknown index type {index_type}, expected one of {', '.join(INDEX_TYPES)}")
+    index.nprobe = params["nprobe"]
+    # Hashtable direct map: labels can be reconstructed (MMR, rebuilds) and removed
+    index.set_direct_map_type(faiss.DirectMap.Hashtable)
+    return index, params
+
+def _rebuild_ann(vectordb, index_type, params=None):
+    """Rebuild a vector store's FAISS index as index_type from the vectors it already holds"""
+    labels = np.array(sorted(vectordb.index_to_docstore_id), dtype=np.int64)
+    old_index = vectordb.index
+    new_index, params = _new_ann_index(index_type, old_index.d, len(labels), params)
+
+    if not new_index.is_trained:
+        # Train on a fixed-seed sample so the same corpus gives the same index
+        sample_size = min(len(labels), params["nlist"] * 256)
+        rng = np.random.default_rng(0)
+        sample = np.sort(rng.choice(labels, size=sample_size, replace=False))
+        new_index.train(old_index.reconstruct_batch(sample))
+
+    for start in range(0, len(labels), ANN_BUILD_BATCH_SIZE):
+        batch = labels[start:start + ANN_BUILD_BATCH_SIZE]
+        vectors = old_index.reconstruct_batch(batch)
+        if index_type in ("ivf_flat", "ivf_pq"):
+            new_index.add_with_ids(vectors, batch)
+        else:
+            new_index.add(vectors)
+
+    if index_type not in ("ivf_flat", "ivf_pq"):
+        # Flat and HNSW label vectors by position
+        vectordb.index_to_docstore_id = {
+            position: vectordb.index_to_docstore_id[int(label)] for position, label in enumerate(labels)
+        }
+    params["trained_on"] = len(labels)
+    vectordb.index = new_index
+    # Only the vectors still in use were copied
+    vectordb._deleted = {}
+    return params
+
+def _serving_index(index, labels, storage=INDEX_STORAGE):
+    """Copy of an index that FAISS can memory-map: an IVF index holding vectors in storage precision
+
+    IVF-PQ codes are already compact and are served as they are. HNSW is served as it is too, so
+    queries keep walking the graph; FAISS reads it into memory rather than mapping it. Flat
+    indexes become a single-list IVF index, which is still an exact search.
+    """
+    if storage not in INDEX_STORAGE_TYPES:
+        raise ValueError(f"Unknown index storage {storage}, expected one of {', '.join(INDEX_STORAGE_TYPES)}")
+    kind = _index_kind(index)
+    if kind in ("ivf_pq", "hnsw"):
+        return index
+    if kind == "ivf_flat":
+        ivf = faiss.extract_index_ivf(index)
+        quantizer, nlist, nprobe = faiss.clone_index(ivf.quantizer), ivf.nlist, ivf.nprobe
+    else:
+        quantizer, nlist, nprobe = faiss.IndexFlat(index.d, index.metric_type), 1, 1
+        quantizer.add(np.zeros((1, index.d), dtype=np.float32))
+
+    if storage == "float32":
+        serving = faiss.IndexIVFFlat(quantizer, index.d, nlist, index.metric_type)
+    else:
+        qtype = faiss.ScalarQuantizer.QT_fp16 if storage == "float16" else faiss.ScalarQuantizer.QT_8bit
+        serving = faiss.IndexIVFScalarQuantizer(quantizer, index.d, nlist, qtype, index.metric_type)
+    serving.nprobe = nprobe
+    if not serving.is_trained:
+        # 8-bit ranges are fitted on a fixed-seed sample, like IVF lists
+        rng = np.random.default_rng(0)
+        sample = np.sort(rng.choice(labels, size=min(len(labels), ANN_BUILD_BATCH_SIZE), replace=False))
+        serving.train(index.reconstruct_batch(sample) if len(sample) else np.zeros((1, index.d), dtype=np.float32))
+    for start in range(0, len(labels), ANN_BUILD_BATCH_SIZE):
+        batch = labels[start:start + ANN_BUILD_BATCH_SIZE]
+        serving.add_with_ids(index.reconstruct_batch(batch), batch)
+    return serving
+
+def _tune_index(vectordb, manifest):
+    """Switch the index to the type that fits the corpus size, retraining IVF lists as it grows"""
+    vector_count = vectordb.index.ntotal
+    current = manifest.get("index") or _index_params(vectordb.index)
+    target = _select_index_type(vector_count)
+
+    if target != current["type"]:
+        if INDEX_TYPE == "auto" and INDEX_TYPES.index(target) < INDEX_TYPES.index(current["type"]):
+            # Never step down automatically; that would only pay off after a full rebuild
+            return current
+        if current["type"] == "ivf_pq":
+            print("Warning: PQ codes are lossy, rebuild the embeddings to change the index type")
+            return current
+        print(f"Switching index from {current['type']} to {target} for {vector_count} vectors")
+        manifest["index"] = _rebuild_ann(vectordb, target)
+        return manifest["index"]
+
+    if target == "ivf_flat" and vector_count > IVF_RETRAIN_GROWTH * current.get("trained_on", vector_count):
+        print(f"Retraining IVF lists for {vector_count} vectors")
+        manifest["index"] = _rebuild_ann(vectordb, target)
+        return manifest["index"]
+
+    manifest["index"] = dict(current, type=current["type"])
+    manifest["index"].setdefault("trained_on", vector_count)
+    return manifest["index"]
+
+def _configure_search(index, nprobe=None, ef_search=None):
+    """Apply query-time knobs to a loaded FAISS index"""
+    kind = _index_kind(index)
+    if kind in ("ivf_flat", "ivf_pq") and nprobe is not None:
+        faiss.extract_index_ivf(index).nprobe = nprobe
+    elif kind == "hnsw" and ef_search is not None:
+        faiss.downcast_index(index).hnsw.efSearch = ef_search
+
+def _iter_pages(pdf_path, start=0, stop=None):
+    """Yield pages of a PDF one at a time, as the documents PyMuPDFLoader makes of them"""
+    with fitz.open(pdf_path) as pdf:
+        info = {key: value for key, value in pdf.metadata.items() if type(value) in [str, int]}
+        for number in range(start, min(stop or pdf.page_count, pdf.page_count)):
+            metadata = {"source": pdf_path, "file_path": pdf_path, "page": number, "total_pages": pdf.page_count}
+            yield Document(page_content=pdf.load_page(number).get_text(), metadata=dict(metadata, **info))
+
+def _page_count(pdf_path):
+    """Number of pages of a PDF, read from its page tree only"""
+    with fitz.open(pdf_path) as pdf:
+        return pdf.page_count
+
+def _extract_pages(pdf_path, start, stop, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+    """Load and split a page range of one PDF, returning its page count, chunks and stage timings (runs in a worker process)"""
+    started = time.perf_counter()
+    pages = list(_iter_pages(pdf_path, start, stop))
+    extracted = time.perf_counter()
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap, add_start_index=True)
+    chunks = splitter.split_documents(pages)
+    return len(pages), chunks, {"extract": extracted - started, "split": time.perf_counter() - extracted}
+
+def _iter_extracted(tasks, max_workers=None):
+    """Yield extraction events for PDFs in input order
+
+    tasks is a list of (pdf path, first page); pages before the first page are skipped.
+    Events are ("pages", path, page_count, chunks, timings, (start, stop, total_pages)),
+    ("done", path) and ("failed", path, error), where timings holds the seconds spent
+    extracting and splitting pages start to stop. In-process extraction reads one page at
+    a time; a process pool extracts PAGE_RANGE_SIZE pages per task with only a few tasks in
+    flight, so memory stays flat however large a PDF is.
+    """
+    workers = min(max_workers or INGEST_WORKERS, len(tasks))
+
+    if workers <= 1:
+        splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, add_start_index=True)
+        for pdf_path, first_page in tasks:
             try:
-                loader = PyMuPDFLoader(pdf_path)
-                docs.extend(loader.load())
+                pages = _iter_pages(pdf_path, first_page)
+                while True:
+                    started = time.perf_counter()
+                    page = next(pages, None)
+                    if page is None:
+                        break
+                    extracted = time.perf_counter()
+                    chunks = splitter.split_documents([page])
+                    timings = {"extract": extracted - started, "split": time.perf_counter() - extracted}
+                    number, total_pages = page.metadata["page"], page.metadata["total_pages"]
+                    yield "pages", pdf_path, 1, chunks, timings, (number, number + 1, total_pages)
             except Exception as e:
-                print(f"Warning: Could not load {pdf_path}: {str(e)}")
+                yield "failed", pdf_path, str(e)
                 continue
+            yield "done", pdf_path
+        return
+
+    def page_ranges():
+        # (path, (start, stop, total pages) or None, whether it is the file's last range, or the error)
+        for pdf_path, first_page in tasks:
+            try:
+                total_pages = _page_count(pdf_path)
+            except Exception as e:
+                yield pdf_path, None, str(e)
+                continue
+            if first_page >= total_pages:
+                yield pdf_path, None, None
+            for start in range(first_page, total_pages, PAGE_RANGE_SIZE):
+                stop = min(start + PAGE_RANGE_SIZE, total_pages)
+                yield pdf_path, (start, stop, total_pages), stop == total_pages
+
+    def submit(pdf_path, pages, last):
+        future = pool.submit(_extract_pages, pdf_path, pages[0], pages[1]) if pages is not None else None
+        return pdf_path, pages, last, future
+
+    # Spawn fresh workers so they never inherit the model or threads of the app process
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        remaining = page_ranges()
+        in_flight = deque(submit(*task) for task in itertools.islice(remaining, workers * 2))
+        failed_paths = set()
+        while in_flight:
+            pdf_path, pages, last, future = in_flight.popleft()
+            next_task = next(remaining, None)
+            if next_task is not None:
+                in_flight.append(submit(*next_task))
+            if pdf_path in failed_paths:
+                # Later ranges of a file that already failed
+                if future is not None:
+                    future.cancel()
+                continue
+            if pages is None:
+                if last is None:
+                    yield "done", pdf_path
+                else:
+                    yield "failed", pdf_path, last
+                continue
+            try:
+                page_count, chunks, timings = future.result()
+            except Exception as e:
+                failed_paths.add(pdf_path)
+                yield "failed", pdf_path, str(e)
+                continue
+            yield "pages", pdf_path, page_count, chunks, timings, pages
+            if last:
+                yield "done", pdf_path
+
+def _chunk_id(key, sha, position):
+    """Deterministic chunk id, so rebuilding the same files gives the same index"""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{key}#{sha}#{position}"))
+
+def _normalize_roles(roles):
+    """Sorted access roles of a PDF, or None if everyone may read it"""
+    if not roles:
+        return None
+    if isinstance(roles, str):
+        roles = roles.split(",")
+    return sorted({role.strip() for role in roles if role.strip()}) or None
+
+def _manifest_entry(key, sha, page_count, chunk_ids, roles=None):
+    """Manifest entry for one indexed PDF"""
+    return {
+        "path": key,
+        "sha256": sha,
+        "pages": page_count,
+        "chunk_ids": chunk_ids,
+        "embedding_model": EMBEDDING_MODEL,
+        "roles": roles,
+    }
+
+def _progress_snapshot(stats, started):
+    """Ingestion counters with throughput since the start of the run"""
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    return dict(
+        stats,
+        elapsed=elapsed,
+        pages_per_s=stats["pages"] / elapsed,
+        chunks_per_s=stats["chunks"] / elapsed,
+        vectors_per_s=stats["vectors"] / elapsed,
+    )
+
+def _checkpoint_fingerprint(key, sha):
+    """Everything the saved chunks and vectors of a PDF depend on"""
+    settings = [key, sha, CHUNK_SIZE, CHUNK_OVERLAP, PAGE_RANGE_SIZE, EMBEDDING_MODEL, EMBEDDING_NORMALIZE, EMBEDDING_BACKEND]
+    return hashlib.sha256(json.dumps(settings).encode("utf-8")).hexdigest()
+
+def _ingest(vectordb, entries, items, max_workers=None, progress=None, batch_size=None, checkpoints=None, work_dir=None):
+    """Stream PDFs through extract → split → embed → index in fixed-size batches
+
+    items is a list of (manifest key, pdf path, sha256, roles) in indexing order. The index is
+    created from the first batch if vectordb is None. progress, if given, is called with
+    the current counters after every batch and every finished file. With a checkpoints
+    folder, PDFs of more than PAGE_RANGE_SIZE pages save every page range once it is
+    embedded, and a later ingest of the same file restores those ranges instead of
+    extracting and embedding them again. A new index keeps its chunk store in work_dir
+    until it is saved.
+    """
+    batch_size = batch_size or EMBED_BATCH_SIZE
+    embeddings = get_embeddings()
+    cache = get_embedding_cache()
+    by_path = {pdf_path: (key, sha, roles) for key, pdf_path, sha, roles in items}
+    stats = {
+        "stage": "ingesting", "files_total": len(items), "files_done": 0,
+        "pages": 0, "chunks": 0, "vectors": 0, "cached_vectors": 0, "restored_vectors": 0,
+    }
+    started = time.perf_counter()
+    # (chunk, chunk id, vector if already known, (page range, position in it) if it is checkpointed)
+    pending = []
+    file_ids, file_pages, file_timings = {}, {}, {}
+    processed, failed = [], {}
+    page_checkpoints = {}
+    if checkpoints is not None:
+        page_checkpoints = {key: PageCheckpoint(checkpoints, key, _checkpoint_fingerprint(key, sha)) for key, _, sha, _ in items}
+    # Page ranges being checkpointed, per file and first page
+    open_ranges = {}
+
+    def report():
+        if progress is not None:
+            progress(_progress_snapshot(stats, started))
+
+    def close_range(key, page_range):
+        # Save a range once all its pages are extracted and all its chunks embedded
+        if page_range["pages"] == page_range["stop"] - page_range["start"] and page_range["missing"] == 0:
+            page_checkpoints[key].save(
+                page_range["start"], page_range["stop"], page_range["texts"], page_range["metadatas"], page_range["vectors"]
+            )
+            del open_ranges[key][page_range["start"]]
+
+    def add_batch(batch):
+        nonlocal vectordb
+        texts = [chunk.page_content for chunk, _, _, _ in batch]
+        vectors = [vector for _, _, vector, _ in batch]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            # Chunks embedded by an earlier build are read from the cache, the model only sees the rest
+            with metrics.timed("embed", vectors=len(missing), cached=0) as counters:
+                if cache is None:
+                    computed = embeddings.embed_documents([texts[i] for i in missing])
+                else:
+                    computed, counters["cached"] = cache.embed([texts[i] for i in missing], embeddings.embed_documents)
+                    stats["cached_vectors"] += counters["cached"]
+            if cache is not None and cache.unsaved() >= EMBEDDING_CACHE_FLUSH_ROWS:
+                # Bounds the vectors held until the end of a large ingest, and keeps them if it is interrupted
+                with index_lock("embedding_cache"):
+                    cache.save()
+            for i, vector in zip(missing, computed):
+                vectors[i] = vector
+        stats["restored_vectors"] += len(batch) - len(missing)
+        text_embeddings = list(zip(texts, vectors))
+        metadatas = [chunk.metadata for chunk, _, _, _ in batch]
+        ids = [chunk_id for _, chunk_id, _, _ in batch]
+        with metrics.timed("index_add", vectors=len(ids)):
+            if vectordb is None:
+                vectordb = DocumentIndex.from_embeddings(
+                    text_embeddings, embeddings, metadatas=metadatas, ids=ids, docstore=ChunkStore(folder=work_dir)
+                )
+            else:
+                vectordb.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+        stats["vectors"] += len(batch)
+
+        for (_, _, _, checkpoint), vector in zip(batch, vectors):
+            if checkpoint is not None:
+                key, page_range, position = checkpoint
+                page_range["vectors"][position] = vector
+                page_range["missing"] -= 1
+                close_range(key, page_range)
+        report()
+
+    def queue(key, sha, roles, chunks, vectors=None, page_range=None):
+        ids = file_ids.setdefault(key, [])
+        for i, chunk in enumerate(chunks):
+            checkpoint = None
+            if page_range is not None:
+                page_range["texts"].append(chunk.page_content)
+                page_range["metadatas"].append(dict(chunk.metadata))
+                page_range["vectors"].append(None)
+                page_range["missing"] += 1
+                checkpoint = (key, page_range, len(page_range["texts"]) - 1)
+            # Access roles travel with every chunk, searches filter on them
+            if roles:
+                chunk.metadata["roles"] = roles
+            ids.append(_chunk_id(key, sha, len(ids)))
+            pending.append((chunk, ids[-1], None if vectors is None else vectors[i], checkpoint))
+        while len(pending) >= batch_size:
+            add_batch(pending[:batch_size])
+            del pending[:batch_size]
+
+    def restore(key, sha, roles):
+        # Ranges saved by an interrupted ingest go first, already embedded
+        checkpoint = page_checkpoints.get(key)
+        if checkpoint is None:
+            return
+        for start, stop in checkpoint.ranges():
+            texts, metadatas, vectors = checkpoint.load(start, stop)
+            chunks = [Document(page_content=text, metadata=metadata) for text, metadata in zip(texts, metadatas)]
+            file_pages[key] = file_pages.get(key, 0) + stop - start
+            queue(key, sha, roles, chunks, vectors=vectors)
+
+    tasks = []
+    for key, pdf_path, sha, roles in items:
+        checkpoint = page_checkpoints.get(key)
+        tasks.append((pdf_path, checkpoint.resume_page() if checkpoint is not None else 0))
+    restored = set()
+
+    for event in _iter_extracted(tasks, max_workers=max_workers):
+        kind, pdf_path = event[0], event[1]
+        key, sha, roles = by_path[pdf_path]
+        if key not in restored:
+            restored.add(key)
+            restore(key, sha, roles)
+
+        if kind == "pages":
+            page_count, chunks = event[2], event[3]
+            timings = file_timings.setdefault(key, {"extract": 0.0, "split": 0.0})
+            for stage, seconds in event[4].items():
+                timings[stage] += seconds
+            start, stop, total_pages = event[5]
+            page_range = None
+            if key in page_checkpoints and total_pages > PAGE_RANGE_SIZE:
+                first = start - start % PAGE_RANGE_SIZE
+                page_range = open_ranges.setdefault(key, {}).setdefault(first, {
+                    "start": first, "stop": min(first + PAGE_RANGE_SIZE, total_pages), "pages": 0,
+                    "texts": [], "metadatas": [], "vectors": [], "missing": 0,
+                })
+                page_range["pages"] += stop - start
+            queue(key, sha, roles, chunks, page_range=page_range)
+            if page_range is not None:
+                close_range(key, page_range)
+            file_pages[key] = file_pages.get(key, 0) + page_count
+            stats["pages"] += page_count
+            stats["chunks"] += len(chunks)
+
+        elif kind == "done":
+            entries[key] = _manifest_entry(key, sha, file_pages.get(key, 0), file_ids.get(key, []), roles)
+            timings = file_timings.pop(key, {"extract": 0.0, "split": 0.0})
+            metrics.record("extract", timings["extract"], files=1, pages=file_pages.get(key, 0))
+            metrics.record("split", timings["split"], chunks=len(file_ids.get(key, [])))
+            processed.append(key)
+            stats["files_done"] += 1
+            report()
+
+        else:
+            failed[pdf_path] = event[2]
+            # Forget the failed file's chunks, including any batches already in the index.
+            # Its saved page ranges stay, so the next attempt resumes after them.
+            open_ranges.pop(key, None)
+            stale = set(file_ids.pop(key, []))
+            pending_ids = {chunk_id for _, chunk_id, _, _ in pending}
+            indexed = [chunk_id for chunk_id in stale if chunk_id not in pending_ids]
+            if indexed:
+                vectordb.delete(indexed)
+            pending = [item for item in pending if item[1] not in stale]
+            file_pages.pop(key, None)
+            stats["files_done"] += 1
+            report()
+
+    if pending:
+        add_batch(pending)
+    if cache is not None:
+        with index_lock("embedding_cache"):
+            cache.save()
+    snapshot = _progress_snapshot(stats, started)
+    metrics.record(
+        "ingest", snapshot["elapsed"], files=len(processed), failed=len(failed),
+        pages=stats["pages"], chunks=stats["chunks"], vectors=stats["vectors"], cached=stats["cached_vectors"],
+        restored=stats["restored_vectors"],
+    )
+    metrics.flush()
+    return vectordb, processed, failed, snapshot
+
+def process_and_save_pdfs(pdf_paths=None, index_name="docs_index", rebuild=False, max_workers=None, progress=None, access=None):
+    """Process new or changed PDFs in data folder and merge them into the FAISS index
+
+    Extraction runs on up to max_workers processes (INGEST_WORKERS by default) and
+    chunks are embedded and indexed in batches of EMBED_BATCH_SIZE as they arrive.
+    progress, if given, is called with page, chunk and vector counters and rates.
+    access maps PDF paths to the roles allowed to read them; files not listed keep their
+    current roles, and new files without roles are open to everyone.
+    Returns a report of processed, unchanged, removed and failed files.
+    """
+    with index_lock(index_name):
+        # If no specific paths provided, process all PDFs in data folder
+        if pdf_paths is None:
+            if not os.path.exists(collection_data_dir(index_name)):
+                raise ValueError("Data directory does not exist")
+        
+            pdf_paths = _list_data_pdfs(index_name)
+        else:
+            # Also include existing PDFs in data folder
+            existing_pdfs = _list_data_pdfs(index_name)
+            # Combine new uploads with existing files, remove duplicates
+            all_pdfs = list(set(pdf_paths + existing_pdfs))
+            pdf_paths = all_pdfs
+    
+        if not pdf_paths:
+            raise ValueError("No PDF files found to process")
+
+        paths = _index_paths(index_name)
+        # Roles of the saved index, kept even when a rebuild or mismatch discards its manifest
+        previous_roles = _previous_roles(paths)
+        vectordb, manifest = _open_index(paths, rebuild=rebuild)
+        entries = manifest["files"]
+
+        # Compare content hashes and access roles against the manifest
+        requested_roles = {_manifest_key(pdf_path): _normalize_roles(roles) for pdf_path, roles in (access or {}).items()}
+        current = {}
+        for pdf_path in pdf_paths:
+            if os.path.exists(pdf_path):
+                key = _manifest_key(pdf_path)
+                # Only an explicit access entry may lift a restriction
+                roles = requested_roles[key] if key in requested_roles else previous_roles.get(key)
+                current[key] = (pdf_path, _file_sha256(pdf_path), roles)
+
+        changed = [
+            key for key, (_, sha, roles) in current.items()
+            if entries.get(key, {}).get("sha256") != sha or entries.get(key, {}).get("roles") != roles
+        ]
+        removed = [key for key in entries if key not in current]
+
+        # Drop vectors of files that changed or no longer exist
+        stale_ids = _drop_files(vectordb, entries, changed + removed)
+
+        # Stream only new or changed PDFs into the index, in a fixed order so the contents are reproducible
+        items = [(key,) + current[key] for key in sorted(changed)]
+        vectordb, processed, failed, stats = _ingest(
+            vectordb, entries, items, max_workers=max_workers, progress=progress,
+            checkpoints=paths["checkpoints"], work_dir=paths["work"],
+        )
+        for pdf_path, error in failed.items():
+            print(f"Warning: Could not load {pdf_path}: {error}")
+
+        if not entries:
+            details = "".join(f"\n{path}: {error}" for path, error in failed.items())
+            raise ValueError(f"No content found in PDFs{details}")
+
+        if stats["vectors"] or stale_ids or paths["generation"] is None:
+            if progress is not None:
+                progress(dict(stats, stage="saving"))
+            paths = _save_index(vectordb, manifest, index_name)
+        # Only files that failed can resume, everything else is in the published index
+        prune_checkpoints(paths["checkpoints"], keep=[_manifest_key(pdf_path) for pdf_path in failed])
+
+        total_chunks = sum(len(entry["chunk_ids"]) for entry in entries.values())
+        print(
+            f"Processed {len(processed)} new or changed PDF files ({len(current) - len(changed)} unchanged, "
+            f"{len(removed)} removed, {len(failed)} failed) and created embeddings for {stats['vectors']} chunks "
+            f"({stats['cached_vectors']} from the embedding cache, {stats['restored_vectors']} restored from "
+            f"checkpoints, {total_chunks} chunks in index, "
+            f"{stats['vectors_per_s']:.1f} vectors/s)"
+        )
+        return {
+            "index_path": paths["faiss"],
+            "manifest_path": paths["manifest"],
+            "generation": paths["generation"],
+            "processed": processed,
+            "unchanged": len(current) - len(changed),
+            "removed": removed,
+            "failed": failed,
+            "chunks_added": stats["vectors"],
+            "total_chunks": total_chunks,
+            "stats": stats,
+        }
+
+def remove_pdf(pdf_path, index_name="docs_index", delete_file=True, lock_timeout=None):
+    """Delete a PDF and drop its vectors from the index without rebuilding it
 
-    if not docs:
-        raise ValueError("No content found in PDFs")
+    Its vectors are only marked deleted, see _save_deletion, until they are
+    INDEX_COMPACT_FRACTION of the index or the next ingest rewrites it. Waits up to
+    lock_timeout seconds (forever if None) for a running update of the index.
+    """
+    with index_lock(index_name, timeout=lock_timeout):
+        paths = _index_paths(index_name)
+        key = _manifest_key(pdf_path)
+        manifest = _load_manifest(paths["manifest"])
 
-    # Split docs
-    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
-    chunks = splitter.split_documents(docs)
+        if manifest is not None and key in manifest["files"]:
+            entries = manifest["files"]
+            if len(entries) == 1:
+                # Last document in the index, nothing left to search
+                _delete_index(index_name)
+            elif _embedding_mismatch(manifest) is not None:
+                raise ValueError(f"Index {index_name} was built with a different embedding model, rebuild it first")
+            else:
+                chunk_count = len(entries[key]["chunk_ids"])
+                if _save_deletion(index_name, paths, manifest, key) is None:
+                    vectordb, manifest = _open_index(paths)
+                    if vectordb is None:
+                        raise FileNotFoundError(f"Index {index_name} has no saved vectors, rebuild it first")
+                    _drop_files(vectordb, manifest["files"], [key])
+                    _save_index(vectordb, manifest, index_name)
+                print(f"Removed {chunk_count} chunks of {pdf_path} from {index_name}")
 
-    # Embeddings
-    embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+        shutil.rmtree(checkpoint_folder(paths["checkpoints"], key), ignore_errors=True)
+        if delete_file and os.path.exists(pdf_path):
+            os.remove(pdf_path)
 
-    # Vector DB
-    vectordb = FAISS.from_documents(chunks, embedding=embeddings)
+def replace_pdf(pdf_path, index_name="docs_index"):
+    """Re-index a single PDF in place, replacing the vectors of its previous version"""
+    with index_lock(index_name):
+        if not os.path.exists(pdf_path):
+            raise FileNotFoundError(f"{pdf_path} does not exist")
+
+        paths = _index_paths(index_name)
+        vectordb, manifest = _open_index(paths)
+        if vectordb is None:
+            # No usable index yet, build it from everything in the data folder
+            return process_and_save_pdfs([pdf_path], index_name=index_name)
+        entries = manifest["files"]
+
+        key = _manifest_key(pdf_path)
+        sha = _file_sha256(pdf_path)
+        report = {
+            "index_path": paths["faiss"],
+            "manifest_path": paths["manifest"],
+            "generation": paths["generation"],
+            "processed": [],
+            "unchanged": 0,
+            "removed": [],
+            "failed": {},
+            "chunks_added": 0,
+        }
+        if entries.get(key, {}).get("sha256") == sha:
+            report["unchanged"] = 1
+        else:
+            roles = entries.get(key, {}).get("roles")
+            stale_ids = _drop_files(vectordb, entries, [key])
+            vectordb, processed, failed, stats = _ingest(
+                vectordb, entries, [(key, pdf_path, sha, roles)], checkpoints=paths["checkpoints"], work_dir=paths["work"]
+            )
+            if failed:
+                raise ValueError(f"Could not load {pdf_path}: {failed[pdf_path]}")
+            paths = _save_index(vectordb, manifest, index_name)
+            prune_checkpoints(paths["checkpoints"])
+            report.update(index_path=paths["faiss"], manifest_path=paths["manifest"], generation=paths["generation"])
+
+            print(f"Replaced {len(stale_ids)} chunks of {pdf_path} with {stats['vectors']} new chunks")
+            report["processed"] = processed
+            report["chunks_added"] = stats["vectors"]
+            report["stats"] = stats
+
+        report["total_chunks"] = sum(len(entry["chunk_ids"]) for entry in entries.values())
+        return report
+
+@contextmanager
+def index_lock(index_name="docs_index", timeout=None):
+    """Exclusive lock on an index across threads and processes
+
+    Held by every writer of the index. It is an OS file lock, so it is released
+    even if the holder crashes. Re-entrant within a thread. Raises TimeoutError
+    if the lock is not free within timeout seconds (wait forever if None).
+    """
+    held = _lock_state.__dict__.setdefault("held", set())
+    if index_name in held:
+        yield
+        return
 
-    # Save FAISS index
     os.makedirs(EMBEDDINGS_DIR, exist_ok=True)
-    faiss_path = os.path.join(EMBEDDINGS_DIR, f"{index_name}.faiss")
-    pkl_path = os.path.join(EMBEDDINGS_DIR, f"{index_name}.pkl")
+    lock_file = open(os.path.join(EMBEDDINGS_DIR, f"{index_name}.lock"), "a+")
+    deadline = None if timeout is None else time.monotonic() + timeout
+    try:
+        while True:
+            try:
+                _lock_file(lock_file)
+                break
+            except OSError:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise TimeoutError(f"Index {index_name} is being updated, please try again shortly")
+                time.sleep(0.2)
 
-    vectordb.save_local(faiss_path)
-    with open(pkl_path, "wb") as f:
-        pickle.dump(embeddings, f)
+        held.add(index_name)
+        try:
+            yield
+        finally:
+            held.discard(index_name)
+            _unlock_file(lock_file)
+    finally:
+        lock_file.close()
 
-    print(f"Processed {len(pdf_paths)} PDF files and created embeddings for {len(chunks)} chunks")
-    return faiss_path, pkl_path
+def _lock_file(lock_file):
+    """Take a non-blocking exclusive OS lock, raising OSError if it is held elsewhere"""
+    if os.name == "nt":
+        import msvcrt
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+def _unlock_file(lock_file):
+    """Release a lock taken by _lock_file"""
+    if os.name == "nt":
+        import msvcrt
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
 
 def rebuild_embeddings_for_all_docs(index_name="docs_index"):
-    """Rebuild embeddings for all documents in data folder"""
-    return process_and_save_pdfs(pdf_paths=None, index_name=index_name)
+    """Rebuild embeddings for all documents in the collection's data folder from scratch"""
+    return process_and_save_pdfs(pdf_paths=None, index_name=index_name, rebuild=True)
+
+def migrate_chunk_store(index_name="docs_index"):
+    """Move the chunks of an index saved with a pickled docstore into a chunk store
+
+    Publishes the converted index as a new generation, so earlier generations remain
+    available for rollback. An unversioned index saved without a manifest gets one built
+    from its chunks. Returns False if the index already has a chunk store.
+    """
+    with index_lock(index_name):
+        paths = _index_paths(index_name)
+        vectordb, manifest = _open_index(paths)
+        # Saved by FAISS.save_local before manifests existed
+        legacy = paths["generation"] is None and os.path.exists(os.path.join(paths["faiss"], "index.pkl"))
+        if vectordb is None and legacy and _load_manifest(paths["manifest"]) is None:
+            vectordb = DocumentIndex.load_local(
+                paths["faiss"], get_embeddings(), work_dir=paths["work"], allow_dangerous_deserialization=True
+            )
+            manifest = _legacy_manifest(vectordb)
+        if vectordb is None:
+            raise FileNotFoundError(f"No usable index {index_name} to migrate")
+        if isinstance(vectordb.docstore, ChunkStore):
+            print(f"{index_name} already keeps its chunks in a chunk store")
+            return False
+        paths = _save_index(vectordb, manifest, index_name)
+        print(f"Moved {len(vectordb.index_to_docstore_id)} chunks of {index_name} into a chunk store (generation {paths['generation']})")
+        return True
+
+def _legacy_manifest(vectordb):
+    """Manifest of an index saved before manifests existed, with one entry per source PDF
+
+    The index does not record which version of each PDF it holds, so the entries have no
+    hash and the next ingest embeds the files again.
+    """
+    print("Warning: The index has no manifest, assuming it was built with the configured embedding model")
+    ids = list(vectordb.index_to_docstore_id.values())
+    files = {}
+    for id_, doc in zip(ids, vectordb._documents(ids)):
+        key = _manifest_key(doc.metadata["source"])
+        entry = files.setdefault(key, _manifest_entry(key, None, 0, []))
+        entry["chunk_ids"].append(id_)
+        entry["pages"] = max(entry["pages"], doc.metadata.get("total_pages", doc.metadata.get("page", -1) + 1))
+    return {"files": files}
+
+def load_vectordb(index_name="docs_index", nprobe=None, ef_search=None, mode=None):
+    """Load FAISS index, refusing indexes built with a different embedding model
 
-def load_vectordb(index_name="docs_index"):
-    """Load FAISS index"""
-    faiss_path = os.path.join(EMBEDDINGS_DIR, f"{index_name}.faiss")
-    pkl_path = os.path.join(EMBEDDINGS_DIR, f"{index_name}.pkl")
+    nprobe (IVF indexes) and ef_search (HNSW) override the search settings stored with
+    the index, trading recall for query latency. mode "mmap" (the INDEX_LOAD_MODE default)
+    maps the read-only serving copy, "memory" reads the full index for changing it.
+    """
+    mode = mode or INDEX_LOAD_MODE
+    if mode not in INDEX_LOAD_MODES:
+        raise ValueError(f"Unknown load mode {mode}, expected one of {', '.join(INDEX_LOAD_MODES)}")
+    # Resolve the generation once; a build published meanwhile goes to other files
+    paths = _index_paths(index_name)
+    version = paths["generation"] or _legacy_version(paths)
+    manifest = _load_manifest(paths["manifest"])
 
-    if not os.path.exists(faiss_path) or not os.path.exists(pkl_path):
+    if manifest is None or not os.path.exists(paths["faiss"]):
         raise FileNotFoundError("No embeddings found. Please upload PDFs in admin panel first.")
 
-    with open(pkl_path, "rb") as f:
-        embeddings = pickle.load(f)
+    mismatch = _embedding_mismatch(manifest)
+    if mismatch is not None:
+        raise ValueError(f"Index {index_name} cannot be used because {mismatch}. Please rebuild the embeddings.")
 
-    vectordb = FAISS.load_local(faiss_path, embeddings, allow_dangerous_deserialization=True)
+    with metrics.timed("load", vectors=0) as counters:
+        vectordb = DocumentIndex.load_local(
+            paths["faiss"], get_embeddings(), mmap=mode == "mmap", allow_dangerous_deserialization=True
+        )
+        counters["vectors"] = vectordb.index.ntotal
+    if vectordb.index.d != manifest["embedding"]["dimension"]:
+        raise ValueError(f"Index {index_name} does not match its metadata. Please rebuild the embeddings.")
+    _configure_search(vectordb.index, nprobe=nprobe, ef_search=ef_search)
+    vectordb.index_name = index_name
+    vectordb.version = version
     return vectordb
 
-def get_qa_chain(vectordb):
-    """QA Chain with memory and custom prompt for natural responses"""
-    llm = ChatGroq(
-        model="llama3-70b-8192",
-        groq_api_key=groq_api_key,
-        temperature=0.1
-    )
+def index_version(index_name="docs_index"):
+    """Version stamp of the saved index, changes whenever a generation is published or rolled back"""
+    paths = _index_paths(index_name)
+    return paths["generation"] or _legacy_version(paths)
+
+def _legacy_version(paths):
+    """Version stamp of an unversioned index"""
+    # The manifest is written last on every save, so its mtime marks a new version
+    if not os.path.exists(paths["legacy_manifest"]):
+        return None
+    stat = os.stat(paths["legacy_manifest"])
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+def get_shared_vectordb(index_name="docs_index"):
+    """Process-wide FAISS index shared by all sessions, reloaded when a new version is published"""
+    version = index_version(index_name)
+    if version is None:
+        raise FileNotFoundError("No embeddings found. Please upload PDFs in admin panel first.")
+
+    cached = _shared_vectordbs.get(index_name)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    with _shared_lock:
+        cached = _shared_vectordbs.get(index_name)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        try:
+            vectordb = load_vectordb(index_name)
+        except Exception as e:
+            if cached is None:
+                raise
+            # e.g. a generation built with another model was published, keep serving the previous one
+            print(f"Warning: Could not reload {index_name}, serving previous version: {str(e)}")
+            return cached[1]
+        # Swap in the new index in one step, sessions pick it up on their next call
+        _shared_vectordbs[index_name] = (vectordb.version, vectordb)
+        return vectordb
+
+def get_federated_vectordb(collections=None):
+    """Shared index searching the given collections, all of them if None
+
+    A single collection is served by its shared DocumentIndex. Collections without an index
+    yet are skipped, FileNotFoundError if none has one. The same FederatedIndex is returned
+    until one of its collections publishes a new version, so sessions can tell when to refresh.
+    """
+    indexes = {}
+    for name in sorted(set(collections or list_collections())):
+        try:
+            indexes[name] = get_shared_vectordb(name)
+        except FileNotFoundError:
+            continue
+    if not indexes:
+        raise FileNotFoundError("No embeddings found. Please upload PDFs in admin panel first.")
+    if len(indexes) == 1:
+        return next(iter(indexes.values()))
+
+    key = tuple(indexes)
+    with _shared_lock:
+        cached = _federated_vectordbs.get(key)
+        if cached is None or any(cached.indexes[name] is not index for name, index in indexes.items()):
+            cached = _federated_vectordbs[key] = FederatedIndex(indexes)
+    return cached
+
+def get_llm():
+    """Process-wide Groq chat client"""
+    global _llm
+    with _shared_lock:
+        if _llm is None:
+            _llm = ChatGroq(
+                model="llama3-70b-8192",
+                groq_api_key=groq_api_key,
+                temperature=0.1
+            )
+    return _llm
+
+def get_answer_cache(index_name="docs_index", roles=None):
+    """Process-wide answer cache of an index, persisted next to it
+
+    Callers restricted to roles get a cache of their own, so answers never cross role sets.
+    """
+    roles = None if roles is None else tuple(sorted(set(roles)))
+    with _shared_lock:
+        cache = _answer_caches.get((index_name, roles))
+        if cache is None:
+            path = _index_paths(index_name)["answer_cache"]
+            if roles is not None:
+                digest = hashlib.sha256("\n".join(roles).encode("utf-8")).hexdigest()[:12]
+                path = path.replace(".answers.json", f".answers.{digest}.json")
+            cache = AnswerCache(path)
+            _answer_caches[(index_name, roles)] = cache
+    return cache
+
+def get_context_cache():
+    """Process-wide cache of packed contexts, see ContextCache"""
+    return _context_cache
+
+def needs_condensing(question):
+    """True if a follow-up question refers back to earlier turns and cannot be retrieved on alone"""
+    words = re.findall(r"[a-z']+", question.lower())
+    if len(words) < 4 or question.rstrip().endswith(("...", "…")):
+        return True
+    if words[0] in FOLLOW_UP_OPENERS or " ".join(words[:2]) in FOLLOW_UP_OPENERS:
+        return True
+    for i, word in enumerate(words):
+        if word in REFERRING_WORDS:
+            return True
+        # "that" is only a reference when it stands for a noun, not when it starts a clause
+        if word == "that" and (i == len(words) - 1 or (i > 0 and words[i - 1] in THAT_REFERENCE_PRECEDERS)):
+            return True
+    return False
+
+class AnswerStream:
+    """Answer tokens as the LLM produces them
+
+    Iterate to receive the tokens; once exhausted, result holds the same dict the chain
+    returns when called, including source documents and timings.
+    """
+
+    def __init__(self, run):
+        self.result = None
+        self.started = time.perf_counter()
+        self.first_token_at = None
+        self._tokens = run(self)
+
+    def __iter__(self):
+        try:
+            for token in self._tokens:
+                if self.first_token_at is None:
+                    self.first_token_at = time.perf_counter()
+                yield token
+        finally:
+            # A reader that stops early must still release callers waiting on this answer
+            self._tokens.close()
+
+class CachedQAChain:
+    """Conversational QA chain that answers near-duplicate questions from the answer cache
+
+    Called like the chain it wraps, or token by token with stream(); results carry "cached"
+    and "coalesced" flags and per-stage timings in seconds. rewrite_mode decides when follow-up
+    questions are condensed by the LLM: "llm" always, "never", or "heuristic" only when they
+    refer back to earlier turns. context_mode "packed" over-fetches CONTEXT_FETCH_K chunks and
+    packs them into context_budget tokens (see pack_context); "stuff" uses the retriever's k.
+    """
+
+    def __init__(
+        self, chain, vectordb, memory, cache=None, rewrite_mode=QUERY_REWRITE_MODE, retrieval_mode=RETRIEVAL_MODE, roles=None,
+        context_mode=CONTEXT_MODE, context_budget=CONTEXT_TOKEN_BUDGET, query_embeddings=None,
+    ):
+        if rewrite_mode not in QUERY_REWRITE_MODES:
+            raise ValueError(f"Unknown query rewrite mode {rewrite_mode}, expected one of {', '.join(QUERY_REWRITE_MODES)}")
+        if retrieval_mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode {retrieval_mode}, expected one of {', '.join(RETRIEVAL_MODES)}")
+        if context_mode not in CONTEXT_MODES:
+            raise ValueError(f"Unknown context mode {context_mode}, expected one of {', '.join(CONTEXT_MODES)}")
+        self.chain = chain
+        self.vectordb = vectordb
+        self.cache = cache
+        self.rewrite_mode = rewrite_mode
+        # Hybrid retrieval needs the BM25 index that only DocumentIndex maintains
+        self.retrieval_mode = retrieval_mode if isinstance(vectordb, (DocumentIndex, FederatedIndex)) else "vector"
+        if roles is not None and not isinstance(vectordb, (DocumentIndex, FederatedIndex)):
+            raise ValueError("Access roles can only be enforced on a DocumentIndex or FederatedIndex")
+        self.roles = roles
+        self.context_mode = context_mode
+        self.context_budget = context_budget
+        self.memory = memory
+        self.version = getattr(vectordb, "version", None)
+        # Must embed like the index's embeddings, e.g. a wrapper that batches concurrent queries
+        self.query_embeddings = query_embeddings or vectordb.embeddings
+
+    def _rewrite(self, question, messages, chat_history):
+        """Question for the answer prompt, retrieval query, cache key text and whether the LLM condensed it"""
+        if not chat_history:
+            return question, question, question, False
+        if self.rewrite_mode == "llm" or (self.rewrite_mode == "heuristic" and needs_condensing(question)):
+            # Same condensing step as ConversationalRetrievalChain, so the cache key is self-contained
+            generator = self.chain.question_generator
+            standalone = generator.invoke({"question": question, "chat_history": chat_history})[generator.output_key]
+            return standalone, standalone, standalone, True
+
+        # No LLM round trip: retrieve on the question plus the previous user turns
+        recent = [message.content for message in messages if message.type == "human"][-REWRITE_CONTEXT_TURNS:]
+        query = "\n".join(recent + [question])
+        # A question without references stands on its own, so it can share answers with other sessions
+        return question, query, question if self.rewrite_mode == "heuristic" else query, False
+
+    def _generate(self, question, query, query_vector, cache_vector, chat_history, timings, usage):
+        """Yield answer tokens, returning the answer, its sources and whether it came from the cache"""
+        if self.cache is not None:
+            # Another caller may have stored the answer while this one waited
+            entry = self.cache.lookup(cache_vector, self.version, count=False)
+            if entry is not None:
+                yield entry["answer"]
+                return entry["answer"], entry["source_documents"], True
+
+        docs = self._context(query, query_vector, timings)
+
+        # Fill the combine-documents prompt ourselves so the LLM output can be streamed
+        combine = self.chain.combine_docs_chain
+        context = combine.document_separator.join(format_document(doc, combine.document_prompt) for doc in docs)
+        usage["context_tokens"] = count_tokens(context)
+        prompt = combine.llm_chain.prompt.format_prompt(
+            **{combine.document_variable_name: context, "question": question, "chat_history": chat_history}
+        )
+        usage["prompt_tokens"] = count_tokens(prompt.to_string())
+        parts = []
+        started = time.perf_counter()
+        for chunk in combine.llm_chain.llm.stream(prompt):
+            # Prefer the provider's own count when it reports one
+            if getattr(chunk, "usage_metadata", None):
+                usage["prompt_tokens"] = chunk.usage_metadata["input_tokens"]
+            if chunk.content:
+                parts.append(chunk.content)
+                yield chunk.content
+        answer = "".join(parts)
+        timings["generate"] = time.perf_counter() - started
+        usage["answer_tokens"] = count_tokens(answer)
+
+        if self.cache is not None:
+            self.cache.store(question, cache_vector, answer, docs, self.version)
+        return answer, docs, False
+
+    def _retrieve(self, query, query_vector, k):
+        # Reuse the question embedding instead of letting the retriever embed it again
+        if self.retrieval_mode == "hybrid":
+            return self.vectordb.hybrid_search_by_vector(query, query_vector, k=k, roles=self.roles)
+        if isinstance(self.vectordb, (DocumentIndex, FederatedIndex)):
+            return self.vectordb.vector_search(query_vector, k=k, roles=self.roles)
+        return self.vectordb.similarity_search_by_vector(query_vector, k=k)
+
+    def _context(self, query, query_vector, timings):
+        """Documents for the answer prompt, packed and cached per query embedding in "packed" mode"""
+        started = time.perf_counter()
+        if self.context_mode == "stuff":
+            docs = self._retrieve(query, query_vector, self.chain.retriever.search_kwargs.get("k", 4))
+            timings["retrieve"] = time.perf_counter() - started
+            return docs
+
+        # Hybrid results depend on the query text too, so it is part of the key
+        key = None
+        if self.version is not None:
+            key = ContextCache.key(
+                self.version, self.roles, query_vector, self.retrieval_mode,
+                query if self.retrieval_mode == "hybrid" else None, self.context_budget,
+            )
+            docs = _context_cache.get(key)
+            if docs is not None:
+                timings["retrieve"] = time.perf_counter() - started
+                return docs
+        docs = self._retrieve(query, query_vector, CONTEXT_FETCH_K)
+        timings["retrieve"] = time.perf_counter() - started
+        started = time.perf_counter()
+        docs = pack_context(docs, self.context_budget, max_overlap=CHUNK_OVERLAP)
+        timings["pack"] = time.perf_counter() - started
+        if key is not None:
+            _context_cache.put(key, docs)
+        return docs
+
+    def _run(self, stream, inputs):
+        question = inputs["question"]
+        timings = {}
+        usage = {"prompt_tokens": 0}
+        get_chat_history = self.chain.get_chat_history or _get_chat_history
+        messages = self.memory.load_memory_variables({})["chat_history"]
+        chat_history = get_chat_history(messages)
+        usage["history_tokens"] = count_tokens(chat_history)
+        standalone, query, cache_text, condensed = self._rewrite(question, messages, chat_history)
+        timings["condense"] = time.perf_counter() - stream.started
+
+        started = time.perf_counter()
+        query_vector = self.query_embeddings.embed_query(query)
+        cache_vector = query_vector if cache_text == query else self.query_embeddings.embed_query(cache_text)
+        timings["embed"] = time.perf_counter() - started
+
+        entry = self.cache.lookup(cache_vector, self.version) if self.cache is not None else None
+        coalesced = False
+        if entry is not None:
+            answer, docs, cached = entry["answer"], entry["source_documents"], True
+            yield answer
+        elif self.cache is not None:
+            key = (self.version, normalize_question(cache_text))
+            call, owner = self.cache.join(key)
+            if owner:
+                try:
+                    answer, docs, cached = yield from self._generate(
+                        standalone, query, query_vector, cache_vector, chat_history, timings, usage
+                    )
+                except BaseException as e:
+                    if not isinstance(e, Exception):
+                        e = RuntimeError("The answer was abandoned before it was complete")
+                    self.cache.finish(key, call, error=e)
+                    raise
+                self.cache.finish(key, call, (answer, docs, cached))
+            else:
+                # Identical question already in flight, wait for its answer instead of asking the LLM again
+                answer, docs, cached = self.cache.wait(call)
+                coalesced = True
+                yield answer
+        else:
+            answer, docs, cached = yield from self._generate(
+                standalone, query, query_vector, cache_vector, chat_history, timings, usage
+            )
+
+        self.memory.save_context({"question": question}, {"answer": answer})
+        finished = time.perf_counter()
+        timings["time_to_first_token"] = (stream.first_token_at or finished) - stream.started
+        timings["total"] = finished - stream.started
+        _answer_timings.append(dict(timings, rewrite_mode=self.rewrite_mode, condensed=condensed, **usage))
+        self._record_metrics(timings, usage, condensed, cached, coalesced)
+        stream.result = {
+            "question": question,
+            "generated_question": standalone,
+            "retrieval_query": query,
+            "rewrite_mode": self.rewrite_mode,
+            "condensed": condensed,
+            "answer": answer,
+            "source_documents": docs,
+            "cached": cached,
+            "coalesced": coalesced,
+            "timings": timings,
+            "usage": usage,
+        }
+
+    def _record_metrics(self, timings, usage, condensed, cached, coalesced):
+        metrics.record("condense", timings["condense"], condensed=int(condensed))
+        metrics.record("query_embed", timings["embed"])
+        if "retrieve" in timings:
+            metrics.record("retrieve", timings["retrieve"])
+        if "pack" in timings:
+            metrics.record("pack", timings["pack"], context_tokens=usage["context_tokens"])
+        if "generate" in timings:
+            metrics.record(
+                "generate", timings["generate"],
+                prompt_tokens=usage["prompt_tokens"], answer_tokens=usage.get("answer_tokens", 0),
+            )
+        metrics.record("first_token", timings["time_to_first_token"])
+        metrics.record(
+            "answer", timings["total"], history_tokens=usage["history_tokens"],
+            cache_hits=int(cached and not coalesced), coalesced=int(coalesced),
+        )
+        metrics.flush(wait=False)
+
+    def stream(self, inputs):
+        """Stream the answer to inputs["question"], see AnswerStream"""
+        return AnswerStream(lambda stream: self._run(stream, inputs))
+
+    def __call__(self, inputs):
+        stream = self.stream(inputs)
+        for _ in stream:
+            pass
+        return stream.result
+
+    invoke = __call__
+
+def answer_timings(rewrite_mode=None):
+    """Median and 95th percentile of the per-stage timings of recent answers, in seconds
+
+    Pass a rewrite mode to compare the latency of the query rewriting modes. Token counts of
+    the chat history and the answer prompt are summarized the same way.
+    """
+    recent = [timings for timings in _answer_timings if rewrite_mode in (None, timings["rewrite_mode"])]
+    summary = {"answers": len(recent), "condensed": sum(timings["condensed"] for timings in recent)}
+    for stage in (
+        "condense", "embed", "retrieve", "pack", "generate", "time_to_first_token", "total",
+        "history_tokens", "context_tokens", "prompt_tokens",
+    ):
+        values = [timings[stage] for timings in recent if stage in timings]
+        if values:
+            summary[stage] = {"p50": float(np.percentile(values, 50)), "p95": float(np.percentile(values, 95))}
+    return summary
+
+def clean_response_stream(tokens, phrases=RESPONSE_FILLER_PHRASES):
+    """Remove filler phrases from streamed text, even when a phrase is split across tokens"""
+    buffer = ""
+    for token in tokens:
+        buffer += token
+        for phrase in phrases:
+            buffer = buffer.replace(phrase, "")
+        # Hold back any tail that could still grow into a phrase
+        hold = 0
+        for phrase in phrases:
+            for size in range(min(len(phrase) - 1, len(buffer)), hold, -1):
+                if phrase.startswith(buffer[-size:]):
+                    hold = size
+                    break
+        if len(buffer) > hold:
+            yield buffer[:len(buffer) - hold]
+            buffer = buffer[len(buffer) - hold:]
+    if buffer:
+        yield buffer
+
+def get_qa_chain(
+    vectordb, memory=None, use_cache=True, rewrite_mode=None, retrieval_mode=None, roles=None, llm=None,
+    context_mode=None, context_budget=None, query_embeddings=None,
+):
+    """QA Chain with memory and custom prompt for natural responses
+
+    Pass the memory of a previous chain to keep the conversation when the index is reloaded.
+    Answers are cached per index version unless use_cache is False. rewrite_mode,
+    retrieval_mode, context_mode and context_budget override QUERY_REWRITE_MODE,
+    RETRIEVAL_MODE, CONTEXT_MODE and CONTEXT_TOKEN_BUDGET, see CachedQAChain.
+    With roles, retrieval only sees documents open to everyone or to one of those roles;
+    roles=None is unrestricted. llm replaces the Groq model, for example with the offline
+    stand-in of the benchmarks. query_embeddings embeds questions instead of the index's
+    embeddings, for example a QueryBatcher shared by the sessions of the query API.
+    """
+    llm = llm or get_llm()
 
     # Custom prompt template for more natural responses
     custom_prompt = PromptTemplate(
@@ -116,18 +2321,21 @@ Answer: """,
         input_variables=["context", "chat_history", "question"]
     )
 
-    memory = ConversationBufferMemory(
-        memory_key="chat_history",
-        return_messages=True,
-        output_key="answer"
-    )
+    # Older turns are folded into a summary so prompts stay within a fixed token budget
+    if memory is None:
+        memory = TokenBudgetMemory(llm)
 
     qa_chain = ConversationalRetrievalChain.from_llm(
         llm=llm,
         retriever=vectordb.as_retriever(search_kwargs={"k": 3}),
-        memory=memory,
         return_source_documents=True,
         combine_docs_chain_kwargs={"prompt": custom_prompt}
     )
 
-    return qa_chain
\ No newline at end of file
+    index_name = getattr(vectordb, "index_name", None)
+    roles = None if roles is None else sorted(set(roles))
+    cache = get_answer_cache(index_name, roles) if use_cache and index_name is not None else None
+    return CachedQAChain(
+        qa_chain, vectordb, memory, cache, rewrite_mode or QUERY_REWRITE_MODE, retrieval_mode or RETRIEVAL_MODE, roles,
+        context_mode or CONTEXT_MODE, context_budget or CONTEXT_TOKEN_BUDGET, query_embeddings,
+    )
\ No newline at end of file
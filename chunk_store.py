@@ -0,0 +1,175 @@
+import os
+import json
+import uuid
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import threading
+import weakref
+from urllib.request import pathname2url
+from langchain_community.docstore.base import AddableMixin, Docstore
+from langchain_core.documents import Document
+
+# Ids per statement when reading or deleting many chunks, below SQLite's variable limit
+CHUNK_STORE_BATCH = 500
+# Page cache of each connection in KiB; lookups only touch the pages of the hits
+CHUNK_STORE_CACHE_KB = int(os.getenv("CHUNK_STORE_CACHE_KB", 2048))
+
+def _remove_file(path):
+    for suffix in ("", "-journal"):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+class ChunkStore(Docstore, AddableMixin):
+    """Chunk texts and metadata in an SQLite file, read by id only for the chunks a search hits
+
+    A store opened on a saved file never writes to it, so saved generations stay immutable:
+    the first add or delete copies the file to a private working file in folder (the temp
+    folder by default), and save moves the working file into place. An unchanged store is
+    saved as a hard link. A store without a path starts empty in a working file in folder.
+    """
+
+    def __init__(self, path=None, folder=None):
+        self._lock = threading.Lock()
+        self.path = path
+        self.folder = folder or tempfile.gettempdir()
+        self._work = None
+        self._cleanup = None
+        if path is None:
+            self._open_work(None)
+        else:
+            # immutable: no locking or change detection, the file is never modified once saved
+            uri = f"file:{pathname2url(os.path.abspath(path))}?mode=ro&immutable=1"
+            self._conn = self._connect(uri, uri=True)
+
+    @staticmethod
+    def _connect(target, uri=False):
+        conn = sqlite3.connect(target, uri=uri, check_same_thread=False)
+        conn.execute(f"PRAGMA cache_size=-{CHUNK_STORE_CACHE_KB}")
+        return conn
+
+    def _open_work(self, source):
+        """Switch to a private working file, a copy of source if given"""
+        os.makedirs(self.folder, exist_ok=True)
+        work = os.path.join(self.folder, f".chunks-{uuid.uuid4().hex}.work.sqlite")
+        if source is not None:
+            shutil.copyfile(source, work)
+        conn = self._connect(work)
+        # The working file is thrown away on failure, so it needs no durability
+        conn.execute("PRAGMA journal_mode=MEMORY")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("CREATE TABLE IF NOT EXISTS chunks (id TEXT PRIMARY KEY, text TEXT NOT NULL, metadata TEXT NOT NULL)")
+        conn.commit()
+        self._conn = conn
+        self._work = work
+        self._cleanup = weakref.finalize(self, _remove_file, work)
+
+    def _writable(self):
+        if self._work is None:
+            self._conn.close()
+            self._open_work(self.path)
+        return self._conn
+
+    def add(self, texts):
+        """Add documents by id, ValueError if any id is already stored"""
+        rows = [(id_, doc.page_content, json.dumps(doc.metadata)) for id_, doc in texts.items()]
+        with self._lock:
+            conn = self._writable()
+            try:
+                with conn:
+                    conn.executemany("INSERT INTO chunks (id, text, metadata) VALUES (?, ?, ?)", rows)
+            except sqlite3.IntegrityError:
+                raise ValueError("Tried to add ids that already exist")
+
+    def delete(self, ids):
+        ids = list(ids)
+        with self._lock:
+            conn = self._writable()
+            deleted = 0
+            with conn:
+                for start in range(0, len(ids), CHUNK_STORE_BATCH):
+                    batch = ids[start:start + CHUNK_STORE_BATCH]
+                    deleted += conn.execute(f"DELETE FROM chunks WHERE id IN ({','.join('?' * len(batch))})", batch).rowcount
+        if not deleted:
+            raise ValueError(f"Tried to delete ids that do not exist: {ids}")
+
+    def search(self, search):
+        with self._lock:
+            row = self._conn.execute("SELECT text, metadata FROM chunks WHERE id = ?", (search,)).fetchone()
+        if row is None:
+            return f"ID {search} not found."
+        return Document(page_content=row[0], metadata=json.loads(row[1]))
+
+    def iter_rows(self, ids):
+        """(text, metadata JSON) of ids in order, read CHUNK_STORE_BATCH at a time; KeyError for unknown ids"""
+        ids = list(ids)
+        for start in range(0, len(ids), CHUNK_STORE_BATCH):
+            batch = ids[start:start + CHUNK_STORE_BATCH]
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT id, text, metadata FROM chunks WHERE id IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+            found = {id_: (text, metadata) for id_, text, metadata in rows}
+            for id_ in batch:
+                yield found[id_]
+
+    def iter_documents(self, ids):
+        """Documents of ids in order, see iter_rows"""
+        for text, metadata in self.iter_rows(ids):
+            yield Document(page_content=text, metadata=json.loads(metadata))
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def save(self, path):
+        """Write the store to path and keep reading it from there"""
+        with self._lock:
+            tmp_path = f"{path}.tmp"
+            if self._work is not None:
+                self._conn.commit()
+                self._conn.close()
+                # A rename, unless folder is on another file system
+                shutil.move(self._work, tmp_path)
+                self._cleanup.detach()
+                self._work = None
+            else:
+                self._conn.close()
+                try:
+                    os.link(self.path, tmp_path)
+                except OSError:
+                    shutil.copyfile(self.path, tmp_path)
+            os.replace(tmp_path, path)
+            self.path = path
+            uri = f"file:{pathname2url(os.path.abspath(path))}?mode=ro&immutable=1"
+            self._conn = self._connect(uri, uri=True)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+            if self._cleanup is not None:
+                self._cleanup()
+
+    @classmethod
+    def copy_of(cls, docstore, ids, folder=None):
+        """New store holding the documents of ids from another docstore, e.g. an unpickled InMemoryDocstore"""
+        store = cls(folder=folder)
+        ids = list(ids)
+        for start in range(0, len(ids), CHUNK_STORE_BATCH):
+            store.add({id_: docstore.search(id_) for id_ in ids[start:start + CHUNK_STORE_BATCH]})
+        return store
+
+if __name__ == "__main__":
+    from chatpdf import list_collections, migrate_chunk_store
+
+    parser = argparse.ArgumentParser(description="Move the chunks of indexes saved with a pickled docstore into chunk stores")
+    parser.add_argument("indexes", nargs="*", help="indexes to migrate, every collection by default")
+    args = parser.parse_args()
+    for index_name in args.indexes or list_collections():
+        try:
+            migrate_chunk_store(index_name)
+        except FileNotFoundError as e:
+            print(f"Warning: Skipped {index_name}: {str(e)}")
@@ -0,0 +1,175 @@
+import os
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from langchain_core.documents import Document
+from chat_memory import count_tokens, _truncate_tokens
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 720))
+CONTEXT_FETCH_K = int(os.getenv("CONTEXT_FETCH_K", 12))
+# Weight of relevance against novelty when ordering passages, 1.0 ignores diversity
+CONTEXT_DIVERSITY_LAMBDA = float(os.getenv("CONTEXT_DIVERSITY_LAMBDA", 0.7))
+CONTEXT_CACHE_SIZE = int(os.getenv("CONTEXT_CACHE_SIZE", 256))
+# Shortest text shared by the end of one chunk and the start of another that counts as overlap
+MIN_OVERLAP_CHARS = 20
+# Consecutive chunks of a page are separated only by the whitespace the splitter stripped,
+# so chunks this close are neighbours rather than chunks with another one between them
+MAX_GAP_CHARS = 8
+
+_WORD_PATTERN = re.compile(r"\w+")
+
+def _overlap(left, right, max_chars):
+    """Length of the longest end of left that right starts with, 0 if under MIN_OVERLAP_CHARS"""
+    if len(right) < MIN_OVERLAP_CHARS:
+        return 0
+    head = right[:MIN_OVERLAP_CHARS]
+    position = left.find(head, max(len(left) - max_chars, 0))
+    while position != -1:
+        if right.startswith(left[position:]):
+            return len(left) - position
+        position = left.find(head, position + 1)
+    return 0
+
+def _merge_positioned(passages):
+    """Merge passages of one page by their start offsets"""
+    passages.sort(key=lambda passage: passage["start"])
+    merged = [passages[0]]
+    for passage in passages[1:]:
+        last = merged[-1]
+        end = last["start"] + len(last["text"])
+        if passage["start"] > end + MAX_GAP_CHARS:
+            merged.append(passage)
+            continue
+        if passage["start"] > end:
+            last["text"] += "\n" + passage["text"]
+        else:
+            last["text"] += passage["text"][end - passage["start"]:]
+        last["rank"] = min(last["rank"], passage["rank"])
+    return merged
+
+def _merge_by_text(passages, max_overlap):
+    """Merge passages of one page whose texts overlap, for chunks saved without start offsets"""
+    merged = []
+    for passage in sorted(passages, key=lambda passage: passage["rank"]):
+        for other in merged:
+            if passage["text"] in other["text"]:
+                break
+            if other["text"] in passage["text"]:
+                other["text"] = passage["text"]
+                break
+            size = _overlap(other["text"], passage["text"], max_overlap)
+            if size:
+                other["text"] += passage["text"][size:]
+                break
+            size = _overlap(passage["text"], other["text"], max_overlap)
+            if size:
+                other["text"] = passage["text"] + other["text"][size:]
+                break
+        else:
+            merged.append(passage)
+    return merged
+
+def merge_chunks(docs, max_overlap):
+    """Merge retrieved chunks that overlap or touch on the same page into passages
+
+    Each passage keeps the metadata and rank of its best ranked chunk. max_overlap is
+    the splitter's chunk overlap in characters.
+    """
+    pages = {}
+    for rank, doc in enumerate(docs):
+        metadata = doc.metadata
+        passage = {"text": doc.page_content, "rank": rank, "start": metadata.get("start_index"), "metadata": metadata}
+        pages.setdefault((metadata.get("source"), metadata.get("page")), []).append(passage)
+
+    passages = []
+    for page in pages.values():
+        if all(passage["start"] is not None for passage in page):
+            passages.extend(_merge_positioned(page))
+        else:
+            passages.extend(_merge_by_text(page, max_overlap))
+    for passage in passages:
+        passage["metadata"] = docs[passage["rank"]].metadata
+    return sorted(passages, key=lambda passage: passage["rank"])
+
+def _diverse_order(passages, diversity):
+    """Order passages by maximal marginal relevance, with rank for relevance and word overlap for similarity"""
+    words = [set(_WORD_PATTERN.findall(passage["text"].lower())) for passage in passages]
+    relevance = [1.0 - i / len(passages) for i in range(len(passages))]
+    similarity = np.zeros(len(passages))
+    order, remaining = [], list(range(len(passages)))
+    while remaining:
+        best = max(remaining, key=lambda i: diversity * relevance[i] - (1.0 - diversity) * similarity[i])
+        order.append(best)
+        remaining.remove(best)
+        for i in remaining:
+            union = len(words[i] | words[best]) or 1
+            similarity[i] = max(similarity[i], len(words[i] & words[best]) / union)
+    return [passages[i] for i in order]
+
+def pack_context(docs, token_budget=CONTEXT_TOKEN_BUDGET, diversity=CONTEXT_DIVERSITY_LAMBDA, max_overlap=200):
+    """Documents to put in the prompt: docs merged, ordered for diversity and cut to token_budget
+
+    docs are retrieved chunks, best first. Passages are taken in order while they fit the
+    budget; one that does not fit is skipped for a shorter one further down. The best
+    passage is always included, truncated if it alone exceeds the budget.
+    """
+    if not docs:
+        return []
+    passages = _diverse_order(merge_chunks(docs, max_overlap), diversity)
+    packed, used = [], 0
+    for passage in passages:
+        tokens = count_tokens(passage["text"])
+        if used + tokens > token_budget:
+            if packed:
+                continue
+            passage["text"] = _truncate_tokens(passage["text"], token_budget)
+            tokens = token_budget
+        metadata = dict(passage["metadata"])
+        if passage["start"] is not None:
+            metadata["start_index"] = passage["start"]
+        packed.append(Document(page_content=passage["text"], metadata=metadata))
+        used += tokens
+    return packed
+
+class ContextCache:
+    """Packed contexts of recent retrievals, so a repeated query skips retrieval and packing
+
+    Keys are the index version, the reader's roles, the packing settings and the exact
+    query embedding. The least recently used contexts are dropped beyond max_entries.
+    """
+
+    def __init__(self, max_entries=CONTEXT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.counters = {"hits": 0, "misses": 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(version, roles, query_vector, *settings):
+        digest = hashlib.blake2b(np.asarray(query_vector, dtype=np.float32).tobytes(), digest_size=16).digest()
+        return (version, tuple(roles) if roles is not None else None) + settings + (digest,)
+
+    def get(self, key):
+        """Cached documents for key, or None"""
+        with self._lock:
+            docs = self._entries.get(key)
+            if docs is None:
+                self.counters["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return docs
+
+    def put(self, key, docs):
+        with self._lock:
+            self._entries[key] = docs
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """Hit and miss counters and the number of cached contexts"""
+        with self._lock:
+            return dict(self.counters, entries=len(self._entries))
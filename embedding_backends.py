@@ -0,0 +1,156 @@
+import os
+import re
+import json
+import shutil
+import argparse
+import threading
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_huggingface import HuggingFaceEmbeddings
+
+# torch runs the sentence-transformers model as it is; onnx runs an ONNX Runtime export of it,
+# onnx-int8 the same export with its weights dynamically quantized to int8
+EMBEDDING_BACKENDS = ("torch", "onnx", "onnx-int8")
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+# Intra-op threads of one model call, 0 for the runtime's default of one per core
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", 0))
+# Texts per forward pass of the model; EMBED_BATCH_SIZE is the number of chunks per ingest batch
+ENCODE_BATCH_SIZE = int(os.getenv("ENCODE_BATCH_SIZE", 32))
+ONNX_OPSET = 14
+ONNX_FILES = {"onnx": "model.onnx", "onnx-int8": "model.int8.onnx"}
+
+_export_lock = threading.Lock()
+
+def onnx_folder(model_name, cache_folder):
+    """Folder of the ONNX export of a model: the fp32 and int8 graphs, the tokenizer and settings"""
+    return os.path.join(cache_folder, "onnx", re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name))
+
+def export_onnx(model_name, cache_folder, quantize=True):
+    """Export a sentence-transformers model to ONNX, with pooling and normalization in the graph
+
+    Also writes the dynamically quantized int8 graph unless quantize is False. Needs torch and
+    onnx, so export on a host that has them and copy the folder to hosts that only run
+    onnxruntime. Returns the folder; files that already exist are kept.
+    """
+    folder = onnx_folder(model_name, cache_folder)
+    fp32_path = os.path.join(folder, ONNX_FILES["onnx"])
+    int8_path = os.path.join(folder, ONNX_FILES["onnx-int8"])
+    with _export_lock:
+        if not os.path.exists(fp32_path):
+            import torch
+            from sentence_transformers import SentenceTransformer
+
+            model = SentenceTransformer(model_name, cache_folder=cache_folder, device="cpu").eval()
+            sample = model.tokenizer(["an example sentence"], return_tensors="pt")
+            names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+
+            class SentenceEmbedding(torch.nn.Module):
+                def __init__(self):
+                    super().__init__()
+                    self.model = model
+
+                def forward(self, *inputs):
+                    return self.model(dict(zip(names, inputs)))["sentence_embedding"]
+
+            os.makedirs(folder, exist_ok=True)
+            # Apps and the ingest worker may export at the same time, each into its own file
+            tmp_path = f"{fp32_path}.{os.getpid()}.tmp"
+            with torch.no_grad():
+                torch.onnx.export(
+                    SentenceEmbedding(), tuple(sample[name] for name in names), tmp_path,
+                    input_names=names, output_names=["sentence_embedding"],
+                    dynamic_axes=dict({name: {0: "batch", 1: "sequence"} for name in names}, sentence_embedding={0: "batch"}),
+                    opset_version=ONNX_OPSET, dynamo=False,
+                )
+            model.tokenizer.save_pretrained(folder)
+            with open(os.path.join(folder, "settings.json"), "w", encoding="utf-8") as f:
+                json.dump({"model_name": model_name, "max_length": model.max_seq_length, "inputs": names}, f)
+            # The graph is published last, so a folder with a graph is complete
+            os.replace(tmp_path, fp32_path)
+
+        if quantize and not os.path.exists(int8_path):
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            tmp_path = f"{int8_path}.{os.getpid()}.tmp"
+            quantize_dynamic(fp32_path, tmp_path, weight_type=QuantType.QInt8)
+            os.replace(tmp_path, int8_path)
+    return folder
+
+class OnnxEmbeddings(Embeddings):
+    """Sentence embeddings from an ONNX export of a sentence-transformers model (see export_onnx)
+
+    Texts are embedded in batches of batch_size, sorted by length so each batch pads little.
+    threads sets ONNX Runtime's intra-op threads, 0 for its default.
+    """
+
+    def __init__(self, folder, quantized=False, normalize=False, threads=0, batch_size=ENCODE_BATCH_SIZE):
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        with open(os.path.join(folder, "settings.json"), "r", encoding="utf-8") as f:
+            settings = json.load(f)
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.inter_op_num_threads = 1
+        if threads:
+            options.intra_op_num_threads = threads
+        path = os.path.join(folder, ONNX_FILES["onnx-int8" if quantized else "onnx"])
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.tokenizer = AutoTokenizer.from_pretrained(folder)
+        self.inputs = settings["inputs"]
+        self.max_length = settings["max_length"]
+        self.normalize = normalize
+        self.batch_size = batch_size
+
+    def embed_documents(self, texts):
+        # Same preprocessing as HuggingFaceEmbeddings
+        texts = [text.replace("\n", " ") for text in texts]
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            rows = order[start:start + self.batch_size]
+            encoded = self.tokenizer(
+                [texts[i] for i in rows], padding=True, truncation=True, max_length=self.max_length, return_tensors="np"
+            )
+            output = self.session.run(None, {name: encoded[name].astype(np.int64) for name in self.inputs})[0]
+            for i, vector in zip(rows, output):
+                vectors[i] = vector
+        if self.normalize and vectors:
+            vectors = np.array(vectors)
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return [vector.tolist() for vector in vectors]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+def load_embeddings(backend, model_name, normalize, cache_folder, threads=EMBEDDING_THREADS, batch_size=ENCODE_BATCH_SIZE):
+    """Embeddings of model_name on one of EMBEDDING_BACKENDS, exporting the ONNX graphs on first use"""
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend {backend}, expected one of {', '.join(EMBEDDING_BACKENDS)}")
+    if backend == "torch":
+        if threads:
+            import torch
+
+            # Process-wide, like the thread pool it configures
+            torch.set_num_threads(threads)
+        return HuggingFaceEmbeddings(
+            model_name=model_name,
+            cache_folder=cache_folder,
+            encode_kwargs={"normalize_embeddings": normalize, "batch_size": batch_size},
+        )
+    folder = onnx_folder(model_name, cache_folder)
+    if not os.path.exists(os.path.join(folder, ONNX_FILES[backend])):
+        folder = export_onnx(model_name, cache_folder, quantize=backend == "onnx-int8")
+    return OnnxEmbeddings(folder, backend == "onnx-int8", normalize, threads, batch_size)
+
+if __name__ == "__main__":
+    from chatpdf import EMBEDDING_MODEL, MODEL_CACHE_DIR
+
+    parser = argparse.ArgumentParser(description="Export the embedding model to ONNX and quantize it to int8")
+    parser.add_argument("--model", default=EMBEDDING_MODEL)
+    parser.add_argument("--cache-folder", default=MODEL_CACHE_DIR)
+    parser.add_argument("--force", action="store_true", help="replace an existing export")
+    args = parser.parse_args()
+    if args.force:
+        shutil.rmtree(onnx_folder(args.model, args.cache_folder), ignore_errors=True)
+    print(f"Exported {args.model} to {export_onnx(args.model, args.cache_folder)}")
@@ -0,0 +1,227 @@
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+import unicodedata
+import numpy as np
+
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", "embeddings/embedding_cache/")
+EMBEDDING_CACHE_MAX_MB = float(os.getenv("EMBEDDING_CACHE_MAX_MB", 1024))
+# Ingestion saves the cache once this many new vectors are held in memory
+EMBEDDING_CACHE_FLUSH_ROWS = int(os.getenv("EMBEDDING_CACHE_FLUSH_ROWS", 4096))
+# After an eviction the cache is this full, so the next few saves only append
+EVICTION_TARGET = 0.9
+KEY_BYTES = 16
+
+def normalize_text(text):
+    """Chunk text as it is hashed: NFC, with runs of whitespace collapsed"""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+def text_key(text):
+    """16-byte hash of a chunk's normalized text"""
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).digest()[:KEY_BYTES]
+
+class EmbeddingCache:
+    """Embeddings of chunk texts on disk, so an unchanged chunk is never embedded twice
+
+    There is one cache per embedding model and backend. Each row holds a text hash, a float32 vector and
+    the time it was last used, in flat files named after the current generation, plus a JSON
+    header written last. Lookups binary-search a sorted copy of the hashes and read only the
+    vectors they hit. New rows are appended on save; once the files outgrow max_bytes, the
+    least recently used rows are dropped into a new generation.
+    """
+
+    def __init__(self, model_name, normalize=False, directory=EMBEDDING_CACHE_DIR, max_mb=EMBEDDING_CACHE_MAX_MB, backend="torch"):
+        slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name) + ("-normalized" if normalize else "")
+        # Vectors of the default backend keep the name caches had before backends were added
+        if backend != "torch":
+            slug += f"-{backend}"
+        self.base = os.path.join(directory, slug)
+        self.model_name = model_name
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _path(self, generation, kind):
+        return f"{self.base}.{generation}.{kind}"
+
+    def _read_header(self):
+        try:
+            with open(f"{self.base}.json", "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"generation": 0, "count": 0, "dimension": None}
+
+    def _write_header(self, header):
+        tmp_path = f"{self.base}.json.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(dict(header, model_name=self.model_name), f)
+        os.replace(tmp_path, f"{self.base}.json")
+
+    def _load(self):
+        """Map the rows on disk, dropping anything not yet saved"""
+        header = self._read_header()
+        self.generation, self.count, self.dimension = header["generation"], header["count"], header["dimension"]
+        if self.count:
+            keys = np.fromfile(self._path(self.generation, "keys"), dtype=f"S{KEY_BYTES}", count=self.count)
+            self._vectors = np.memmap(
+                self._path(self.generation, "vectors"), dtype=np.float32, mode="r", shape=(self.count, self.dimension)
+            )
+            self._used = np.fromfile(self._path(self.generation, "used"), dtype=np.float64, count=self.count)
+        else:
+            keys = np.zeros(0, dtype=f"S{KEY_BYTES}")
+            self._vectors = None
+            self._used = np.zeros(0, dtype=np.float64)
+        self._order = np.argsort(keys, kind="stable")
+        self._sorted_keys = keys[self._order]
+        self._new = {}
+
+    def _row_bytes(self):
+        return KEY_BYTES + 4 * (self.dimension or 0) + 8
+
+    def lookup(self, texts):
+        """Cached vector of every text, or None where there is none"""
+        keys = [text_key(text) for text in texts]
+        found = [None] * len(keys)
+        with self._lock:
+            if len(self._sorted_keys):
+                query = np.array(keys, dtype=f"S{KEY_BYTES}")
+                positions = np.minimum(np.searchsorted(self._sorted_keys, query), len(self._sorted_keys) - 1)
+                now = time.time()
+                for i in np.flatnonzero(self._sorted_keys[positions] == query):
+                    row = int(self._order[positions[i]])
+                    found[i] = np.array(self._vectors[row])
+                    self._used[row] = now
+            for i, key in enumerate(keys):
+                if found[i] is None and key in self._new:
+                    found[i] = self._new[key]
+            hits = sum(vector is not None for vector in found)
+            self.counters["hits"] += hits
+            self.counters["misses"] += len(keys) - hits
+        return found
+
+    def store(self, texts, vectors):
+        """Remember the vectors of texts, written to disk by the next save"""
+        with self._lock:
+            for text, vector in zip(texts, vectors):
+                vector = np.asarray(vector, dtype=np.float32)
+                if self.dimension is None:
+                    self.dimension = len(vector)
+                self._new[text_key(text)] = vector
+
+    def unsaved(self):
+        """Number of new vectors held in memory until the next save"""
+        with self._lock:
+            return len(self._new)
+
+    def embed(self, texts, embed_documents):
+        """Vectors of texts, calling embed_documents only for texts that are not cached
+
+        Returns the vectors as lists of floats, like embed_documents, and the number of hits.
+        """
+        vectors = self.lookup(texts)
+        missing = {}
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                missing.setdefault(texts[i], []).append(i)
+        if missing:
+            computed = embed_documents(list(missing))
+            self.store(list(missing), computed)
+            for text, vector in zip(missing, computed):
+                for i in missing[text]:
+                    vectors[i] = vector
+        hits = len(texts) - sum(len(positions) for positions in missing.values())
+        return [np.asarray(vector, dtype=np.float32).tolist() for vector in vectors], hits
+
+    def save(self):
+        """Append new rows and record last use, evicting if the cache outgrew its size
+
+        Callers in different processes must not save at the same time.
+        """
+        with self._lock:
+            header = self._read_header()
+            if header["generation"] != self.generation or header["count"] != self.count:
+                # Another process saved meanwhile; keep our new rows on top of its files
+                new, used = self._new, dict(zip(self._sorted_keys.tolist(), self._used[self._order].tolist()))
+                self._load()
+                self._new = new
+                for key, row in zip(self._sorted_keys.tolist(), self._order.tolist()):
+                    self._used[row] = max(self._used[row], used.get(key, 0.0))
+            self._new = {key: vector for key, vector in self._new.items() if not self._contains(key)}
+
+            now = time.time()
+            new_keys = list(self._new)
+            self._vectors = None
+            if new_keys:
+                os.makedirs(os.path.dirname(self.base) or ".", exist_ok=True)
+                for kind, data in (
+                    ("keys", b"".join(new_keys)),
+                    ("vectors", np.stack([self._new[key] for key in new_keys]).astype(np.float32).tobytes()),
+                ):
+                    # Rows past the header's count are leftovers of an interrupted save
+                    with open(self._path(self.generation, kind), "ab") as f:
+                        f.truncate(self.count * (KEY_BYTES if kind == "keys" else 4 * self.dimension))
+                        f.write(data)
+            used = np.concatenate([self._used, np.full(len(new_keys), now)])
+            count = self.count + len(new_keys)
+            if count:
+                tmp_path = self._path(self.generation, "used.tmp")
+                used.tofile(tmp_path)
+                os.replace(tmp_path, self._path(self.generation, "used"))
+                self._write_header({"generation": self.generation, "count": count, "dimension": self.dimension})
+            self._load()
+            if self.count * self._row_bytes() > self.max_bytes:
+                self._evict()
+
+    def _contains(self, key):
+        key = np.array(key, dtype=f"S{KEY_BYTES}")
+        position = int(np.searchsorted(self._sorted_keys, key))
+        return position < len(self._sorted_keys) and self._sorted_keys[position] == key
+
+    def _evict(self):
+        """Rewrite the cache as a new generation holding only the most recently used rows"""
+        keep = int(self.max_bytes * EVICTION_TARGET) // self._row_bytes()
+        rows = np.sort(np.argsort(-self._used, kind="stable")[:keep])
+        keys = np.fromfile(self._path(self.generation, "keys"), dtype=f"S{KEY_BYTES}", count=self.count)
+        old_generation, generation = self.generation, self.generation + 1
+        keys[rows].tofile(self._path(generation, "keys"))
+        with open(self._path(generation, "vectors"), "wb") as f:
+            for start in range(0, len(rows), 65536):
+                f.write(np.asarray(self._vectors[rows[start:start + 65536]], dtype=np.float32).tobytes())
+        self._used[rows].tofile(self._path(generation, "used"))
+        self._write_header({"generation": generation, "count": len(rows), "dimension": self.dimension})
+        self.counters["evictions"] += self.count - len(rows)
+        self._load()
+        for kind in ("keys", "vectors", "used"):
+            try:
+                os.remove(self._path(old_generation, kind))
+            except OSError:
+                # Still mapped by a reader on Windows, it goes with a later eviction
+                pass
+
+    def stats(self):
+        """Hit and miss counters, hit rate and size on disk"""
+        with self._lock:
+            stats = dict(
+                self.counters,
+                entries=self.count,
+                unsaved=len(self._new),
+                bytes=self.count * self._row_bytes(),
+                max_bytes=self.max_bytes,
+            )
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def clear(self):
+        """Drop every cached embedding"""
+        with self._lock:
+            for kind in ("keys", "vectors", "used"):
+                if os.path.exists(self._path(self.generation, kind)):
+                    os.remove(self._path(self.generation, kind))
+            if os.path.exists(f"{self.base}.json"):
+                os.remove(f"{self.base}.json")
+            self._load()
@@ -0,0 +1,91 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+import numpy as np
+
+RANGE_FILE_PATTERN = re.compile(r"^(\d+)-(\d+)\.npz$")
+
+def checkpoint_folder(directory, key):
+    """Folder of the saved page ranges of the PDF with the given manifest key"""
+    return os.path.join(directory, hashlib.sha256(key.encode("utf-8")).hexdigest()[:32])
+
+def prune_checkpoints(directory, keep=()):
+    """Delete the saved page ranges of every PDF but those with the keep manifest keys"""
+    if not os.path.isdir(directory):
+        return
+    kept = {os.path.basename(checkpoint_folder(directory, key)) for key in keep}
+    for name in os.listdir(directory):
+        if name not in kept:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+class PageCheckpoint:
+    """Chunks and vectors of the finished page ranges of one PDF, so an interrupted ingest resumes
+
+    Each range is saved to its own file, named after its first and last page, as soon as all
+    of its chunks are embedded. The folder is named after the PDF's manifest key. Its
+    fingerprint covers the file's content hash and the chunking and embedding settings, and
+    ranges saved under another fingerprint are dropped.
+    """
+
+    def __init__(self, directory, key, fingerprint):
+        self.folder = checkpoint_folder(directory, key)
+        self.fingerprint = fingerprint
+        try:
+            with open(os.path.join(self.folder, "checkpoint.json"), "r", encoding="utf-8") as f:
+                saved = json.load(f).get("fingerprint")
+        except (OSError, ValueError):
+            saved = None
+        if saved != fingerprint:
+            self.clear()
+
+    def ranges(self):
+        """(start, stop) of the saved ranges that follow on from the first page without a gap"""
+        if not os.path.isdir(self.folder):
+            return []
+        saved = {}
+        for name in os.listdir(self.folder):
+            match = RANGE_FILE_PATTERN.match(name)
+            if match:
+                saved[int(match.group(1))] = int(match.group(2))
+        ranges, start = [], 0
+        while start in saved:
+            ranges.append((start, saved[start]))
+            start = saved[start]
+        return ranges
+
+    def resume_page(self):
+        """First page not covered by saved ranges"""
+        ranges = self.ranges()
+        return ranges[-1][1] if ranges else 0
+
+    def _range_path(self, start, stop):
+        return os.path.join(self.folder, f"{start:08d}-{stop:08d}.npz")
+
+    def load(self, start, stop):
+        """Texts, metadatas and vectors of a saved range"""
+        with np.load(self._range_path(start, stop)) as data:
+            chunks = json.loads(data["chunks"].tobytes().decode("utf-8"))
+            vectors = data["vectors"]
+        return chunks["texts"], chunks["metadatas"], vectors
+
+    def save(self, start, stop, texts, metadatas, vectors):
+        """Write one finished range atomically"""
+        if not os.path.exists(os.path.join(self.folder, "checkpoint.json")):
+            os.makedirs(self.folder, exist_ok=True)
+            with open(os.path.join(self.folder, "checkpoint.json"), "w", encoding="utf-8") as f:
+                json.dump({"fingerprint": self.fingerprint}, f)
+        chunks = json.dumps({"texts": texts, "metadatas": metadatas}).encode("utf-8")
+        path = self._range_path(start, stop)
+        with open(f"{path}.tmp", "wb") as f:
+            np.savez(
+                f,
+                chunks=np.frombuffer(chunks, dtype=np.uint8),
+                vectors=np.asarray(vectors, dtype=np.float32) if texts else np.zeros((0, 0), dtype=np.float32),
+            )
+        os.replace(f"{path}.tmp", path)
+
+    def clear(self):
+        """Drop every saved range"""
+        shutil.rmtree(self.folder, ignore_errors=True)
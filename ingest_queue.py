@@ -0,0 +1,244 @@
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import threading
+import subprocess
+from chatpdf import process_and_save_pdfs, index_lock
+
+JOBS_DIR = "jobs/"
+WORKER_HEARTBEAT = os.path.join(JOBS_DIR, "worker.heartbeat")
+WORKER_STALE_SECONDS = 15
+PROGRESS_WRITE_INTERVAL = 1.0
+ACTIVE_STATES = ("queued", "running")
+# A job whose worker died this many times is failed instead of queued again
+MAX_JOB_ATTEMPTS = int(os.getenv("MAX_JOB_ATTEMPTS", 3))
+
+def _job_path(job_id):
+    return os.path.join(JOBS_DIR, f"{job_id}.json")
+
+def _write_job(job):
+    """Persist a job atomically so readers never see a half-written file"""
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    job["updated_at"] = time.time()
+    tmp_path = f"{_job_path(job['id'])}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(job, f, indent=2)
+    os.replace(tmp_path, _job_path(job["id"]))
+
+def submit_job(pdf_paths, index_name="docs_index", roles=None, rebuild=False):
+    """Queue PDFs for ingestion into an index and return the new job
+
+    roles restricts who may retrieve the PDFs; None opens them to everyone. rebuild builds
+    the index again from every PDF of its collection, see process_and_save_pdfs.
+    """
+    job = {
+        "id": f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}",
+        "index_name": index_name,
+        "pdf_paths": list(pdf_paths),
+        "roles": list(roles) if roles else None,
+        "rebuild": rebuild,
+        "state": "queued",
+        "stage": "queued",
+        "stages": {},
+        "attempts": 0,
+        "created_at": time.time(),
+        "coalesced_with": [],
+        "report": None,
+        "error": None,
+    }
+    _write_job(job)
+    return job
+
+def get_job(job_id):
+    """Load one job, or None if it does not exist"""
+    try:
+        with open(_job_path(job_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def list_jobs(index_name=None, limit=None):
+    """Jobs newest first, optionally only those of one index"""
+    if not os.path.exists(JOBS_DIR):
+        return []
+    jobs = []
+    for name in os.listdir(JOBS_DIR):
+        if name.endswith(".json"):
+            job = get_job(name[:-len(".json")])
+            if job is not None and (index_name is None or job["index_name"] == index_name):
+                jobs.append(job)
+    jobs.sort(key=lambda job: job["created_at"], reverse=True)
+    return jobs[:limit] if limit else jobs
+
+def active_jobs(index_name=None):
+    """Jobs that are queued or running"""
+    return [job for job in list_jobs(index_name) if job["state"] in ACTIVE_STATES]
+
+def _index_is_busy(index_name):
+    """True if some process currently holds the index lock"""
+    try:
+        with index_lock(index_name, timeout=0):
+            return False
+    except TimeoutError:
+        return True
+
+def _requeue_abandoned(jobs):
+    """Put running jobs whose worker died back in the queue, or fail them after MAX_JOB_ATTEMPTS"""
+    for job in jobs:
+        if job["state"] == "running" and not _index_is_busy(job["index_name"]):
+            if job["attempts"] >= MAX_JOB_ATTEMPTS:
+                job["state"] = "failed"
+                job["stage"] = "failed"
+                job["error"] = f"The worker stopped during each of {job['attempts']} attempts"
+                job["finished_at"] = time.time()
+            else:
+                job["state"] = "queued"
+                job["stage"] = "queued"
+            _write_job(job)
+
+def _stages_from_progress(stats):
+    """Per-stage progress of a job from the ingestion counters"""
+    return {
+        "extract": {"files_done": stats["files_done"], "files_total": stats["files_total"], "pages": stats["pages"]},
+        "split": {"chunks": stats["chunks"]},
+        "embed": {
+            "vectors": stats["vectors"],
+            "cached": stats.get("cached_vectors", 0),
+            "restored": stats.get("restored_vectors", 0),
+            "vectors_per_s": round(stats["vectors_per_s"], 1),
+        },
+        "save": "running" if stats["stage"] == "saving" else "pending",
+    }
+
+def run_next_job():
+    """Run the oldest queued job, coalesced with every other queued job of the same index
+
+    Indexes locked by another process are skipped for the next index with queued jobs.
+    Returns the jobs that were processed, or an empty list if there was nothing to do.
+    """
+    _requeue_abandoned(list_jobs())
+    queued = sorted((job for job in list_jobs() if job["state"] == "queued"), key=lambda job: job["created_at"])
+    # Indexes in the order of their oldest queued job
+    for index_name in dict.fromkeys(job["index_name"] for job in queued):
+        try:
+            # Jobs are serialized per index; another worker may already own this one
+            with index_lock(index_name, timeout=0):
+                batch = _run_batch(index_name, queued)
+        except TimeoutError:
+            continue
+        if batch:
+            return batch
+    return []
+
+def _run_batch(index_name, queued):
+    """Run the queued jobs of one index as one ingest, the caller holds the index lock"""
+    # Re-read under the lock so no other worker can take the same jobs
+    batch = [get_job(job["id"]) for job in queued if job["index_name"] == index_name]
+    batch = [job for job in batch if job is not None and job["state"] == "queued"]
+    if not batch:
+        return []
+    for job in batch:
+        job["state"] = "running"
+        job["stage"] = "ingesting"
+        job["attempts"] += 1
+        job["started_at"] = time.time()
+        job["coalesced_with"] = [other["id"] for other in batch if other["id"] != job["id"]]
+        _write_job(job)
+
+    last_write = [0.0]
+
+    def on_progress(stats):
+        # Throttle job file writes, but always record stage changes
+        now = time.monotonic()
+        if now - last_write[0] < PROGRESS_WRITE_INTERVAL and stats["stage"] == batch[0]["stage"]:
+            return
+        last_write[0] = now
+        for job in batch:
+            job["stage"] = stats["stage"]
+            job["stages"] = _stages_from_progress(stats)
+            _write_job(job)
+
+    pdf_paths = sorted({pdf_path for job in batch for pdf_path in job["pdf_paths"]})
+    # Later uploads of the same file decide its roles
+    access = {pdf_path: job.get("roles") for job in batch for pdf_path in job["pdf_paths"]}
+    try:
+        # A rebuild job rebuilds the whole batch; jobs from before the flag existed do not
+        rebuild = any(job.get("rebuild") for job in batch)
+        report = process_and_save_pdfs(pdf_paths, index_name=index_name, rebuild=rebuild, progress=on_progress, access=access)
+    except Exception as e:
+        for job in batch:
+            job["state"] = "failed"
+            job["stage"] = "failed"
+            job["error"] = str(e)
+            job["finished_at"] = time.time()
+            _write_job(job)
+        return batch
+
+    for job in batch:
+        job["state"] = "done"
+        job["stage"] = "done"
+        job["report"] = report
+        if "stats" in report:
+            job["stages"] = dict(_stages_from_progress(report["stats"]), save="done")
+        job["finished_at"] = time.time()
+        _write_job(job)
+    return batch
+
+def _touch_heartbeat(stop):
+    """Mark this worker as alive until stop is set"""
+    while True:
+        with open(WORKER_HEARTBEAT, "w") as f:
+            f.write(str(os.getpid()))
+        if stop.wait(WORKER_STALE_SECONDS / 3):
+            return
+
+def run_worker(poll_interval=1.0, once=False):
+    """Process queued jobs until interrupted, or until the queue is empty if once is set"""
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=_touch_heartbeat, args=(stop,), daemon=True)
+    heartbeat.start()
+    try:
+        while True:
+            if not run_next_job():
+                if once:
+                    return
+                time.sleep(poll_interval)
+    finally:
+        stop.set()
+
+def worker_alive():
+    """True if a worker has written its heartbeat recently"""
+    try:
+        return time.time() - os.path.getmtime(WORKER_HEARTBEAT) < WORKER_STALE_SECONDS
+    except OSError:
+        return False
+
+def ensure_worker():
+    """Start a background worker process unless one is already running"""
+    if worker_alive():
+        return False
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    log = open(os.path.join(JOBS_DIR, "worker.log"), "a")
+    kwargs = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP} if os.name == "nt" else {"start_new_session": True}
+    subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__)],
+        cwd=os.getcwd(),
+        stdout=log,
+        stderr=subprocess.STDOUT,
+        **kwargs
+    )
+    # Count the worker as alive right away so reruns do not start a second one
+    with open(WORKER_HEARTBEAT, "w") as f:
+        f.write("starting")
+    return True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the ingestion job worker")
+    parser.add_argument("--once", action="store_true", help="exit when the queue is empty")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="seconds between queue checks")
+    args = parser.parse_args()
+    run_worker(poll_interval=args.poll_interval, once=args.once)
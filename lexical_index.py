@@ -0,0 +1,284 @@
+import os
+import re
+import numpy as np
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Codes such as "A-12", "1099-B" or "plan_v2.1" stay one token, their parts are indexed as well
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-_./][a-z0-9]+)*")
+_PART_PATTERN = re.compile(r"[-_./]")
+STOPWORDS = frozenset("""
+a an and are as at be but by can do does for from has have how i if in is it its may me my no not of on or
+our so than that the their them then there these they this to us was we were what when where which who why
+will with you your
+""".split())
+
+def tokenize(text):
+    """Lowercased terms of a text without stopwords"""
+    terms = []
+    for token in _TOKEN_PATTERN.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        terms.append(token)
+        if _PART_PATTERN.search(token):
+            terms.extend(part for part in _PART_PATTERN.split(token) if part and part not in STOPWORDS)
+    return terms
+
+# Arrays of a saved index, each in its own .npy file so readers map it instead of reading it
+SAVED_ARRAYS = (
+    "term_bytes", "term_offsets", "id_bytes", "id_offsets", "doc_ptr", "doc_terms", "doc_tfs", "doc_len",
+    "post_ptr", "post_docs", "post_weights",
+)
+
+def _blob(strings):
+    """UTF-8 bytes of strings laid end to end, with the offset of each one"""
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+def _split(array):
+    text = array.tobytes().decode("utf-8")
+    return text.split("\n") if text else []
+
+class MappedStrings:
+    """Read-only sequence of strings kept as UTF-8 bytes and offsets, e.g. mapped from .npy files"""
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        data = self.blob.tobytes()
+        offsets = self.offsets.tolist()
+        return (data[start:end].decode("utf-8") for start, end in zip(offsets, offsets[1:]))
+
+    def index_of(self, string):
+        """Position of a string by binary search, the strings being sorted, or None"""
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self[middle] < string:
+                low = middle + 1
+            else:
+                high = middle
+        return low if low < len(self) and self[low] == string else None
+
+def _posting_weights(post_docs, post_tfs, doc_len):
+    """BM25 term frequency factor of every posting, precomputed once per index change
+
+    It only depends on the term frequency and the chunk's length, so a query just scales it by idf.
+    """
+    avg_len = max(float(doc_len.mean()), 1.0) if len(doc_len) else 1.0
+    doc_norm = (BM25_K1 * (1 - BM25_B + BM25_B * doc_len / avg_len)).astype(np.float32)
+    tfs = post_tfs.astype(np.float32)
+    return tfs * np.float32(BM25_K1 + 1) / (tfs + doc_norm[post_docs])
+
+class BM25Index:
+    """Okapi BM25 over document chunks, stored as compact integer arrays
+
+    A forward index (terms of each chunk) is the source of truth and is cheap to append to and
+    filter. Postings (chunks of each term) and their BM25 weights are derived from it after
+    every change, so a query only slices arrays and sums precomputed factors.
+
+    A loaded index maps its arrays read-only and keeps the vocabulary and docstore ids as
+    MappedStrings, so serving processes share it through the page cache. The first add or
+    delete turns them into lists and a dict, see _thaw.
+    """
+
+    def __init__(self):
+        self.vocabulary = []
+        self.term_ids = {}
+        self.doc_ids = []
+        self.doc_ptr = np.zeros(1, dtype=np.int64)
+        self.doc_terms = np.zeros(0, dtype=np.int32)
+        self.doc_tfs = np.zeros(0, dtype=np.uint16)
+        self.doc_len = np.zeros(0, dtype=np.int32)
+        self._pending = []
+        self._postings = None
+
+    def __len__(self):
+        return len(self.doc_ids) + len(self._pending)
+
+    def _thaw(self):
+        if self.term_ids is None:
+            self.vocabulary = list(self.vocabulary)
+            self.term_ids = {term: i for i, term in enumerate(self.vocabulary)}
+            self.doc_ids = list(self.doc_ids)
+
+    def _term_id(self, term):
+        if self.term_ids is None:
+            return self.vocabulary.index_of(term)
+        return self.term_ids.get(term)
+
+    def add(self, ids, texts):
+        """Index chunks under their docstore ids"""
+        self._thaw()
+        for id_, text in zip(ids, texts):
+            terms = tokenize(text)
+            counts = {}
+            for term in terms:
+                term_id = self.term_ids.get(term)
+                if term_id is None:
+                    term_id = self.term_ids[term] = len(self.vocabulary)
+                    self.vocabulary.append(term)
+                counts[term_id] = counts.get(term_id, 0) + 1
+            self._pending.append((id_, counts, len(terms)))
+        self._postings = None
+
+    def _flush(self):
+        if not self._pending:
+            return
+        lengths = [len(counts) for _, counts, _ in self._pending]
+        self.doc_ids.extend(id_ for id_, _, _ in self._pending)
+        self.doc_ptr = np.concatenate([self.doc_ptr, self.doc_ptr[-1] + np.cumsum(lengths, dtype=np.int64)])
+        self.doc_terms = np.concatenate([self.doc_terms, np.fromiter(
+            (term_id for _, counts, _ in self._pending for term_id in counts), dtype=np.int32, count=sum(lengths)
+        )])
+        self.doc_tfs = np.concatenate([self.doc_tfs, np.fromiter(
+            (min(tf, 65535) for _, counts, _ in self._pending for tf in counts.values()), dtype=np.uint16, count=sum(lengths)
+        )])
+        self.doc_len = np.concatenate([self.doc_len, np.array([n for _, _, n in self._pending], dtype=np.int32)])
+        self._pending = []
+
+    def delete(self, ids):
+        """Drop chunks by docstore id, unknown ids are ignored"""
+        self._thaw()
+        self._flush()
+        doomed = set(ids)
+        keep = np.array([id_ not in doomed for id_ in self.doc_ids], dtype=bool)
+        if keep.all():
+            return
+        lengths = np.diff(self.doc_ptr)
+        entry_keep = np.repeat(keep, lengths)
+        self.doc_ids = [id_ for id_, kept in zip(self.doc_ids, keep) if kept]
+        self.doc_ptr = np.concatenate([[0], np.cumsum(lengths[keep])]).astype(np.int64)
+        self.doc_terms = self.doc_terms[entry_keep]
+        self.doc_tfs = self.doc_tfs[entry_keep]
+        self.doc_len = self.doc_len[keep]
+        self._postings = None
+
+    def row_ids(self):
+        """Docstore id of every row, in the order search masks refer to them"""
+        self._flush()
+        return self.doc_ids
+
+    def _build_postings(self):
+        """Invert the forward index: postings grouped by term, with their weights"""
+        self._flush()
+        docs = np.repeat(np.arange(len(self.doc_ids), dtype=np.int32), np.diff(self.doc_ptr))
+        order = np.argsort(self.doc_terms, kind="stable")
+        post_ptr = np.zeros(len(self.vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.doc_terms, minlength=len(self.vocabulary)), out=post_ptr[1:])
+        post_docs = docs[order]
+        self._postings = (post_ptr, post_docs, _posting_weights(post_docs, self.doc_tfs[order], self.doc_len))
+
+    def _sort_terms(self):
+        """Renumber terms in sorted order, so a loaded index finds them by binary search"""
+        self._flush()
+        order = sorted(range(len(self.vocabulary)), key=self.vocabulary.__getitem__)
+        if all(i == term_id for i, term_id in enumerate(order)):
+            return
+        rank = np.empty(len(order), dtype=np.int32)
+        rank[order] = np.arange(len(order), dtype=np.int32)
+        self.vocabulary = [self.vocabulary[i] for i in order]
+        self.term_ids = {term: i for i, term in enumerate(self.vocabulary)}
+        self.doc_terms = rank[self.doc_terms]
+        self._postings = None
+
+    def search(self, query, k, allowed=None):
+        """Best k (docstore id, BM25 score) pairs for a query
+
+        allowed, a boolean array over row_ids(), restricts the search to those rows before scoring.
+        """
+        if self._postings is None:
+            self._build_postings()
+        post_ptr, post_docs, post_weights = self._postings
+        doc_count = len(self.doc_ids)
+        term_ids = {self._term_id(term) for term in tokenize(query)} - {None}
+        doc_parts, score_parts = [], []
+        for term_id in term_ids:
+            start, end = post_ptr[term_id], post_ptr[term_id + 1]
+            if start == end:
+                continue
+            df = end - start
+            idf = np.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+            docs, weights = post_docs[start:end], post_weights[start:end]
+            if allowed is not None:
+                visible = allowed[docs]
+                docs, weights = docs[visible], weights[visible]
+            doc_parts.append(docs)
+            score_parts.append(idf * weights)
+        if not doc_parts:
+            return []
+
+        # Sum per chunk over the matched postings only, never over the whole corpus
+        docs, inverse = np.unique(np.concatenate(doc_parts), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(score_parts))
+        top = np.argpartition(-scores, k - 1)[:k] if len(scores) > k else np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(self.doc_ids[docs[i]], float(scores[i])) for i in top]
+
+    @staticmethod
+    def files(path):
+        """Files of an index saved under path, one per array"""
+        return [f"{path}.{name}.npy" for name in SAVED_ARRAYS]
+
+    def save(self, path):
+        """Write the index as .npy files next to path, each one atomically"""
+        if self.term_ids is not None:
+            self._sort_terms()
+        if self._postings is None:
+            self._build_postings()
+        post_ptr, post_docs, post_weights = self._postings
+        if self.term_ids is None:
+            term_bytes, term_offsets = self.vocabulary.blob, self.vocabulary.offsets
+            id_bytes, id_offsets = self.doc_ids.blob, self.doc_ids.offsets
+        else:
+            term_bytes, term_offsets = _blob(self.vocabulary)
+            id_bytes, id_offsets = _blob(self.doc_ids)
+        arrays = {
+            "term_bytes": term_bytes, "term_offsets": term_offsets, "id_bytes": id_bytes, "id_offsets": id_offsets,
+            "doc_ptr": self.doc_ptr, "doc_terms": self.doc_terms, "doc_tfs": self.doc_tfs, "doc_len": self.doc_len,
+            "post_ptr": post_ptr, "post_docs": post_docs, "post_weights": post_weights,
+        }
+        for name, file_path in zip(SAVED_ARRAYS, self.files(path)):
+            tmp_path = f"{file_path}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, arrays[name], allow_pickle=False)
+            os.replace(tmp_path, file_path)
+
+    @classmethod
+    def load(cls, path):
+        """Map an index written by save, or read one from the .npz file earlier versions wrote"""
+        lexical = cls()
+        if path.endswith(".npz"):
+            with np.load(path, allow_pickle=False) as data:
+                lexical.vocabulary = _split(data["vocabulary"])
+                lexical.doc_ids = _split(data["doc_ids"])
+                lexical.doc_ptr = data["doc_ptr"]
+                lexical.doc_terms = data["doc_terms"]
+                lexical.doc_tfs = data["doc_tfs"]
+                lexical.doc_len = data["doc_len"]
+                post_ptr, post_docs, post_tfs = data["post_ptr"], data["post_docs"], data["post_tfs"]
+            lexical.term_ids = {term: i for i, term in enumerate(lexical.vocabulary)}
+            lexical._postings = (post_ptr, post_docs, _posting_weights(post_docs, post_tfs, lexical.doc_len))
+            return lexical
+
+        arrays = {
+            name: np.asarray(np.load(file_path, mmap_mode="r", allow_pickle=False))
+            for name, file_path in zip(SAVED_ARRAYS, cls.files(path))
+        }
+        lexical.vocabulary = MappedStrings(arrays["term_bytes"], arrays["term_offsets"])
+        lexical.term_ids = None
+        lexical.doc_ids = MappedStrings(arrays["id_bytes"], arrays["id_offsets"])
+        for name in ("doc_ptr", "doc_terms", "doc_tfs", "doc_len"):
+            setattr(lexical, name, arrays[name])
+        lexical._postings = (arrays["post_ptr"], arrays["post_docs"], arrays["post_weights"])
+        return lexical
@@ -0,0 +1,193 @@
+import os
+import json
+import shutil
+from collections.abc import Mapping
+import numpy as np
+from langchain_community.docstore.base import Docstore
+from langchain_core.documents import Document
+
+CHUNK_FILE_MAGIC = b"IDCHUNK1"
+# Sections start on cache-line boundaries so every array can be viewed in place
+SECTION_ALIGNMENT = 64
+
+def _blob(strings):
+    """UTF-8 bytes of strings laid end to end, with the offset of each one"""
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+def write_chunk_file(path, labels, ids, rows, label_masks=None, lexical_masks=None, role_bits=None, source=None, storage=None):
+    """Write chunks in a layout that readers map instead of unpickling
+
+    labels are ascending and rows yields the UTF-8 text and metadata JSON of each label in
+    turn, so the chunks are streamed to disk rather than held in memory. The file is written
+    next to path and moved into place, so processes that still map the previous file keep
+    reading it undisturbed.
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    if np.any(labels[1:] <= labels[:-1]):
+        raise ValueError("Chunk file labels must be ascending")
+    id_bytes, id_offsets = _blob(ids)
+    text_offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+    meta_offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+    # Texts and metadata go to side files first, their sizes are only known at the end
+    blob_paths = {"text_bytes": f"{path}.text.tmp", "meta_bytes": f"{path}.meta.tmp"}
+    tmp_path = f"{path}.tmp"
+    try:
+        count = 0
+        with open(blob_paths["text_bytes"], "wb") as text_file, open(blob_paths["meta_bytes"], "wb") as meta_file:
+            for row, (text, metadata) in enumerate(rows):
+                text_file.write(text)
+                meta_file.write(metadata)
+                text_offsets[row + 1] = text_offsets[row] + len(text)
+                meta_offsets[row + 1] = meta_offsets[row] + len(metadata)
+                count += 1
+        if count != len(ids):
+            raise ValueError(f"Got {count} chunks for {len(ids)} ids")
+        sections = {
+            "labels": labels,
+            "id_order": np.array(sorted(range(len(ids)), key=ids.__getitem__), dtype=np.int64),
+            "id_offsets": id_offsets,
+            "id_bytes": id_bytes,
+            "text_offsets": text_offsets,
+            "text_bytes": None,
+            "meta_offsets": meta_offsets,
+            "meta_bytes": None,
+        }
+        if label_masks is not None:
+            sections["label_masks"] = np.asarray(label_masks, dtype=np.uint64)
+            sections["lexical_masks"] = np.asarray(lexical_masks, dtype=np.uint64)
+
+        header = {"count": len(ids), "role_bits": role_bits, "source": source, "storage": storage, "sections": {}}
+        offset = 0
+        for name, array in sections.items():
+            if array is None:
+                dtype, length = "|u1", int(text_offsets[-1] if name == "text_bytes" else meta_offsets[-1])
+            else:
+                dtype, length = array.dtype.str, len(array)
+            header["sections"][name] = [offset, dtype, length]
+            offset += -(-length * np.dtype(dtype).itemsize // SECTION_ALIGNMENT) * SECTION_ALIGNMENT
+        header_bytes = json.dumps(header).encode("utf-8")
+        data_start = -(-(len(CHUNK_FILE_MAGIC) + 8 + len(header_bytes)) // SECTION_ALIGNMENT) * SECTION_ALIGNMENT
+
+        with open(tmp_path, "wb") as f:
+            f.write(CHUNK_FILE_MAGIC)
+            f.write(np.uint64(len(header_bytes)).tobytes())
+            f.write(header_bytes)
+            for name, array in sections.items():
+                f.seek(data_start + header["sections"][name][0])
+                if array is None:
+                    with open(blob_paths[name], "rb") as blob:
+                        shutil.copyfileobj(blob, f, 1024 * 1024)
+                else:
+                    f.write(array.tobytes())
+            f.truncate(data_start + offset)
+        os.replace(tmp_path, path)
+    finally:
+        for tmp in [tmp_path, *blob_paths.values()]:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+class MappedChunks:
+    """Read-only view of a chunk file, backed by the page cache and shared between processes"""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            if f.read(len(CHUNK_FILE_MAGIC)) != CHUNK_FILE_MAGIC:
+                raise ValueError(f"{path} is not a chunk file")
+            header_size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(header_size))
+        data_start = -(-(len(CHUNK_FILE_MAGIC) + 8 + header_size) // SECTION_ALIGNMENT) * SECTION_ALIGNMENT
+        self.path = path
+        self.count = header["count"]
+        self.role_bits = header["role_bits"]
+        self.source = header["source"]
+        self.storage = header.get("storage")
+        self._rows_by_id = None
+        self._map = np.memmap(path, dtype=np.uint8, mode="r")
+        for name, (offset, dtype, length) in header["sections"].items():
+            setattr(self, name, np.frombuffer(self._map, dtype=dtype, count=length, offset=data_start + offset))
+        if not hasattr(self, "label_masks"):
+            self.label_masks = self.lexical_masks = None
+
+    def __len__(self):
+        return self.count
+
+    def _string(self, blob, offsets, row):
+        return blob[offsets[row]:offsets[row + 1]].tobytes().decode("utf-8")
+
+    def id_at(self, row):
+        return self._string(self.id_bytes, self.id_offsets, row)
+
+    def row_of_label(self, label):
+        row = int(np.searchsorted(self.labels, label))
+        if row == self.count or self.labels[row] != label:
+            raise KeyError(label)
+        return row
+
+    def row_of_id(self, id_):
+        """Row of a docstore id by binary search over the sorted ids, or None"""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.id_at(int(self.id_order[middle])) < id_:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self.id_at(int(self.id_order[low])) == id_:
+            return int(self.id_order[low])
+        return None
+
+    def rows_by_id(self):
+        """Row of every docstore id, decoded once"""
+        if self._rows_by_id is None:
+            self._rows_by_id = {self.id_at(row): row for row in range(self.count)}
+        return self._rows_by_id
+
+    def raw(self, row):
+        """UTF-8 text and metadata JSON of a row as stored, e.g. to copy it into a new chunk file"""
+        return (
+            self.text_bytes[self.text_offsets[row]:self.text_offsets[row + 1]].tobytes(),
+            self.meta_bytes[self.meta_offsets[row]:self.meta_offsets[row + 1]].tobytes(),
+        )
+
+    def document(self, row):
+        return Document(
+            page_content=self._string(self.text_bytes, self.text_offsets, row),
+            metadata=json.loads(self._string(self.meta_bytes, self.meta_offsets, row)),
+        )
+
+class MappedDocstore(Docstore):
+    """Docstore over mapped chunks, documents are decoded on each lookup"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def search(self, search):
+        row = self.chunks.row_of_id(search)
+        if row is None:
+            return f"ID {search} not found."
+        return self.chunks.document(row)
+
+class MappedLabels(Mapping):
+    """Vector label to docstore id mapping over mapped chunks, without the labels in deleted"""
+
+    def __init__(self, chunks, deleted=()):
+        self.chunks = chunks
+        self.deleted = frozenset(deleted)
+        deleted = np.fromiter(self.deleted, dtype=np.int64, count=len(self.deleted))
+        self._count = chunks.count - int(np.isin(deleted, chunks.labels).sum())
+
+    def __getitem__(self, label):
+        if label in self.deleted:
+            raise KeyError(label)
+        return self.chunks.id_at(self.chunks.row_of_label(label))
+
+    def __iter__(self):
+        if not self.deleted:
+            return iter(self.chunks.labels.tolist())
+        return (label for label in self.chunks.labels.tolist() if label not in self.deleted)
+
+    def __len__(self):
+        return self._count
@@ -0,0 +1,231 @@
+import os
+import json
+import time
+import atexit
+import sqlite3
+import argparse
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+# Empty to disable recording
+METRICS_DB = os.getenv("METRICS_DB", "metrics/metrics.db")
+METRICS_RETENTION = float(os.getenv("METRICS_RETENTION", 7 * 24 * 3600))
+# Samples are buffered and written in one transaction at most this often
+FLUSH_INTERVAL = 1.0
+FLUSH_SIZE = 200
+# Samples older than the retention period are deleted at most this often
+PRUNE_INTERVAL = float(os.getenv("METRICS_PRUNE_INTERVAL", 300))
+# Percentiles of a stage with more samples in the window are taken from a random sample of about this size
+PERCENTILE_SAMPLES = int(os.getenv("METRICS_PERCENTILE_SAMPLES", 10000))
+PROMETHEUS_PREFIX = "intellidoc"
+
+class MetricsStore:
+    """Buffered writer and reader of (time, stage, seconds, counters) samples in SQLite
+
+    The database is shared by every process of the app, so the admin panel sees what the
+    user app and the ingestion worker recorded. Samples are written by a background thread,
+    so recording never waits on the database.
+    """
+
+    def __init__(self, path=METRICS_DB, retention=METRICS_RETENTION):
+        self.path = path
+        self.retention = retention
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._last_prune = None
+        self._ready = False
+        self._wake = threading.Event()
+        self._writer = None
+
+    def _connect(self):
+        if not self._ready:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=5)
+        if not self._ready:
+            # WAL lets the apps and the worker write while the admin panel reads
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS samples (ts REAL NOT NULL, stage TEXT NOT NULL, seconds REAL, counters TEXT)"
+            )
+            # Covers the per stage counts, sums and percentiles without reading the table
+            connection.execute("CREATE INDEX IF NOT EXISTS samples_stage_ts_seconds ON samples (stage, ts, seconds)")
+            connection.execute("DROP INDEX IF EXISTS samples_stage_ts")
+            connection.execute("CREATE INDEX IF NOT EXISTS samples_ts ON samples (ts)")
+            self._ready = True
+        return connection
+
+    def record(self, stage, seconds=None, **counters):
+        """Buffer one sample of a stage: its duration in seconds and any counts it produced"""
+        with self._lock:
+            self._buffer.append((time.time(), stage, seconds, json.dumps(counters) if counters else None))
+            due = len(self._buffer) >= FLUSH_SIZE or time.monotonic() - self._last_flush >= FLUSH_INTERVAL
+        if due:
+            self.flush(wait=False)
+
+    def _start_writer(self):
+        with self._lock:
+            # Also restarts the writer in a forked child, where the thread is gone
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._write_loop, name="metrics-writer", daemon=True)
+                self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            self._wake.wait(FLUSH_INTERVAL)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self, wait=True):
+        """Write buffered samples, or with wait=False only wake the background writer to do it"""
+        if not wait:
+            self._start_writer()
+            self._wake.set()
+            return
+        with self._lock:
+            samples, self._buffer = self._buffer, []
+            self._last_flush = time.monotonic()
+            prune = self._last_prune is None or time.monotonic() - self._last_prune >= PRUNE_INTERVAL
+            if samples and prune:
+                self._last_prune = time.monotonic()
+        if not samples:
+            return
+        try:
+            connection = self._connect()
+            try:
+                with connection:
+                    connection.executemany("INSERT INTO samples VALUES (?, ?, ?, ?)", samples)
+                    if prune:
+                        connection.execute("DELETE FROM samples WHERE ts < ?", (time.time() - self.retention,))
+            finally:
+                connection.close()
+        except sqlite3.Error as e:
+            # Metrics must never break ingestion or answering
+            print(f"Warning: Could not write metrics: {str(e)}")
+
+    def samples(self, window=3600, stage=None):
+        """(stage, seconds, counters) of the samples recorded in the last window seconds"""
+        self.flush()
+        if not os.path.exists(self.path):
+            return []
+        query = "SELECT stage, seconds, counters FROM samples WHERE ts >= ?"
+        params = [time.time() - window]
+        if stage is not None:
+            query += " AND stage = ?"
+            params.append(stage)
+        connection = self._connect()
+        try:
+            rows = connection.execute(query, params).fetchall()
+        finally:
+            connection.close()
+        return [(stage, seconds, json.loads(counters) if counters else {}) for stage, seconds, counters in rows]
+
+    def summary(self, window=3600):
+        """Per stage: sample count, latency percentiles in ms, counter totals and throughput
+
+        Throughput is each counter's total divided by the time spent in the stage, e.g. vectors
+        per second of embedding; rate_per_min is how often the stage ran.
+        """
+        self.flush()
+        if not os.path.exists(self.path):
+            return {}
+        since = time.time() - window
+        connection = self._connect()
+        try:
+            # One read transaction, so the counts, totals and percentiles see the same samples
+            connection.execute("BEGIN")
+            stages = connection.execute(
+                "SELECT stage, COUNT(seconds), SUM(seconds) FROM samples WHERE ts >= ? GROUP BY stage ORDER BY stage", (since,)
+            ).fetchall()
+            totals = {}
+            for stage, name, total in connection.execute(
+                "SELECT s.stage, c.key, SUM(c.value) FROM samples s, json_each(s.counters) c"
+                " WHERE s.ts >= ? AND s.counters IS NOT NULL GROUP BY s.stage, c.key", (since,)
+            ):
+                totals.setdefault(stage, {})[name] = total
+
+            summary = {}
+            for stage, count, seconds_total in stages:
+                stats = {"count": count, "rate_per_min": count / (window / 60), "totals": totals.get(stage, {})}
+                if count:
+                    percentiles = self._percentiles(connection, stage, since, count)
+                    stats.update({f"p{p}_ms": value * 1000 for p, value in percentiles.items()})
+                    stats["seconds_total"] = seconds_total
+                    if seconds_total > 0:
+                        stats["per_s"] = {name: total / seconds_total for name, total in stats["totals"].items()}
+                summary[stage] = stats
+        finally:
+            connection.close()
+        return summary
+
+    @staticmethod
+    def _percentiles(connection, stage, since, count):
+        """p50, p95 and p99 of a stage's durations, from at most about PERCENTILE_SAMPLES of them"""
+        query = "SELECT seconds FROM samples WHERE stage = ? AND ts >= ? AND seconds IS NOT NULL"
+        params = [stage, since]
+        if count > PERCENTILE_SAMPLES:
+            query += " AND abs(random()) % ? = 0"
+            params.append(-(-count // PERCENTILE_SAMPLES))
+        seconds = np.array([row[0] for row in connection.execute(query, params)])
+        return {p: float(np.percentile(seconds, p)) for p in (50, 95, 99)}
+
+    def prometheus_text(self, window=3600):
+        """Summary of the last window seconds in the Prometheus text exposition format"""
+        summary = self.summary(window)
+        name = f"{PROMETHEUS_PREFIX}_stage_seconds"
+        lines = [f"# HELP {name} Stage latency over the last {int(window)} seconds", f"# TYPE {name} summary"]
+        for stage, stats in summary.items():
+            if "seconds_total" not in stats:
+                continue
+            for p in (50, 95, 99):
+                lines.append(f'{name}{{stage="{stage}",quantile="0.{p}"}} {stats[f"p{p}_ms"] / 1000:.6f}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {stats["seconds_total"]:.6f}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {stats["count"]}')
+
+        counters = sorted({counter for stats in summary.values() for counter in stats["totals"]})
+        for counter in counters:
+            name = f"{PROMETHEUS_PREFIX}_{counter}"
+            lines.append(f"# HELP {name} Total {counter.replace('_', ' ')} over the last {int(window)} seconds")
+            lines.append(f"# TYPE {name} gauge")
+            for stage, stats in summary.items():
+                if counter in stats["totals"]:
+                    lines.append(f'{name}{{stage="{stage}"}} {stats["totals"][counter]}')
+        return "\n".join(lines) + "\n"
+
+_store = MetricsStore() if METRICS_DB else None
+if _store is not None:
+    atexit.register(_store.flush)
+
+def record(stage, seconds=None, **counters):
+    """Record a sample in the process-wide store, a no-op when metrics are disabled"""
+    if _store is not None:
+        _store.record(stage, seconds, **counters)
+
+@contextmanager
+def timed(stage, **counters):
+    """Time the enclosed block as one sample of stage
+
+    Yields the counters dict, so the block can add counts it only knows at the end.
+    """
+    started = time.perf_counter()
+    try:
+        yield counters
+    finally:
+        record(stage, time.perf_counter() - started, **counters)
+
+def flush(wait=True):
+    """Write this process's buffered samples now; wait=False hands them to the background writer, e.g. at the end of a chat turn"""
+    if _store is not None:
+        _store.flush(wait)
+
+def get_store():
+    """The process-wide store, or None if metrics are disabled"""
+    return _store
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print recorded stage metrics in the Prometheus text format")
+    parser.add_argument("--window", type=float, default=3600, help="seconds of samples to summarize")
+    args = parser.parse_args()
+    if _store is not None:
+        print(_store.prometheus_text(args.window), end="")
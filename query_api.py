@@ -0,0 +1,454 @@
+import os
+import hmac
+import json
+import time
+import hashlib
+import uuid
+import queue
+import asyncio
+import argparse
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from aiohttp import web
+from langchain_core.embeddings import Embeddings
+import metrics
+from chatpdf import get_embeddings, get_federated_vectordb, get_qa_chain, index_version, list_collections, clean_response_stream
+
+API_HOST = os.getenv("API_HOST", "127.0.0.1")
+API_PORT = int(os.getenv("API_PORT", 8600))
+# Answers generated at once; more requests wait for a free slot, up to API_MAX_QUEUED of them
+API_MAX_CONCURRENT = int(os.getenv("API_MAX_CONCURRENT", 16))
+API_MAX_QUEUED = int(os.getenv("API_MAX_QUEUED", 64))
+# Seconds from receiving a question to the end of its answer, including the wait for a slot
+API_REQUEST_TIMEOUT = float(os.getenv("API_REQUEST_TIMEOUT", 60))
+API_SESSION_TTL = float(os.getenv("API_SESSION_TTL", 1800))
+API_MAX_SESSIONS = int(os.getenv("API_MAX_SESSIONS", 10000))
+# Set by the gateway in front of the API to the caller's comma separated roles, honored only
+# from requests carrying the shared gateway secret
+API_ROLES_HEADER = os.getenv("API_ROLES_HEADER", "X-User-Roles")
+API_DEFAULT_ROLES = os.getenv("API_DEFAULT_ROLES", "user")
+API_GATEWAY_SECRET = os.getenv("API_GATEWAY_SECRET", "")
+API_GATEWAY_HEADER = os.getenv("API_GATEWAY_HEADER", "X-Gateway-Secret")
+# JSON object mapping API keys, sent as "Authorization: Bearer <key>", to their roles
+API_KEYS_FILE = os.getenv("API_KEYS_FILE", "")
+# 1 serves /health and /metrics without credentials, e.g. to a scraper on a private network
+METRICS_PUBLIC = os.getenv("METRICS_PUBLIC", "0") == "1"
+# The first query of a batch waits this long for others before the model is called
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", 5))
+EMBED_BATCH_MAX = int(os.getenv("EMBED_BATCH_MAX", 32))
+
+def parse_roles(value):
+    """Sorted roles of a comma separated list"""
+    return sorted({role.strip() for role in value.split(",") if role.strip()})
+
+def _key_digest(key):
+    # Keys are looked up by digest, so the lookup time says nothing about the key
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+def load_api_keys(path=API_KEYS_FILE):
+    """API keys of the JSON file at path mapped to their roles, a list or a comma separated string"""
+    if not path:
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        keys = json.load(f)
+    if not isinstance(keys, dict):
+        raise ValueError(f"{path} must hold a JSON object of API keys and their roles")
+    return keys
+
+class QueryBatcher(Embeddings):
+    """Embeds the queries of concurrent callers together, in one model call per batch
+
+    embed_query blocks the calling thread until the batch it joined is embedded. A batch
+    collects queries for up to window seconds after its first one, or until it holds
+    max_batch queries; queries that arrive while the model is busy form the next batch.
+    The wrapped embeddings must embed a query like a document, as sentence-transformers does.
+    """
+
+    def __init__(self, embeddings, window=EMBED_BATCH_WINDOW_MS / 1000, max_batch=EMBED_BATCH_MAX):
+        self.embeddings = embeddings
+        self.window = window
+        self.max_batch = max(max_batch, 1)
+        self.counters = {"batches": 0, "queries": 0, "largest": 0}
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._serve, name="query-batcher", daemon=True)
+        self._thread.start()
+
+    def embed_query(self, text):
+        future = Future()
+        self._queue.put((text, future))
+        return future.result()
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def close(self):
+        """Stop the batching thread once the queued queries are embedded"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def stats(self):
+        """Batch and query counters and the mean batch size"""
+        counters = dict(self.counters)
+        counters["mean_batch"] = counters["queries"] / counters["batches"] if counters["batches"] else 0.0
+        return counters
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _serve(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = self._collect(item)
+            started = time.perf_counter()
+            try:
+                vectors = self.embeddings.embed_documents([text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            metrics.record("query_embed_batch", time.perf_counter() - started, queries=len(batch))
+            self.counters["batches"] += 1
+            self.counters["queries"] += len(batch)
+            self.counters["largest"] = max(self.counters["largest"], len(batch))
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+
+class Session:
+    """One conversation: its roles and collections, its QA chain with the chat memory, and whether it is answering"""
+
+    def __init__(self, roles, collections=None):
+        self.roles = roles
+        self.collections = collections
+        self.qa_chain = None
+        self.vectordb = None
+        self.busy = False
+        self.last_used = time.monotonic()
+
+class QueryService:
+    """Chat sessions over the shared indexes, answered by a bounded pool of worker threads
+
+    Chains run synchronously in the pool and hand their tokens to the event loop, which
+    streams them to the client. When every slot is busy, up to max_queued requests wait
+    for one and later requests are turned away with 503. A request that has not finished
+    within timeout seconds is answered with 504, or with an error line once streaming, and
+    its chain stops at the next token. llm replaces the Groq model, e.g. for load tests.
+    Sessions search the collections they were opened with, or collections, all of them if None.
+
+    Callers must authenticate: a gateway with gateway_secret, which then passes each caller's
+    roles in API_ROLES_HEADER, or a client with one of api_keys (key to roles, API_KEYS_FILE
+    by default). Anyone else gets 401, so with neither configured every request is refused.
+    /health and /metrics need the same credentials unless metrics_public is set.
+    """
+
+    def __init__(
+        self, collections=None, llm=None, use_cache=True, max_concurrent=API_MAX_CONCURRENT,
+        max_queued=API_MAX_QUEUED, timeout=API_REQUEST_TIMEOUT, session_ttl=API_SESSION_TTL,
+        max_sessions=API_MAX_SESSIONS, batch_window=EMBED_BATCH_WINDOW_MS / 1000, max_batch=EMBED_BATCH_MAX,
+        gateway_secret=API_GATEWAY_SECRET, api_keys=None, metrics_public=METRICS_PUBLIC,
+    ):
+        self.collections = collections
+        self.gateway_secret = gateway_secret
+        self.metrics_public = metrics_public
+        api_keys = load_api_keys() if api_keys is None else api_keys
+        self._api_keys = {
+            _key_digest(key): parse_roles(roles if isinstance(roles, str) else ",".join(roles)) for key, roles in api_keys.items()
+        }
+        if not gateway_secret and not self._api_keys:
+            print("Warning: Neither API_GATEWAY_SECRET nor API_KEYS_FILE is set, every request will be refused")
+        self.llm = llm
+        self.use_cache = use_cache
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self.session_ttl = session_ttl
+        self.max_sessions = max_sessions
+        self.sessions = {}
+        self.active = 0
+        self.waiting = 0
+        self.batcher = QueryBatcher(get_embeddings(), batch_window, max_batch)
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="answer")
+
+    def _roles(self, request):
+        """Roles of an authenticated caller, 401 for anyone else"""
+        secret = request.headers.get(API_GATEWAY_HEADER)
+        if self.gateway_secret and secret is not None and hmac.compare_digest(
+            secret.encode("utf-8"), self.gateway_secret.encode("utf-8")
+        ):
+            return parse_roles(request.headers.get(API_ROLES_HEADER, API_DEFAULT_ROLES))
+        scheme, _, key = request.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() == "bearer" and key.strip():
+            roles = self._api_keys.get(_key_digest(key.strip()))
+            if roles is not None:
+                return roles
+        raise web.HTTPUnauthorized(text="Missing or invalid credentials", headers={"WWW-Authenticate": "Bearer"})
+
+    def _session(self, request):
+        session = self.sessions.get(request.match_info["session_id"])
+        if session is None:
+            raise web.HTTPNotFound(text="Unknown or expired session")
+        if self._roles(request) != session.roles:
+            raise web.HTTPForbidden(text="The session belongs to other roles")
+        return session
+
+    def expire_sessions(self):
+        """Drop sessions idle for longer than the session TTL"""
+        cutoff = time.monotonic() - self.session_ttl
+        for session_id, session in list(self.sessions.items()):
+            if not session.busy and session.last_used < cutoff:
+                del self.sessions[session_id]
+
+    def _chain(self, session):
+        # Runs in a worker thread; a session answers one question at a time
+        vectordb = get_federated_vectordb(session.collections or self.collections)
+        if session.vectordb is not vectordb:
+            memory = session.qa_chain.memory if session.qa_chain is not None else None
+            session.qa_chain = get_qa_chain(
+                vectordb, memory=memory, use_cache=self.use_cache, roles=session.roles, llm=self.llm,
+                query_embeddings=self.batcher,
+            )
+            session.vectordb = vectordb
+        return session.qa_chain
+
+    def _answer(self, session, question, emit, cancelled):
+        """Stream the answer to question through emit, stopping when cancelled is set"""
+        tokens = cleaned = None
+        try:
+            answer = self._chain(session).stream({"question": question})
+            tokens = iter(answer)
+            cleaned = clean_response_stream(tokens)
+            text = ""
+            for token in cleaned:
+                if cancelled.is_set():
+                    return
+                text += token
+                emit("token", token)
+            result = answer.result
+            emit("done", {
+                "answer": text,
+                "sources": [
+                    {
+                        "source": os.path.basename(doc.metadata.get("source", "")),
+                        "page": doc.metadata.get("page"),
+                        "collection": doc.metadata.get("collection", session.vectordb.index_name),
+                    }
+                    for doc in result["source_documents"]
+                ],
+                "cached": result["cached"],
+                "timings": result["timings"],
+            })
+        except FileNotFoundError as e:
+            emit("error", (503, str(e)))
+        except Exception as e:
+            print(f"Warning: Could not answer question: {str(e)}")
+            emit("error", (500, str(e)))
+        finally:
+            # Closing the streams early abandons the answer, so it is neither cached nor remembered
+            if cleaned is not None:
+                cleaned.close()
+            if tokens is not None:
+                tokens.close()
+
+    def _release(self, session):
+        self.active -= 1
+        self._slots.release()
+        session.busy = False
+        session.last_used = time.monotonic()
+
+    async def create_session(self, request):
+        """Open a session, searching the collections of an optional {"collections": [...]} body"""
+        collections = None
+        if request.can_read_body:
+            try:
+                body = await request.json()
+            except ValueError:
+                raise web.HTTPBadRequest(text="Expected a JSON body")
+            collections = body.get("collections") if isinstance(body, dict) else None
+            if collections is not None:
+                if not isinstance(collections, list) or not collections or not all(isinstance(name, str) for name in collections):
+                    raise web.HTTPBadRequest(text='Expected {"collections": ["...", ...]}')
+                unknown = sorted(set(collections) - set(list_collections()))
+                if unknown:
+                    raise web.HTTPBadRequest(text=f"Unknown collections: {', '.join(unknown)}")
+        self.expire_sessions()
+        if len(self.sessions) >= self.max_sessions:
+            raise web.HTTPServiceUnavailable(text="Too many open sessions", headers={"Retry-After": "10"})
+        session_id = uuid.uuid4().hex
+        self.sessions[session_id] = Session(self._roles(request), collections)
+        return web.json_response({"session_id": session_id}, status=201)
+
+    async def delete_session(self, request):
+        session = self._session(request)
+        if session.busy:
+            raise web.HTTPConflict(text="The session is answering a question")
+        del self.sessions[request.match_info["session_id"]]
+        return web.Response(status=204)
+
+    async def ask(self, request):
+        """Answer {"question": ...} as JSON lines: {"token": ...} as they arrive, then the result"""
+        session = self._session(request)
+        try:
+            body = await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest(text="Expected a JSON body")
+        question = body.get("question") if isinstance(body, dict) else None
+        if not isinstance(question, str) or not question.strip():
+            raise web.HTTPBadRequest(text='Expected {"question": "..."}')
+        if session.busy:
+            raise web.HTTPConflict(text="The session is still answering its previous question")
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        deadline = started + self.timeout
+        counters = {"rejected": 0, "timeouts": 0, "errors": 0, "tokens": 0}
+        try:
+            # Counted before any await, so requests arriving together cannot all slip in
+            if self.active + self.waiting >= self.max_concurrent + self.max_queued:
+                counters["rejected"] = 1
+                raise web.HTTPServiceUnavailable(text="Too many questions in progress", headers={"Retry-After": "1"})
+            session.busy = True
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._slots.acquire(), self.timeout)
+            except BaseException as e:
+                session.busy = False
+                if isinstance(e, asyncio.TimeoutError):
+                    counters["timeouts"] = 1
+                    raise web.HTTPGatewayTimeout(text="No answer slot became free in time")
+                raise
+            finally:
+                self.waiting -= 1
+            self.active += 1
+            metrics.record("api_wait", loop.time() - started)
+            return await self._stream(request, session, question, deadline, counters)
+        finally:
+            metrics.record("api_request", loop.time() - started, **counters)
+
+    async def _stream(self, request, session, question, deadline, counters):
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        cancelled = threading.Event()
+
+        def emit(kind, value):
+            loop.call_soon_threadsafe(events.put_nowait, (kind, value))
+
+        # The slot is held until the worker is done, even if the client is gone
+        worker = loop.run_in_executor(self._executor, self._answer, session, question, emit, cancelled)
+        worker.add_done_callback(lambda _: self._release(session))
+
+        response = None
+        finished = False
+        try:
+            while not finished:
+                try:
+                    kind, value = await asyncio.wait_for(events.get(), max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    counters["timeouts"] = 1
+                    kind, value = "timeout", (504, "The answer took too long")
+                if kind in ("error", "timeout"):
+                    counters["errors"] = int(kind == "error")
+                    status, message = value
+                    if response is None:
+                        raise _http_error(status, message)
+                    await response.write(_line({"error": message}))
+                    break
+                if response is None:
+                    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson", "Cache-Control": "no-cache"})
+                    await response.prepare(request)
+                if kind == "token":
+                    counters["tokens"] += 1
+                    await response.write(_line({"token": value}))
+                else:
+                    await response.write(_line(value))
+                    finished = True
+            await response.write_eof()
+            return response
+        finally:
+            if not finished:
+                cancelled.set()
+
+    async def health(self, request):
+        if not self.metrics_public:
+            self._roles(request)
+        return web.json_response({
+            "index_versions": {name: index_version(name) for name in self.collections or list_collections()},
+            "sessions": len(self.sessions),
+            "active": self.active,
+            "queued": self.waiting,
+            "max_concurrent": self.max_concurrent,
+            "embedding_batches": self.batcher.stats(),
+        })
+
+    async def prometheus(self, request):
+        if not self.metrics_public:
+            self._roles(request)
+        store = metrics.get_store()
+        if store is None:
+            raise web.HTTPNotFound(text="Metrics are disabled")
+        window = float(request.query.get("window", 3600))
+        text = await asyncio.get_running_loop().run_in_executor(None, store.prometheus_text, window)
+        return web.Response(text=text, content_type="text/plain")
+
+    async def _lifetime(self, app):
+        loop = asyncio.get_running_loop()
+        # Load the index and the embedding model before the first question instead of during it
+        try:
+            await loop.run_in_executor(self._executor, get_federated_vectordb, self.collections)
+        except FileNotFoundError as e:
+            print(f"Warning: {str(e)}")
+        await loop.run_in_executor(self._executor, self.batcher.embed_query, "warm up")
+        expiry = asyncio.create_task(self._expire_periodically())
+        yield
+        expiry.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.batcher.close()
+        metrics.flush()
+
+    async def _expire_periodically(self):
+        while True:
+            await asyncio.sleep(min(self.session_ttl, 60))
+            self.expire_sessions()
+
+def _http_error(status, message):
+    return {503: web.HTTPServiceUnavailable, 504: web.HTTPGatewayTimeout}.get(status, web.HTTPInternalServerError)(text=message)
+
+def _line(value):
+    return (json.dumps(value) + "\n").encode("utf-8")
+
+def create_app(service=None):
+    """aiohttp application serving the query API of service, a QueryService with default settings if None"""
+    service = service or QueryService()
+    app = web.Application()
+    app["service"] = service
+    app.cleanup_ctx.append(service._lifetime)
+    app.add_routes([
+        web.post("/sessions", service.create_session),
+        web.delete("/sessions/{session_id}", service.delete_session),
+        web.post("/sessions/{session_id}/ask", service.ask),
+        web.get("/health", service.health),
+        web.get("/metrics", service.prometheus),
+    ])
+    return app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve chat sessions over the document index as an HTTP API")
+    parser.add_argument("--host", default=API_HOST)
+    parser.add_argument("--port", type=int, default=API_PORT)
+    parser.add_argument("--collections", default="", help="comma separated collections searched by default, all of them if empty")
+    args = parser.parse_args()
+    collections = [name.strip() for name in args.collections.split(",") if name.strip()] or None
+    web.run_app(create_app(QueryService(collections)), host=args.host, port=args.port)
@@ -0,0 +1,25 @@
+import pytest
+import chatpdf
+import metrics
+from context_packing import ContextCache
+from embedding_cache import EmbeddingCache
+from benchmarks.fake_llm import HashEmbeddings
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Point chatpdf at scratch data, index and cache folders with fake embeddings and no metrics
+
+    Every module global is patched through monkeypatch, so the next test starts from the original state.
+    """
+    monkeypatch.setattr(metrics, "_store", None)
+    monkeypatch.setattr(chatpdf, "DATA_DIR", str(tmp_path / "data") + "/")
+    monkeypatch.setattr(chatpdf, "EMBEDDINGS_DIR", str(tmp_path / "embeddings") + "/")
+    key = (chatpdf.EMBEDDING_MODEL, chatpdf.EMBEDDING_NORMALIZE, chatpdf.EMBEDDING_BACKEND)
+    cache = EmbeddingCache(chatpdf.EMBEDDING_MODEL, chatpdf.EMBEDDING_NORMALIZE, str(tmp_path / "embedding_cache"), backend=chatpdf.EMBEDDING_BACKEND)
+    monkeypatch.setattr(chatpdf, "_embedding_models", {key: HashEmbeddings()})
+    monkeypatch.setattr(chatpdf, "_embedding_caches", {key: cache})
+    monkeypatch.setattr(chatpdf, "_shared_vectordbs", {})
+    monkeypatch.setattr(chatpdf, "_federated_vectordbs", {})
+    monkeypatch.setattr(chatpdf, "_answer_caches", {})
+    monkeypatch.setattr(chatpdf, "_context_cache", ContextCache())
+    return tmp_path
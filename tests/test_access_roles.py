@@ -0,0 +1,67 @@
+import pytest
+import chatpdf
+from benchmarks.corpus import generate
+
+QUERY = "What is the policy on leave?"
+
+@pytest.fixture
+def corpus(workdir):
+    """Three synthetic PDFs in a scratch data folder, the first one restricted to hr"""
+    paths = sorted(generate(chatpdf.DATA_DIR, 3, 3))
+    chatpdf.process_and_save_pdfs(access={paths[0]: ["hr"]})
+    return paths
+
+def sources(roles, index_name="docs_index"):
+    vectordb = chatpdf.load_vectordb(index_name, mode="memory")
+    query = vectordb.embeddings.embed_query(QUERY)
+    k = len(vectordb.index_to_docstore_id)
+    return {doc.metadata["source"] for doc in vectordb.vector_search(query, k=k, roles=roles)}
+
+def manifest_roles(path):
+    manifest = chatpdf._load_manifest(chatpdf._index_paths("docs_index")["manifest"])
+    return manifest["files"][chatpdf._manifest_key(path)]["roles"]
+
+def test_restricted_file_is_filtered(corpus):
+    assert corpus[0] not in sources(["user"])
+    assert corpus[0] in sources(["hr"])
+
+@pytest.mark.parametrize("rebuild", [
+    lambda paths: chatpdf.rebuild_embeddings_for_all_docs(),
+    lambda paths: chatpdf.process_and_save_pdfs(rebuild=True),
+    lambda paths: chatpdf.process_and_save_pdfs([paths[1]], rebuild=True, access={paths[1]: None}),
+])
+def test_rebuild_keeps_roles(corpus, rebuild):
+    rebuild(corpus)
+    assert manifest_roles(corpus[0]) == ["hr"]
+    assert corpus[0] not in sources(["user"])
+    assert corpus[0] in sources(["hr"])
+
+def test_model_change_keeps_roles(corpus, monkeypatch):
+    # A mismatch discards the index like a rebuild does
+    monkeypatch.setattr(chatpdf, "_embedding_mismatch", lambda manifest: "changed")
+    chatpdf.process_and_save_pdfs()
+    assert manifest_roles(corpus[0]) == ["hr"]
+
+def test_explicit_access_lifts_restriction(corpus):
+    chatpdf.process_and_save_pdfs(rebuild=True, access={corpus[0]: None})
+    assert manifest_roles(corpus[0]) is None
+    assert corpus[0] in sources(["user"])
+
+def test_unreadable_manifest_fails_closed(corpus):
+    with open(chatpdf._index_paths("docs_index")["manifest"], "w", encoding="utf-8") as f:
+        f.write("{")
+    with pytest.raises(ValueError):
+        chatpdf.rebuild_embeddings_for_all_docs()
+
+def test_rebuild_job_keeps_roles(workdir, monkeypatch):
+    # The admin panel's "Rebuild Collection" button queues this job
+    import ingest_queue
+
+    monkeypatch.setattr(ingest_queue, "JOBS_DIR", str(workdir / "jobs"))
+    paths = sorted(generate(chatpdf.collection_data_dir("hr"), 3, 3))
+    chatpdf.process_and_save_pdfs(index_name="hr", access={paths[0]: ["hr"]})
+    ingest_queue.submit_job([], index_name="hr", rebuild=True)
+    jobs = ingest_queue.run_next_job()
+    assert [job["state"] for job in jobs] == ["done"]
+    assert paths[0] not in sources(["user"], "hr")
+    assert paths[0] in sources(["hr"], "hr")
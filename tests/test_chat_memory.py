@@ -0,0 +1,50 @@
+import threading
+from langchain_core.messages import AIMessage, SystemMessage
+from chat_memory import TokenBudgetMemory
+
+class BlockingLLM:
+    """Summarizes only once released, to catch a fold that blocks the next turn"""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def invoke(self, prompt):
+        self.started.set()
+        self.release.wait(10)
+        return AIMessage(content="Summary of turns")
+
+def test_fold_does_not_block_the_next_turn():
+    llm = BlockingLLM()
+    memory = TokenBudgetMemory(llm, token_budget=200, recent_turns=2)
+    for i in range(3):
+        memory.save_context({"question": f"Question {i}"}, {"answer": f"Answer {i}"})
+    assert llm.started.wait(10)
+
+    # While the fold runs, the next turn reads the previous summary and every turn as they are
+    messages = memory.load_memory_variables({})["chat_history"]
+    assert [message.content for message in messages[::2]] == ["Question 0", "Question 1", "Question 2"]
+    memory.save_context({"question": "Question 3"}, {"answer": "Answer 3"})
+    assert memory.stats()["folding"]
+
+    llm.release.set()
+    memory._folding.join(10)
+    messages = memory.load_memory_variables({})["chat_history"]
+    assert isinstance(messages[0], SystemMessage)
+    assert [message.content for message in messages[1::2]] == ["Question 2", "Question 3"]
+    stats = memory.stats()
+    assert stats["summarized_turns"] == 2 and not stats["folding"]
+    assert stats["history_tokens"] <= 200
+
+def test_clear_drops_a_running_fold():
+    llm = BlockingLLM()
+    memory = TokenBudgetMemory(llm, token_budget=200, recent_turns=1)
+    memory.save_context({"question": "Question 0"}, {"answer": "Answer 0"})
+    memory.save_context({"question": "Question 1"}, {"answer": "Answer 1"})
+    assert llm.started.wait(10)
+    folding = memory._folding
+    memory.clear()
+    llm.release.set()
+    folding.join(10)
+    assert memory.load_memory_variables({})["chat_history"] == []
+    assert memory.summary == ""
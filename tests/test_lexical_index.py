@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+import chatpdf
+from benchmarks.corpus import generate
+from lexical_index import BM25Index
+
+TEXTS = {
+    "a": "Form 1099-B reports proceeds from broker transactions",
+    "b": "Annual leave policy: employees accrue leave monthly",
+    "c": "Sick leave requires a note after three days",
+    "d": "Zebra crossings and plan_v2.1 of the office move",
+}
+QUERIES = ["1099-B proceeds", "leave policy", "sick note", "plan_v2.1", "nothing matches"]
+
+@pytest.fixture
+def saved(tmp_path):
+    lexical = BM25Index()
+    lexical.add(list(TEXTS), list(TEXTS.values()))
+    path = str(tmp_path / "index.bm25")
+    lexical.save(path)
+    return lexical, path
+
+def test_load_maps_arrays(saved):
+    lexical, path = saved
+    loaded = BM25Index.load(path)
+    assert loaded.term_ids is None
+    assert all(isinstance(array.base, np.memmap) for array in loaded._postings)
+    assert list(loaded.row_ids()) == list(lexical.row_ids())
+    for query in QUERIES:
+        assert loaded.search(query, 3) == pytest.approx(lexical.search(query, 3))
+
+def test_loaded_index_can_change(saved, tmp_path):
+    lexical, path = saved
+    loaded = BM25Index.load(path)
+    for index in (lexical, loaded):
+        index.delete(["b"])
+        index.add(["e"], ["Parental leave and the zebra policy"])
+    assert loaded.row_ids() == ["a", "c", "d", "e"]
+    for query in QUERIES + ["zebra"]:
+        assert loaded.search(query, 3) == pytest.approx(lexical.search(query, 3))
+
+    # Saving renumbers the new terms, the reloaded index must still find them
+    loaded.save(str(tmp_path / "again.bm25"))
+    reloaded = BM25Index.load(str(tmp_path / "again.bm25"))
+    assert [id_ for id_, _ in reloaded.search("parental", 3)] == ["e"]
+    assert reloaded.search("zebra", 3) == pytest.approx(lexical.search("zebra", 3))
+
+def test_reads_npz(saved, tmp_path):
+    lexical, _ = saved
+    # The single file layout written before the arrays were mapped
+    post_ptr, post_docs, _ = lexical._postings
+    post_tfs = lexical.doc_tfs[np.argsort(lexical.doc_terms, kind="stable")]
+    path = str(tmp_path / "index.bm25.npz")
+    np.savez(
+        path,
+        vocabulary=np.frombuffer("\n".join(lexical.vocabulary).encode("utf-8"), dtype=np.uint8),
+        doc_ids=np.frombuffer("\n".join(lexical.doc_ids).encode("utf-8"), dtype=np.uint8),
+        doc_ptr=lexical.doc_ptr, doc_terms=lexical.doc_terms, doc_tfs=lexical.doc_tfs, doc_len=lexical.doc_len,
+        post_ptr=post_ptr, post_docs=post_docs, post_tfs=post_tfs,
+    )
+    loaded = BM25Index.load(path)
+    for query in QUERIES:
+        assert loaded.search(query, 3) == pytest.approx(lexical.search(query, 3))
+
+@pytest.mark.parametrize("mode", ["mmap", "memory"])
+def test_saved_index_is_mapped(workdir, mode):
+    generate(chatpdf.DATA_DIR, 2, 2)
+    chatpdf.process_and_save_pdfs()
+    vectordb = chatpdf.load_vectordb(mode=mode)
+    assert vectordb._lexical is not None and vectordb._lexical.term_ids is None
+    assert vectordb._access is not None
+    assert vectordb.lexical.search("leave policy", 3)
@@ -0,0 +1,28 @@
+import os
+import chatpdf
+from langchain_core.documents import Document
+from langchain_community.vectorstores import FAISS
+
+def test_migrate_legacy_index_without_manifest(workdir):
+    # Saved like embeddings/docs_index.faiss: a pickled docstore and no manifest
+    docs = [
+        Document(page_content=f"Chunk {i} of the leave policy", metadata={"source": source, "page": i % 2, "total_pages": 2})
+        for i, source in enumerate(["data\\policies.pdf", "data/policies.pdf", "data/insurance.pdf"])
+    ]
+    FAISS.from_documents(docs, chatpdf.get_embeddings()).save_local(chatpdf._index_paths("docs_index")["faiss"])
+
+    assert chatpdf.migrate_chunk_store("docs_index")
+    paths = chatpdf._index_paths("docs_index")
+    assert paths["generation"] is not None
+    assert not os.path.exists(paths["legacy_faiss"])
+    manifest = chatpdf._load_manifest(paths["manifest"])
+    assert chatpdf._embedding_mismatch(manifest) is None
+    assert sorted(manifest["files"]) == ["data/insurance.pdf", "data/policies.pdf"]
+    assert len(manifest["files"]["data/policies.pdf"]["chunk_ids"]) == 2
+    assert manifest["files"]["data/policies.pdf"]["pages"] == 2
+
+    vectordb = chatpdf.load_vectordb(mode="memory")
+    assert isinstance(vectordb.docstore, chatpdf.ChunkStore)
+    query = vectordb.embeddings.embed_query("leave policy")
+    assert len(vectordb.vector_search(query, k=3)) == 3
+    assert not chatpdf.migrate_chunk_store("docs_index")
@@ -0,0 +1,35 @@
+import asyncio
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+import metrics
+import query_api
+from benchmarks.fake_llm import FakeChatModel
+
+def get(service, path, headers=None):
+    """Status of a GET request to a running app of service"""
+    async def request():
+        async with TestClient(TestServer(query_api.create_app(service))) as client:
+            response = await client.get(path, headers=headers or {})
+            return response.status
+
+    return asyncio.run(request())
+
+@pytest.fixture
+def service(workdir, monkeypatch):
+    # A store, so /metrics has something to serve once the caller is let in
+    monkeypatch.setattr(metrics, "_store", metrics.MetricsStore(str(workdir / "metrics.db")))
+
+    def make(**kwargs):
+        return query_api.QueryService(llm=FakeChatModel(latency=0.0), gateway_secret="gw", api_keys={"key": "user"}, **kwargs)
+    return make
+
+@pytest.mark.parametrize("path", ["/metrics", "/health"])
+def test_monitoring_needs_credentials(service, path):
+    assert get(service(), path) == 401
+    assert get(service(), path, {"Authorization": "Bearer wrong"}) == 401
+    assert get(service(), path, {"Authorization": "Bearer key"}) == 200
+    assert get(service(), path, {"X-Gateway-Secret": "gw"}) == 200
+
+@pytest.mark.parametrize("path", ["/metrics", "/health"])
+def test_metrics_public_opt_in(service, path):
+    assert get(service(metrics_public=True), path) == 200
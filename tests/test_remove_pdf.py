@@ -0,0 +1,64 @@
+import os
+import pytest
+import chatpdf
+from benchmarks.corpus import generate
+
+QUERY = "What is the policy on leave?"
+
+def visible_sources(mode, roles=None):
+    vectordb = chatpdf.load_vectordb(mode=mode)
+    query = vectordb.embeddings.embed_query(QUERY)
+    k = len(vectordb.index_to_docstore_id)
+    docs = vectordb.vector_search(query, k=k, roles=roles) + vectordb.hybrid_search_by_vector(QUERY, query, k=k, roles=roles)
+    return {doc.metadata["source"] for doc in docs}
+
+@pytest.fixture
+def corpus(workdir, monkeypatch, request):
+    monkeypatch.setattr(chatpdf, "INDEX_TYPE", request.param)
+    paths = sorted(generate(chatpdf.DATA_DIR, 4, 2))
+    chatpdf.process_and_save_pdfs()
+    return paths
+
+@pytest.mark.parametrize("corpus", ["flat", "hnsw"], indirect=True)
+def test_remove_marks_vectors_deleted(corpus, monkeypatch):
+    monkeypatch.setattr(chatpdf, "INDEX_COMPACT_FRACTION", 0.5)
+    before = chatpdf._index_paths("docs_index")
+    chatpdf.remove_pdf(corpus[0])
+    after = chatpdf._index_paths("docs_index")
+    # The new generation links the files of the previous one and lists the deleted vectors
+    assert after["generation"] != before["generation"]
+    assert os.path.samefile(os.path.join(before["faiss"], "index.faiss"), os.path.join(after["faiss"], "index.faiss"))
+    assert chatpdf._load_deleted(after["faiss"])
+    assert chatpdf._manifest_key(corpus[0]) not in chatpdf._load_manifest(after["manifest"])["files"]
+    for mode in ("mmap", "memory"):
+        for roles in (None, ["user"]):
+            assert visible_sources(mode, roles) == set(corpus[1:])
+
+@pytest.mark.parametrize("corpus", ["flat", "hnsw"], indirect=True)
+def test_next_save_drops_deleted_vectors(corpus, monkeypatch):
+    monkeypatch.setattr(chatpdf, "INDEX_COMPACT_FRACTION", 0.5)
+    chatpdf.remove_pdf(corpus[0])
+    generate(os.path.join(chatpdf.DATA_DIR, "more"), 1, 2)
+    os.replace(os.path.join(chatpdf.DATA_DIR, "more", "synthetic_00000.pdf"), os.path.join(chatpdf.DATA_DIR, "added.pdf"))
+    chatpdf.process_and_save_pdfs()
+    paths = chatpdf._index_paths("docs_index")
+    vectordb = chatpdf.load_vectordb(mode="memory")
+    deleted = chatpdf._load_deleted(paths["faiss"])
+    if chatpdf._index_kind(vectordb.index) == "hnsw":
+        # Below INDEX_COMPACT_FRACTION the graph keeps them, only the chunks are gone
+        assert deleted and vectordb.index.ntotal == len(vectordb.index_to_docstore_id) + len(deleted)
+    else:
+        assert not deleted and vectordb.index.ntotal == len(vectordb.index_to_docstore_id)
+    assert len(vectordb.docstore) == len(vectordb.index_to_docstore_id) == len(vectordb.lexical)
+    for mode in ("mmap", "memory"):
+        assert visible_sources(mode) == set(corpus[1:]) | {os.path.join(chatpdf.DATA_DIR, "added.pdf")}
+
+@pytest.mark.parametrize("corpus", ["flat", "hnsw"], indirect=True)
+def test_remove_past_compact_fraction_rewrites_index(corpus, monkeypatch):
+    monkeypatch.setattr(chatpdf, "INDEX_COMPACT_FRACTION", 0.1)
+    chatpdf.remove_pdf(corpus[0])
+    paths = chatpdf._index_paths("docs_index")
+    assert not chatpdf._load_deleted(paths["faiss"])
+    vectordb = chatpdf.load_vectordb(mode="memory")
+    assert vectordb.index.ntotal == len(vectordb.index_to_docstore_id)
+    assert visible_sources("mmap") == set(corpus[1:])
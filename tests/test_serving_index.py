@@ -0,0 +1,13 @@
+import chatpdf
+from benchmarks.corpus import generate
+
+def test_mmap_keeps_hnsw(workdir, monkeypatch):
+    monkeypatch.setattr(chatpdf, "INDEX_TYPE", "hnsw")
+    generate(chatpdf.DATA_DIR, 3, 3)
+    chatpdf.process_and_save_pdfs()
+    vectordb = chatpdf.load_vectordb(mode="mmap", ef_search=123)
+    assert vectordb.read_only
+    assert chatpdf._index_kind(vectordb.index) == "hnsw"
+    assert chatpdf.faiss.downcast_index(vectordb.index).hnsw.efSearch == 123
+    query = vectordb.embeddings.embed_query("What is the policy on leave?")
+    assert len(vectordb.vector_search(query, k=4)) == 4
@@ -1,6 +1,16 @@
 import streamlit as st
-from chatpdf import load_vectordb, get_qa_chain
+from chatpdf import get_federated_vectordb, get_qa_chain, clean_response_stream, list_collections
+import metrics
 import os
+import time
+
+# Every rerun of this script is timed up to the point where a new answer starts
+script_started = time.perf_counter()
+
+# Roles of the people using this app; documents restricted to other roles are never retrieved
+USER_ROLES = [role.strip() for role in os.getenv("USER_ROLES", "user").split(",") if role.strip()]
+# Collections searched by default, all of them when empty
+USER_COLLECTIONS = [name.strip() for name in os.getenv("USER_COLLECTIONS", "").split(",") if name.strip()]
 
 # Set page config
 st.set_page_config(
@@ -170,9 +180,26 @@ st.markdown("""
 st.markdown('<div class="main-content">', unsafe_allow_html=True)
 
 try:
-    # Load vector DB and QA chain
-    vectordb = load_vectordb()
-    qa_chain = get_qa_chain(vectordb)
+    # Questions are searched in every selected collection in parallel
+    collections = list_collections()
+    selected = collections
+    if len(collections) > 1:
+        with st.sidebar:
+            selected = st.multiselect(
+                "Collections",
+                collections,
+                default=[name for name in USER_COLLECTIONS if name in collections] or collections,
+            )
+
+    # Shared vector DB, reloaded by chatpdf when the admin publishes a new index
+    vectordb = get_federated_vectordb(selected or collections)
+
+    # One QA chain per session so its memory survives reruns
+    if st.session_state.get("qa_vectordb") is not vectordb:
+        memory = st.session_state.qa_chain.memory if "qa_chain" in st.session_state else None
+        st.session_state.qa_chain = get_qa_chain(vectordb, memory=memory, roles=USER_ROLES)
+        st.session_state.qa_vectordb = vectordb
+    qa_chain = st.session_state.qa_chain
     
     # Initialize chat history
     if "chat_history" not in st.session_state:
@@ -189,39 +216,36 @@ try:
         </div>
         """, unsafe_allow_html=True)
     
+    def render_message(role, message, container=st):
+        css_class = "user-message" if role == "user" else "assistant-message"
+        container.markdown(f"""
+        <div class="chat-message {css_class}">
+            <div class="message-content">{message}</div>
+        </div>
+        """, unsafe_allow_html=True)
+
     # Display chat history
     for role, message in st.session_state.chat_history:
-        if role == "user":
-            st.markdown(f"""
-            <div class="chat-message user-message">
-                <div class="message-content">{message}</div>
-            </div>
-            """, unsafe_allow_html=True)
-        else:
-            st.markdown(f"""
-            <div class="chat-message assistant-message">
-                <div class="message-content">{message}</div>
-            </div>
-            """, unsafe_allow_html=True)
+        render_message(role, message)
     
     st.markdown('</div>', unsafe_allow_html=True)
+    metrics.record("rerun", time.perf_counter() - script_started, messages=len(st.session_state.chat_history))
     
     # Chat input
     if prompt := st.chat_input("Send a message..."):
         # Add user message to history
         st.session_state.chat_history.append(("user", prompt))
+        render_message("user", prompt)
         
-        # Show thinking spinner
+        # Render the answer token by token as the LLM produces it
+        placeholder = st.empty()
         with st.spinner(""):
-            # Get AI response
-            result = qa_chain({"question": prompt})
-            response = result["answer"]
-            
-            # Clean up the response
-            clean_response = response.replace("According to the Clinic Policies Manual, ", "")
-            clean_response = clean_response.replace("The manual states that ", "")
-            clean_response = clean_response.replace("Based on the document, ", "")
-            clean_response = clean_response.replace("According to the document, ", "")
+            stream = qa_chain.stream({"question": prompt})
+            clean_response = ""
+            # Filler phrases are removed even when they arrive split across tokens
+            for text in clean_response_stream(stream):
+                clean_response += text
+                render_message("assistant", clean_response + "▌", placeholder)
             
         # Add AI response to history
         st.session_state.chat_history.append(("assistant", clean_response))